@@ -0,0 +1,31 @@
+"""
+Data and helpers shared by the benchmarks.
+"""
+import json
+import os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+BENCH_LANGUAGES = ["ENGLISH", "FRENCH", "SPANISH", "GERMAN", "CHINESE", "JAPANESE", "KOREAN"]
+
+
+def load_llm_answers():
+    with open(os.path.join(FIXTURES_DIR, "llm_answers.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def split_into_llm_chunks(text: str, sizes=(3, 7, 2, 11, 5, 4, 9)):
+    """
+    Splits an answer the way the LLM backend streams it: small, uneven
+    pieces that cut through words, markdown markers and the language tag.
+    The size cycle is fixed so every run sees the same chunks.
+    """
+    chunks = []
+    pos = 0
+    i = 0
+    while pos < len(text):
+        size = sizes[i % len(sizes)]
+        chunks.append(text[pos:pos + size])
+        pos += size
+        i += 1
+    return chunks
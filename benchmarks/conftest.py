@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# service modules use flat imports (``from app_config import ...``), same as when run from chatagent_ws/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatagent_ws"))
+
+from bench_util import load_llm_answers  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def llm_answers():
+    return load_llm_answers()
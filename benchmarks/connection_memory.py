@@ -0,0 +1,83 @@
+"""
+Memory per idle websocket connection of a single running worker.
+
+Opens --connections idle websockets on an endpoint and reports the growth
+of the worker's private memory (smaps_rollup, Linux only) and of the Python
+heap (a tracemalloc diff from /api/profile taken while they connect), per
+connection. Run the server with one worker on this host:
+
+    APP_WS_WORKERS=1 python chatagent_ws/main.py
+    python benchmarks/connection_memory.py --endpoint text --connections 1000 --api-key $APP_WS_API_KEY
+"""
+import argparse
+import asyncio
+import json
+import os
+
+import httpx
+import websockets
+
+from worker_rss import read_smaps_rollup
+
+
+def private_kb(pid: int) -> int:
+    values = read_smaps_rollup(pid)
+    return values["Private_Clean"] + values["Private_Dirty"]
+
+
+async def open_idle_connections(http: httpx.AsyncClient, ws_url: str, endpoint: str, api_key: str, count: int):
+    connections = []
+    for _ in range(count):
+        response = await http.post("/api/get_session_token", headers={"x-api-key": api_key})
+        response.raise_for_status()
+        token = response.json()["session_token"]
+        connections.append(await websockets.connect(f"{ws_url}/{endpoint}-ws?session_token={token}"))
+    return connections
+
+
+async def run(args):
+    ws_url = args.url.replace("http://", "ws://").replace("https://", "wss://")
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.settle + 120) as http:
+        pid = (await http.get("/health/live")).json()["worker_pid"]
+        before = private_kb(pid)
+        # the tracemalloc window has to cover opening the connections
+        window = args.window or args.connections / 25 + args.settle
+        started = asyncio.get_running_loop().time()
+        profile = asyncio.create_task(http.post("/api/profile", headers={"x-api-key": args.api_key},
+                                                json={"mode": "memory", "seconds": window}))
+        await asyncio.sleep(0.2)
+        connections = await open_idle_connections(http, ws_url, args.endpoint, args.api_key, args.connections)
+        opened_in = asyncio.get_running_loop().time() - started
+        heap = await profile
+        await asyncio.sleep(args.settle)
+        after = private_kb(pid)
+        await asyncio.gather(*[ws.close() for ws in connections], return_exceptions=True)
+
+    result = {"endpoint": args.endpoint, "connections": args.connections, "worker_pid": pid,
+              "private_kb_per_connection": round((after - before) / args.connections, 2)}
+    if opened_in > window:
+        result["python_heap_error"] = f"connecting took {opened_in:.1f}s, longer than the {window:.1f}s window"
+    elif heap.status_code == 200:
+        report = heap.json()
+        result["python_heap_bytes_per_connection"] = round(report["traced_bytes"] / args.connections)
+        result["top_allocations"] = report["top"][:args.top]
+    else:
+        result["python_heap_error"] = heap.text
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--api-key", default=os.getenv("APP_WS_API_KEY", ""))
+    parser.add_argument("--endpoint", choices=["text", "speech", "mux"], default="text")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before measuring")
+    parser.add_argument("--window", type=float, help="tracemalloc window in seconds, by default from --connections")
+    parser.add_argument("--top", type=int, default=10, help="allocation sites to list")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Stand-in for the LLM backend that replays captured upstream streams.
+
+Point a running chatagent-ws at it (APP_API_HOST/APP_API_PORT) and drive the
+websockets with ws_load.py. Traces are recorded by chatagent-ws itself with
+APP_STREAM_CAPTURE_DIR set; chunks are sent back with the original splits and
+inter-arrival delays divided by --speed (0 sends them back to back).
+
+    python benchmarks/replay_server.py --traces ./captures --port 8002 --speed 4
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import os
+import sys
+
+import uvicorn
+from fastapi import FastAPI, Body
+from fastapi.responses import StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatagent_ws"))
+
+from stream_capture import load_trace, TRACE_FILE_SUFFIX  # noqa: E402
+
+
+class TraceLibrary:
+    def __init__(self, trace_dir: str):
+        self.by_endpoint = {}
+        self.by_message = {}
+        for path in sorted(glob.glob(os.path.join(trace_dir, f"*{TRACE_FILE_SUFFIX}"))):
+            header, events = load_trace(path)
+            # replayed with the content type recorded, so the framing is parsed as it was
+            trace = (header.get("content_type", "text/plain"), events)
+            self.by_endpoint.setdefault(header["endpoint"], []).append(trace)
+            self.by_message[(header["endpoint"], header.get("message"))] = trace
+        if not self.by_endpoint:
+            raise SystemExit(f"No traces found in {trace_dir}")
+        self._cycles = {endpoint: itertools.cycle(traces) for endpoint, traces in self.by_endpoint.items()}
+
+    def pick(self, endpoint: str, message: str):
+        # replay the trace recorded for the same question when there is one, round robin otherwise
+        trace = self.by_message.get((endpoint, message))
+        if trace is None:
+            trace = next(self._cycles[endpoint])
+        return trace
+
+
+def create_app(library: TraceLibrary, speed: float) -> FastAPI:
+    app = FastAPI(title="LLM stream replay server")
+
+    async def replay(events):
+        for delay_ms, chunk in events:
+            if speed > 0:
+                await asyncio.sleep(delay_ms / 1000 / speed)
+            yield chunk
+
+    def replay_response(endpoint: str, message: str):
+        content_type, events = library.pick(endpoint, message)
+        return StreamingResponse(replay(events), media_type=content_type)
+
+    @app.post("/api/chat/streaming")
+    async def chat_streaming(message: str = Body(..., embed=True)):
+        return replay_response("chat", message)
+
+    @app.post("/api/speech/streaming")
+    async def speech_streaming(message: str = Body(..., embed=True)):
+        return replay_response("speech", message)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured LLM streams")
+    parser.add_argument("--traces", required=True, help="directory with *.ndjson.gz traces")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor, 1 = original timing, 0 = no delays")
+    args = parser.parse_args()
+
+    library = TraceLibrary(args.traces)
+    for endpoint, traces in library.by_endpoint.items():
+        print(f"loaded {len(traces)} {endpoint} traces")
+    uvicorn.run(create_app(library, args.speed), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup time: import time of the service modules and warm-up time of each
+component, every measurement in a fresh interpreter so nothing is cached.
+
+    python benchmarks/startup_bench.py --runs 3 --output startup.json
+
+Import times are cumulative (a module includes what it imports). The
+warm-up numbers are what /health/ready reports as checks.warm_up.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatagent_ws")
+
+MODULES = ["app_config", "language_util", "tts_provider", "ws_text", "ws_speech", "main"]
+
+IMPORT_SNIPPET = """
+import json, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - started}}))
+"""
+
+# the worker lifespan path: every component concurrently, then the total
+WARM_UP_SNIPPET = """
+import asyncio, json, time
+started = time.perf_counter()
+from readiness import readiness, worker_components
+imported = time.perf_counter()
+asyncio.run(readiness.warm_up(worker_components()))
+print(json.dumps({"import_seconds": imported - started, "ready_seconds": time.perf_counter() - started,
+                  "components": readiness.components}))
+"""
+
+
+def run_snippet(snippet: str) -> dict:
+    env = {**os.environ, "APP_LOG_FILE_ENABLED": ""}
+    result = subprocess.run([sys.executable, "-c", snippet], cwd=SERVICE_DIR, env=env, capture_output=True,
+                            text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    imports = {module: [] for module in MODULES}
+    warm_ups = []
+    for _ in range(args.runs):
+        for module in MODULES:
+            imports[module].append(run_snippet(IMPORT_SNIPPET.format(module=module))["seconds"])
+        warm_ups.append(run_snippet(WARM_UP_SNIPPET))
+
+    components = {}
+    for name in warm_ups[0]["components"]:
+        samples = [run["components"][name].get("seconds", 0) for run in warm_ups]
+        components[name] = {"median_seconds": round(statistics.median(samples), 3),
+                            "ready": all(run["components"][name]["ready"] for run in warm_ups)}
+    results = {
+        "runs": args.runs,
+        "import_seconds": {module: round(statistics.median(samples), 3) for module, samples in imports.items()},
+        "warm_up_import_seconds": round(statistics.median(run["import_seconds"] for run in warm_ups), 3),
+        "time_to_ready_seconds": round(statistics.median(run["ready_seconds"] for run in warm_ups), 3),
+        "components": components,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import pytest
+
+from bench_util import BENCH_LANGUAGES
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("spacy")
+pytest.importorskip("lingua")
+
+from language_util import detect_language_name, detect_language_code_and_voice_name  # noqa: E402
+
+
+def _first_sentence(answer: str) -> str:
+    body = answer.split("\n", 1)[1]
+    for end in (". ", "! ", "？", "！", "。", "? "):
+        index = body.find(end)
+        if index > 0:
+            return body[:index + len(end)]
+    return body
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_fallback_detection_first_sentence(benchmark, llm_answers, lang_name):
+    benchmark.group = "detect_language_name (low accuracy, bounded prefix)"
+    sentence = _first_sentence(llm_answers[lang_name])
+    detected = benchmark(detect_language_name, sentence)
+    benchmark.extra_info["detected"] = detected
+    benchmark.extra_info["chars"] = len(sentence)
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_high_accuracy_detection_whole_answer(benchmark, llm_answers, lang_name):
+    # reference point: what per-chunk detection over the whole buffer would cost
+    benchmark.group = "detect_language_code_and_voice_name (high accuracy, whole answer)"
+    body = llm_answers[lang_name].split("\n", 1)[1]
+    benchmark(detect_language_code_and_voice_name, body)
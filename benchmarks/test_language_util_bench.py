@@ -0,0 +1,79 @@
+import pytest
+
+from bench_util import BENCH_LANGUAGES, split_into_llm_chunks
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("spacy")
+pytest.importorskip("lingua")
+
+from language_util import (  # noqa: E402
+    spacy_tokenize_text,
+    extract_language_name_from_llm_text,
+    get_voice_code_name_by_language_name,
+    fix_markdown_list_spacing,
+    fix_markdown_list_whitespace,
+)
+
+
+def _answer_body(answer: str) -> str:
+    # ws_speech strips the language tag and newlines before tokenizing
+    return answer.split("\n", 1)[1].replace("\n", "")
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_spacy_tokenize_text(benchmark, llm_answers, lang_name):
+    benchmark.group = "spacy_tokenize_text"
+    body = _answer_body(llm_answers[lang_name])
+    # ws_speech tokenizes the pending buffer, which rarely grows past two sentences
+    buffer = body[:160]
+    sentences = benchmark(spacy_tokenize_text, buffer, lang_name)
+    assert sentences
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_extract_language_name_per_turn(benchmark, llm_answers, lang_name):
+    benchmark.group = "extract_language_name_from_llm_text"
+    chunks = split_into_llm_chunks(llm_answers[lang_name])
+    benchmark.extra_info["chunks"] = len(chunks)
+
+    def run_turn():
+        buffer = ""
+        found = None
+        for chunk in chunks:
+            buffer += chunk
+            found = extract_language_name_from_llm_text(buffer)
+        return found
+
+    assert benchmark(run_turn) is not None
+
+
+def test_get_voice_code_name_by_language_name(benchmark):
+    benchmark.group = "get_voice_code_name_by_language_name"
+    names = BENCH_LANGUAGES + ["RUSSIAN", None, "KLINGON"]
+
+    def run_all():
+        return [get_voice_code_name_by_language_name(name) for name in names]
+
+    assert len(benchmark(run_all)) == len(names)
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_fix_markdown_list_spacing_per_turn(benchmark, llm_answers, lang_name):
+    benchmark.group = "fix_markdown_list_spacing"
+    chunks = split_into_llm_chunks(llm_answers[lang_name])
+
+    def run_turn():
+        return [fix_markdown_list_spacing(chunk) for chunk in chunks]
+
+    assert len(benchmark(run_turn)) == len(chunks)
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_fix_markdown_list_whitespace_per_turn(benchmark, llm_answers, lang_name):
+    benchmark.group = "fix_markdown_list_whitespace"
+    chunks = split_into_llm_chunks(llm_answers[lang_name])
+
+    def run_turn():
+        return [fix_markdown_list_whitespace(chunk) for chunk in chunks]
+
+    assert len(benchmark(run_turn)) == len(chunks)
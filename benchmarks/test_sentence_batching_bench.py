@@ -0,0 +1,46 @@
+import pytest
+
+from bench_util import BENCH_LANGUAGES
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("spacy")
+
+from language_util import spacy_tokenize_text  # noqa: E402
+from sentence_batcher import SentenceBatcher  # noqa: E402
+
+# rough Google TTS cost model: fixed per-request overhead plus time per character
+TTS_REQUEST_OVERHEAD_SECONDS = 0.15
+TTS_SECONDS_PER_CHAR = 0.002
+
+
+def _answer_sentences(answer: str, lang_name: str):
+    # ws_speech strips the language tag and newlines before tokenizing
+    body = answer.split("\n", 1)[1].replace("\n", "")
+    return [sentence for sentence in spacy_tokenize_text(body, lang_name) if sentence.strip()]
+
+
+def _synthesis_seconds(requests):
+    return sum(TTS_REQUEST_OVERHEAD_SECONDS + TTS_SECONDS_PER_CHAR * len(text) for text in requests)
+
+
+@pytest.mark.parametrize("lang_name", BENCH_LANGUAGES)
+def test_sentence_batching(benchmark, llm_answers, lang_name):
+    benchmark.group = "sentence_batching"
+    sentences = _answer_sentences(llm_answers[lang_name], lang_name)
+
+    def batch_answer():
+        batcher = SentenceBatcher()
+        requests = []
+        for sentence in sentences:
+            requests.extend(batcher.add(sentence))
+        batch = batcher.flush()
+        if batch:
+            requests.append(batch)
+        return requests
+
+    requests = benchmark(batch_answer)
+    benchmark.extra_info["tts_calls_unbatched"] = len(sentences)
+    benchmark.extra_info["tts_calls_batched"] = len(requests)
+    benchmark.extra_info["synthesis_seconds_unbatched"] = round(_synthesis_seconds(sentences), 3)
+    benchmark.extra_info["synthesis_seconds_batched"] = round(_synthesis_seconds(requests), 3)
+    assert len(requests) <= len(sentences)
@@ -0,0 +1,101 @@
+"""
+Session token issuance throughput: one token per /api/get_session_token
+call against --batch tokens per /api/get_session_tokens call, both with
+--concurrency requests in flight, against a running chatagent-ws:
+
+    python benchmarks/token_issuance.py --tokens 20000 --batch 100 --concurrency 32 \
+        --api-key $APP_WS_API_KEY --output tokens.json
+
+Reports tokens per second, requests per second and request latency
+percentiles for each mode. The issued tokens expire on their own
+(APP_SECURITY_TOKEN_EXPIRY_SECONDS).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import httpx
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def issue(http: httpx.AsyncClient, api_key: str, batch: int) -> int:
+    headers = {"x-api-key": api_key}
+    if batch == 1:
+        response = await http.post("/api/get_session_token", headers=headers)
+        response.raise_for_status()
+        return 1 if response.json().get("session_token") else 0
+    response = await http.post("/api/get_session_tokens", headers=headers, json={"count": batch})
+    response.raise_for_status()
+    return len(response.json()["session_tokens"])
+
+
+async def run_mode(url: str, api_key: str, tokens: int, batch: int, concurrency: int) -> dict:
+    requests = -(-tokens // batch)
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(batch)
+    latencies = []
+    issued = 0
+
+    async def worker(http: httpx.AsyncClient):
+        nonlocal issued
+        while not queue.empty():
+            size = queue.get_nowait()
+            started = time.perf_counter()
+            count = await issue(http, api_key, size)
+            latencies.append(time.perf_counter() - started)
+            issued += count
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as http:
+        # one warm-up request, so connection set-up is not in the numbers
+        await issue(http, api_key, batch)
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(http) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+    return {
+        "batch": batch,
+        "requests": requests,
+        "tokens": issued,
+        "seconds": round(elapsed, 3),
+        "tokens_per_second": round(issued / elapsed, 1),
+        "requests_per_second": round(requests / elapsed, 1),
+        "latency_ms": {"p50": round(statistics.median(latencies) * 1000, 2),
+                       "p95": round(percentile(latencies, 95) * 1000, 2),
+                       "p99": round(percentile(latencies, 99) * 1000, 2)},
+    }
+
+
+async def run(args) -> dict:
+    single = await run_mode(args.url, args.api_key, args.tokens, 1, args.concurrency)
+    bulk = await run_mode(args.url, args.api_key, args.tokens, args.batch, args.concurrency)
+    return {"concurrency": args.concurrency, "single": single, "bulk": bulk,
+            "speedup": round(bulk["tokens_per_second"] / single["tokens_per_second"], 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--api-key", default=os.getenv("APP_WS_API_KEY", ""))
+    parser.add_argument("--tokens", type=int, default=5000, help="tokens to issue in each mode")
+    parser.add_argument("--batch", type=int, default=100, help="tokens per bulk request")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Memory per gunicorn worker and idle connections per core.
+
+Reads /proc/<pid>/smaps_rollup of the gunicorn master and every worker,
+which shows how much of the preloaded spaCy/lingua memory is shared
+copy-on-write (Pss well below Rss), then opens --connections idle
+websockets and measures the growth again. With --rss-limit-mb, the memory a
+worker may use, connections_per_core is how many idle connections a worker
+(one per core) holds within that limit, from its measured Rss and the
+measured memory per connection. Linux only.
+
+    python benchmarks/worker_rss.py --master-pid $(pgrep -o -f gunicorn) \
+        --api-key $APP_WS_API_KEY --connections 2000 --rss-limit-mb 1024
+"""
+import argparse
+import asyncio
+import json
+import os
+
+import httpx
+import websockets
+
+SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+
+
+def read_smaps_rollup(pid: int) -> dict:
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0].rstrip(":") in SMAPS_FIELDS:
+                values[parts[0].rstrip(":")] = int(parts[1])  # kB
+    return values
+
+
+def child_pids(pid: int) -> list[int]:
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    return sorted(children)
+
+
+def snapshot(master_pid: int) -> dict:
+    workers = {pid: read_smaps_rollup(pid) for pid in child_pids(master_pid)}
+    return {"master": read_smaps_rollup(master_pid), "workers": workers}
+
+
+def summarize(snap: dict) -> dict:
+    workers = snap["workers"]
+    if not workers:
+        return {"workers": 0}
+    count = len(workers)
+    return {
+        "workers": count,
+        "rss_per_worker_mb": round(sum(w["Rss"] for w in workers.values()) / count / 1024, 1),
+        "pss_per_worker_mb": round(sum(w["Pss"] for w in workers.values()) / count / 1024, 1),
+        "private_per_worker_mb": round(
+            sum(w["Private_Clean"] + w["Private_Dirty"] for w in workers.values()) / count / 1024, 1),
+        "total_pss_mb": round((snap["master"]["Pss"] + sum(w["Pss"] for w in workers.values())) / 1024, 1),
+    }
+
+
+async def open_idle_connections(url: str, api_key: str, count: int):
+    ws_url = url.replace("http://", "ws://").replace("https://", "wss://")
+    connections = []
+    async with httpx.AsyncClient(base_url=url) as http:
+        for _ in range(count):
+            response = await http.post("/api/get_session_token", headers={"x-api-key": api_key})
+            response.raise_for_status()
+            token = response.json()["session_token"]
+            connections.append(await websockets.connect(f"{ws_url}/text-ws?session_token={token}"))
+    return connections
+
+
+async def run(args):
+    before = snapshot(args.master_pid)
+    result = {"idle": summarize(before)}
+    if args.connections:
+        connections = await open_idle_connections(args.url, args.api_key, args.connections)
+        await asyncio.sleep(args.settle)
+        after = snapshot(args.master_pid)
+        result["connected"] = summarize(after)
+        private_before = sum(w["Private_Clean"] + w["Private_Dirty"] for w in before["workers"].values())
+        private_after = sum(w["Private_Clean"] + w["Private_Dirty"] for w in after["workers"].values())
+        # the ones the server kept open, not the ones asked for
+        held = sum(ws.close_code is None for ws in connections)
+        result["connections_held"] = held
+        kb_per_connection = (private_after - private_before) / held if held else 0
+        result["kb_per_connection"] = round(kb_per_connection, 2)
+        if args.rss_limit_mb and kb_per_connection > 0 and before["workers"]:
+            rss_kb = max(w["Rss"] for w in before["workers"].values())
+            result["connections_per_core"] = max(0, int((args.rss_limit_mb * 1024 - rss_kb) / kb_per_connection))
+        await asyncio.gather(*[ws.close() for ws in connections], return_exceptions=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RSS per gunicorn worker and per idle connection")
+    parser.add_argument("--master-pid", type=int, required=True)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--api-key", default=os.getenv("APP_WS_API_KEY", ""))
+    parser.add_argument("--connections", type=int, default=0, help="idle websockets to open, 0 only measures")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before measuring again")
+    parser.add_argument("--rss-limit-mb", type=float, default=0,
+                        help="memory a worker may use, for connections_per_core")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Websocket load harness for /text-ws and /speech-ws.
+
+Opens --connections concurrent sessions against a running chatagent-ws and
+sends --turns questions on each, then prints latency percentiles and
+throughput. Run it with the backend pointed at replay_server.py so the
+pipelines see real traffic shapes:
+
+    python benchmarks/ws_load.py --endpoint speech --connections 50 --turns 5 \
+        --api-key $APP_WS_API_KEY --traces ./captures
+
+The server's event loop lag histogram is scraped from /metrics before and
+after the run, so each result carries the lag the load caused. To compare
+loop implementations, run the same load once per APP_WS_LOOP/APP_WS_HTTP
+setting (one worker, so every scrape hits the same process) with --label
+and --output, then:
+
+    python benchmarks/ws_load.py --compare results.jsonl
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatagent_ws"))
+
+from stream_capture import load_trace, TRACE_FILE_SUFFIX  # noqa: E402
+
+DEFAULT_MESSAGES = ["What are your store hours?"]
+LAG_METRIC = "chatagent_event_loop_lag_seconds"
+METRIC_LINE = re.compile(r'^(\w+)\{([^}]*)\} (\S+)$')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_messages(trace_dir, endpoint):
+    trace_endpoint = "chat" if endpoint == "text" else "speech"
+    messages = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, f"*{TRACE_FILE_SUFFIX}"))):
+        header, _ = load_trace(path)
+        if header["endpoint"] == trace_endpoint and header.get("message"):
+            messages.append(header["message"])
+    return messages or DEFAULT_MESSAGES
+
+
+class LoadStats:
+    def __init__(self):
+        self.first_chunk = []
+        self.first_audio = []
+        self.turn = []
+        self.errors = 0
+        self.audio_bytes = 0
+
+    def summary(self, elapsed):
+        result = {"turns": len(self.turn), "errors": self.errors, "elapsed_s": round(elapsed, 3),
+                  "turns_per_s": round(len(self.turn) / elapsed, 2) if elapsed else 0.0,
+                  "audio_bytes": self.audio_bytes}
+        for name, values in (("first_chunk_ms", self.first_chunk), ("first_audio_ms", self.first_audio),
+                             ("turn_ms", self.turn)):
+            if values:
+                result[name] = {"p50": round(percentile(values, 50), 1), "p90": round(percentile(values, 90), 1),
+                                "p99": round(percentile(values, 99), 1), "max": round(max(values), 1)}
+        return result
+
+
+def parse_loop_metrics(text):
+    """
+    Lag buckets, sum and count summed over the workers in a /metrics page,
+    plus the stall count and loop implementation.
+    """
+    metrics = {"buckets": defaultdict(float), "sum": 0.0, "count": 0.0, "stalls": 0.0, "loop": ""}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        name, value = match.group(1), float(match.group(3))
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+        if name == f"{LAG_METRIC}_bucket":
+            metrics["buckets"][float(labels["le"])] += value
+        elif name == f"{LAG_METRIC}_sum":
+            metrics["sum"] += value
+        elif name == f"{LAG_METRIC}_count":
+            metrics["count"] += value
+        elif name == "chatagent_event_loop_stalls_total":
+            metrics["stalls"] += value
+        elif name == "chatagent_event_loop_info":
+            metrics["loop"] = labels.get("loop", "")
+    return metrics
+
+
+def lag_summary(before, after):
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {}
+    bounds = sorted(after["buckets"])
+    deltas = [after["buckets"][b] - before["buckets"].get(b, 0.0) for b in bounds]
+
+    def quantile(q):
+        # upper bound of the bucket holding the quantile in ms, as precise as the buckets get; None above the last
+        for bound, cumulative in zip(bounds, deltas):
+            if cumulative >= q * count:
+                return bound * 1000 if bound != float("inf") else None
+        return None
+
+    return {"loop": after["loop"], "samples": int(count),
+            "mean_ms": round((after["sum"] - before["sum"]) / count * 1000, 2),
+            "p50_ms_le": quantile(0.5), "p99_ms_le": quantile(0.99),
+            "stalls": int(after["stalls"] - before["stalls"])}
+
+
+async def scrape_loop_metrics(base_url):
+    try:
+        async with httpx.AsyncClient(base_url=base_url) as http:
+            response = await http.get("/metrics")
+            response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"metrics not available: {e}", file=sys.stderr)
+        return None
+    return parse_loop_metrics(response.text)
+
+
+async def get_session_token(http: httpx.AsyncClient, api_key: str) -> str:
+    response = await http.post("/api/get_session_token", headers={"x-api-key": api_key})
+    response.raise_for_status()
+    return response.json()["session_token"]
+
+
+async def run_session(base_url, ws_base_url, endpoint, api_key, messages, turns, offset, stats):
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        token = await get_session_token(http, api_key)
+    async with websockets.connect(f"{ws_base_url}/{endpoint}-ws?session_token={token}", max_size=None) as ws:
+        for i in range(turns):
+            text = messages[(offset + i) % len(messages)]
+            start = time.perf_counter()
+            first_chunk = first_audio = None
+            await ws.send(json.dumps({"type": "userInput", "text": text, "session_token": token}))
+            while True:
+                frame = await ws.recv()
+                now = (time.perf_counter() - start) * 1000
+                if isinstance(frame, bytes):
+                    stats.audio_bytes += len(frame)
+                    if first_audio is None:
+                        first_audio = now
+                    continue
+                data = json.loads(frame)
+                if data.get("type") == "response_chunk" and first_chunk is None:
+                    first_chunk = now
+                elif data.get("type") == "response_end":
+                    stats.turn.append(now)
+                    break
+                elif data.get("type") == "stream_error":
+                    stats.errors += 1
+                    break
+            if first_chunk is not None:
+                stats.first_chunk.append(first_chunk)
+            if first_audio is not None:
+                stats.first_audio.append(first_audio)
+
+
+async def run_load(args):
+    messages = load_messages(args.traces, args.endpoint) if args.traces else DEFAULT_MESSAGES
+    ws_base_url = args.url.replace("http://", "ws://").replace("https://", "wss://")
+    stats = LoadStats()
+    before = await scrape_loop_metrics(args.url)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[run_session(args.url, ws_base_url, args.endpoint, args.api_key, messages, args.turns, i, stats)
+          for i in range(args.connections)],
+        return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    stats.errors += sum(1 for r in results if isinstance(r, Exception))
+    summary = stats.summary(elapsed)
+    after = await scrape_loop_metrics(args.url)
+    if before is not None and after is not None:
+        summary["loop_lag"] = lag_summary(before, after)
+    return summary
+
+
+def compare(path):
+    """
+    Prints one row per label of a results file: median throughput, turn
+    latency and loop lag over the runs with that label.
+    """
+    runs = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                runs[result.get("label") or "-"].append(result)
+    print(f"{'label':<24}{'runs':>5}{'turns/s':>10}{'turn p50':>10}{'turn p99':>10}{'lag mean':>10}"
+          f"{'lag p99<=':>10}{'stalls':>8}")
+    for label, results in runs.items():
+        def median(values):
+            values = sorted(v for v in values if v is not None)
+            return values[len(values) // 2] if values else float("nan")
+
+        lags = [r.get("loop_lag") or {} for r in results]
+        print(f"{label:<24}{len(results):>5}{median(r['turns_per_s'] for r in results):>10.2f}"
+              f"{median(r.get('turn_ms', {}).get('p50') for r in results):>10.1f}"
+              f"{median(r.get('turn_ms', {}).get('p99') for r in results):>10.1f}"
+              f"{median(lag.get('mean_ms') for lag in lags):>10.2f}"
+              f"{median(lag.get('p99_ms_le') for lag in lags):>10.1f}"
+              f"{sum(lag.get('stalls', 0) for lag in lags):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chatagent-ws websocket load harness")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--api-key", default=os.getenv("APP_WS_API_KEY", ""))
+    parser.add_argument("--endpoint", choices=["text", "speech"], default="text")
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--traces", help="directory with captured traces, their questions are sent")
+    parser.add_argument("--label", default="", help="label stored with the result, e.g. the loop implementation")
+    parser.add_argument("--output", help="append the JSON summary to this file")
+    parser.add_argument("--compare", metavar="RESULTS", help="print a per label comparison of a results file")
+    args = parser.parse_args()
+    if args.compare:
+        compare(args.compare)
+        return
+
+    summary = asyncio.run(run_load(args))
+    summary = {"label": args.label, "endpoint": args.endpoint, "connections": args.connections, **summary}
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import re
+import time
+from typing import Optional
+
+import redis.asyncio as redis
+
+from app_config import APP_ANSWER_CACHE_ENABLED, APP_ANSWER_CACHE_TTL_SECONDS, APP_ANSWER_CACHE_MAX_BYTES, \
+    APP_ANSWER_CACHE_MAX_ENTRY_BYTES, APP_ANSWER_CACHE_CONTEXT
+from logging_util import get_logger
+from metrics_util import Counter
+from session_manager import session_redis_binary_client
+from usage_meter import usage_meter, TTS_CHARS, AUDIO_BYTES
+
+logger = get_logger("answer_cache")
+
+answer_cache_counter = Counter("chatagent_answer_cache_total", "Answer cache lookups and stores, by result",
+                               ("endpoint", "result"))
+
+FRAME_JSON = b"j"
+FRAME_BYTES = b"b"
+
+LRU_KEY = "answer/cache-lru"
+SIZES_KEY = "answer/cache-sizes"
+TOTAL_BYTES_KEY = "answer/cache-bytes"
+
+_whitespace_pattern = re.compile(r"\s+")
+_trailing_punctuation = " \t\n.?!。？！…"
+
+
+def normalize_question(text: str) -> str:
+    # "Store hours?" and "  store   HOURS " are the same question
+    return _whitespace_pattern.sub(" ", text.casefold()).strip(_trailing_punctuation)
+
+
+def is_cacheable_response(headers) -> bool:
+    """
+    The backend opts an answer out of the cache with Cache-Control: no-store
+    (or private), e.g. for anything personalized or time sensitive.
+    """
+    cache_control = (headers or {}).get("cache-control", "").lower()
+    return "no-store" not in cache_control and "private" not in cache_control
+
+
+class AnswerRecorder:
+    """
+    Stands in for the response stream during a turn and keeps a copy of every
+    frame, without sequence numbers, for storing the answer afterwards.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.frames = []
+        self.size = 0
+        self.cacheable = True
+        self.last_frame_type = None
+
+    def _add(self, kind: bytes, data: bytes):
+        if not self.cacheable:
+            return
+        self.size += len(data) + 1
+        if self.size > APP_ANSWER_CACHE_MAX_ENTRY_BYTES:
+            self.mark_uncacheable()
+            return
+        self.frames.append(kind + data)
+
+    async def send_json(self, data: dict):
+        self.last_frame_type = data.get("type")
+        self._add(FRAME_JSON, json.dumps(data).encode("utf-8"))
+        await self.stream.send_json(data)
+
+    async def send_bytes(self, data: bytes):
+        self._add(FRAME_BYTES, data)
+        await self.stream.send_bytes(data)
+
+    def mark_uncacheable(self):
+        self.cacheable = False
+        self.frames = []
+
+    @property
+    def completed(self) -> bool:
+        return self.last_frame_type == "response_end"
+
+
+def mark_uncacheable(stream):
+    """
+    Keeps a degraded answer, e.g. a sentence that went out without audio, out
+    of the cache, so it is not replayed to everyone asking the same question.
+    """
+    if isinstance(stream, AnswerRecorder):
+        stream.mark_uncacheable()
+
+
+class AnswerCache:
+    """
+    Opt-in cache of whole answers (text chunks and audio) for repeated
+    questions, keyed on the normalized question, the endpoint and
+    APP_ANSWER_CACHE_CONTEXT (bump it when the backend's knowledge changes).
+
+    Each answer is a redis list of frames with a TTL. Total size is bounded by
+    APP_ANSWER_CACHE_MAX_BYTES: a sorted set of last access times and a hash
+    of entry sizes let any worker evict the least recently used answers.
+    """
+
+    def __init__(self, redis_client: redis.Redis = session_redis_binary_client,
+                 enabled: bool = APP_ANSWER_CACHE_ENABLED):
+        self.redis_client = redis_client
+        self.enabled = enabled
+
+    @staticmethod
+    def entry_id(endpoint: str, question: str) -> str:
+        raw = f"{endpoint}\0{APP_ANSWER_CACHE_CONTEXT}\0{normalize_question(question)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _key(entry_id: str) -> str:
+        return f"answer/cache:{entry_id}"
+
+    async def get(self, endpoint: str, question: str) -> Optional[list[bytes]]:
+        entry_id = self.entry_id(endpoint, question)
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.lrange(self._key(entry_id), 0, -1)
+                pipe.zadd(LRU_KEY, {entry_id: time.time()}, xx=True)
+                frames, _ = await pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Answer cache lookup failed: {e}")
+            return None
+        answer_cache_counter.inc(endpoint=endpoint, result="hit" if frames else "miss")
+        return frames or None
+
+    async def replay(self, frames: list[bytes], stream, session_id: Optional[str] = None):
+        """
+        Sends a cached answer. Its audio is metered like live audio, and a
+        session over its TTS quota gets the text only, as it would live: the
+        audio and audio_metadata frames are dropped, the text of a
+        response_chunk is counted when its audio went out.
+        """
+        spoken = False
+        for frame in frames:
+            if frame[:1] == FRAME_BYTES:
+                audio_data = frame[1:]
+                spoken = not (session_id and usage_meter.exceeded(session_id, (TTS_CHARS, AUDIO_BYTES)))
+                if spoken:
+                    if session_id:
+                        usage_meter.record(session_id, audio_bytes=len(audio_data))
+                    await stream.send_bytes(audio_data)
+                continue
+            data = json.loads(frame[1:])
+            frame_type = data.get("type")
+            if frame_type == "audio_metadata" and not spoken:
+                continue
+            if frame_type == "response_chunk" and spoken:
+                if session_id:
+                    usage_meter.record(session_id, tts_chars=len(data.get("text", "")))
+                spoken = False
+            await stream.send_json(data)
+
+    async def put(self, endpoint: str, question: str, recorder: AnswerRecorder):
+        if not recorder.cacheable or not recorder.completed:
+            answer_cache_counter.inc(endpoint=endpoint, result="skipped")
+            return
+        entry_id = self.entry_id(endpoint, question)
+        key = self._key(entry_id)
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.rpush(key, *recorder.frames)
+                pipe.expire(key, APP_ANSWER_CACHE_TTL_SECONDS)
+                pipe.zadd(LRU_KEY, {entry_id: time.time()})
+                pipe.hget(SIZES_KEY, entry_id)
+                pipe.hset(SIZES_KEY, entry_id, recorder.size)
+                pipe.incrby(TOTAL_BYTES_KEY, recorder.size)
+                results = await pipe.execute()
+            previous_size = int(results[4] or 0)
+            total = results[6]
+            if previous_size:
+                total = await self.redis_client.decrby(TOTAL_BYTES_KEY, previous_size)
+            answer_cache_counter.inc(endpoint=endpoint, result="stored")
+            if total > APP_ANSWER_CACHE_MAX_BYTES:
+                await self._evict(total)
+        except redis.RedisError as e:
+            logger.error(f"Answer cache store failed: {e}")
+
+    async def _evict(self, total: int):
+        while total > APP_ANSWER_CACHE_MAX_BYTES:
+            oldest = await self.redis_client.zpopmin(LRU_KEY, 16)
+            if not oldest:
+                break
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for entry_id, _ in oldest:
+                    entry_id = entry_id.decode("utf-8")
+                    pipe.delete(self._key(entry_id))
+                    pipe.hget(SIZES_KEY, entry_id)
+                    pipe.hdel(SIZES_KEY, entry_id)
+                results = await pipe.execute()
+            freed = sum(int(size or 0) for size in results[1::3])
+            total = await self.redis_client.decrby(TOTAL_BYTES_KEY, freed)
+            answer_cache_counter.inc(len(oldest), endpoint="", result="evicted")
+
+
+answer_cache = AnswerCache()
+
+
+async def answer_with_cache(endpoint: str, question: str, stream, produce, session_id: Optional[str] = None):
+    """
+    Answers from the cache when possible, otherwise runs
+    produce(stream, response_info) and stores the answer if it completed and
+    the backend response (its headers go in response_info) allows caching.
+    A replayed answer's audio is counted as usage of session_id.
+    """
+    if not answer_cache.enabled:
+        await produce(stream, {})
+        return
+    frames = await answer_cache.get(endpoint, question)
+    if frames:
+        await answer_cache.replay(frames, stream, session_id)
+        return
+    recorder = AnswerRecorder(stream)
+    response_info = {}
+    await produce(recorder, response_info)
+    if is_cacheable_response(response_info.get("headers")):
+        await answer_cache.put(endpoint, question, recorder)
+    else:
+        answer_cache_counter.inc(endpoint=endpoint, result="skipped")
@@ -25,17 +25,146 @@ APP_LOG_LEVEL = os.getenv("APP_LOG_LEVEL", "DEBUG")
 APP_LOG_FILE_PATH = os.getenv("APP_LOG_FILE_PATH", "./logs")
 APP_LOG_FILE_ENABLED = bool(os.getenv("APP_LOG_FILE_ENABLED", True))
 
+# more than one worker runs the app under gunicorn with preloaded models
+APP_WS_WORKERS = int(os.getenv("APP_WS_WORKERS", 1 if APP_ENV == "dev" else 2))
+APP_WS_WORKER_TIMEOUT_SECONDS = int(os.getenv("APP_WS_WORKER_TIMEOUT_SECONDS", 60))
+APP_WS_GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("APP_WS_GRACEFUL_TIMEOUT_SECONDS", 30))
+# drain on shutdown, keep the deadline below the graceful timeout so gunicorn doesn't kill the drain
+APP_DRAIN_TIMEOUT_SECONDS = float(os.getenv("APP_DRAIN_TIMEOUT_SECONDS", 20))
+APP_DRAIN_RECONNECT_DELAY_MS = int(os.getenv("APP_DRAIN_RECONNECT_DELAY_MS", 1000))
+
+# uvicorn event loop (auto, asyncio, uvloop) and HTTP parser (auto, h11, httptools); auto picks
+# uvloop and httptools when they are installed (pip install chatagent-ws[speedups])
+APP_WS_LOOP = os.getenv("APP_WS_LOOP", "auto")
+APP_WS_HTTP = os.getenv("APP_WS_HTTP", "auto")
+# event loop lag sampler, a stall above the threshold logs the stack of the code blocking the loop
+APP_LOOP_MONITOR_ENABLED = os.getenv("APP_LOOP_MONITOR_ENABLED", "true").lower() == "true"
+APP_LOOP_MONITOR_INTERVAL_MS = int(os.getenv("APP_LOOP_MONITOR_INTERVAL_MS", 100))
+APP_LOOP_STALL_THRESHOLD_MS = int(os.getenv("APP_LOOP_STALL_THRESHOLD_MS", 250))
+# on-demand profiles through /api/profile, nothing runs between requests
+APP_PROFILE_MAX_SECONDS = float(os.getenv("APP_PROFILE_MAX_SECONDS", 60))
+APP_PROFILE_INTERVAL_MS = int(os.getenv("APP_PROFILE_INTERVAL_MS", 10))
+APP_PROFILE_MEMORY_TOP = int(os.getenv("APP_PROFILE_MEMORY_TOP", 30))
+APP_PROFILE_MEMORY_FRAMES = int(os.getenv("APP_PROFILE_MEMORY_FRAMES", 10))
+
 # web socket security
 APP_CONNECTION_MAX_SESSIONS_PER_IP = int(os.getenv("APP_CONNECTION_MAX_SESSIONS_PER_IP", 20))
 APP_CONNECTION_MAX_REQUESTS_PER_MINUTE = int(os.getenv("APP_CONNECTION_MAX_REQUESTS_PER_MINUTE", 30))
 APP_SECURITY_TOKEN_EXPIRY_SECONDS = int(os.getenv("APP_SECURITY_TOKEN_EXPIRY_SECONDS", 900))
+# most tokens one /api/get_session_tokens call may issue
+APP_SECURITY_TOKEN_BULK_MAX = int(os.getenv("APP_SECURITY_TOKEN_BULK_MAX", 1000))
 
 APP_REDIS_HOST = os.getenv("APP_REDIS_HOST", "localhost")
 APP_REDIS_PORT = int(os.getenv("APP_REDIS_PORT", 6379))
 APP_REDIS_DB = int(os.getenv("APP_REDIS_DB", 0))
 APP_REDIS_PASSWORD = os.getenv("APP_REDIS_PASSWORD", None)
 
+# cross-node connection registry, node id defaults to the host name
+APP_NODE_ID = os.getenv("APP_NODE_ID", "")
+APP_REGISTRY_HEARTBEAT_SECONDS = float(os.getenv("APP_REGISTRY_HEARTBEAT_SECONDS", 15))
+APP_REGISTRY_FLUSH_SECONDS = float(os.getenv("APP_REGISTRY_FLUSH_SECONDS", 1))
+
+# resumable answers: per session replay buffer of numbered outbound frames in a redis stream
+APP_REPLAY_ENABLED = os.getenv("APP_REPLAY_ENABLED", "false").lower() == "true"
+APP_REPLAY_TTL_SECONDS = int(os.getenv("APP_REPLAY_TTL_SECONDS", 120))
+APP_REPLAY_MAX_FRAMES = int(os.getenv("APP_REPLAY_MAX_FRAMES", 500))
+APP_REPLAY_WAIT_SECONDS = float(os.getenv("APP_REPLAY_WAIT_SECONDS", 60))
+
+# opt-in cache of whole answers for repeated questions, APP_ANSWER_CACHE_CONTEXT is part of the key
+APP_ANSWER_CACHE_ENABLED = os.getenv("APP_ANSWER_CACHE_ENABLED", "false").lower() == "true"
+APP_ANSWER_CACHE_TTL_SECONDS = int(os.getenv("APP_ANSWER_CACHE_TTL_SECONDS", 3600))
+APP_ANSWER_CACHE_MAX_BYTES = int(os.getenv("APP_ANSWER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+APP_ANSWER_CACHE_MAX_ENTRY_BYTES = int(os.getenv("APP_ANSWER_CACHE_MAX_ENTRY_BYTES", 2 * 1024 * 1024))
+APP_ANSWER_CACHE_CONTEXT = os.getenv("APP_ANSWER_CACHE_CONTEXT", "v1")
+
+# adaptive concurrency limit per backend streaming endpoint, with a bounded wait queue
+APP_BACKEND_LIMIT_INITIAL = int(os.getenv("APP_BACKEND_LIMIT_INITIAL", 20))
+APP_BACKEND_LIMIT_MIN = int(os.getenv("APP_BACKEND_LIMIT_MIN", 2))
+APP_BACKEND_LIMIT_MAX = int(os.getenv("APP_BACKEND_LIMIT_MAX", 200))
+APP_BACKEND_LATENCY_TOLERANCE = float(os.getenv("APP_BACKEND_LATENCY_TOLERANCE", 2.0))
+APP_BACKEND_QUEUE_SIZE = int(os.getenv("APP_BACKEND_QUEUE_SIZE", 50))
+APP_BACKEND_QUEUE_WAIT_SECONDS = float(os.getenv("APP_BACKEND_QUEUE_WAIT_SECONDS", 5))
+
+# circuit breaker over the last APP_BREAKER_WINDOW backend calls
+APP_BREAKER_WINDOW = int(os.getenv("APP_BREAKER_WINDOW", 50))
+APP_BREAKER_MIN_CALLS = int(os.getenv("APP_BREAKER_MIN_CALLS", 10))
+APP_BREAKER_ERROR_RATE = float(os.getenv("APP_BREAKER_ERROR_RATE", 0.5))
+APP_BREAKER_SLOW_SECONDS = float(os.getenv("APP_BREAKER_SLOW_SECONDS", 10))
+APP_BREAKER_SLOW_RATE = float(os.getenv("APP_BREAKER_SLOW_RATE", 0.5))
+APP_BREAKER_OPEN_SECONDS = float(os.getenv("APP_BREAKER_OPEN_SECONDS", 15))
+
+# per worker admission control for TTS synthesis (token bucket), keep the sum over workers under the quota
+APP_TTS_RATE_PER_SECOND = float(os.getenv("APP_TTS_RATE_PER_SECOND", 10))
+APP_TTS_BURST = int(os.getenv("APP_TTS_BURST", 10))
+APP_TTS_QUEUE_SIZE = int(os.getenv("APP_TTS_QUEUE_SIZE", 100))
+APP_TTS_QUEUE_WAIT_SECONDS = float(os.getenv("APP_TTS_QUEUE_WAIT_SECONDS", 2))
+
+# opt-in hedging: a duplicate synthesis request when the first is slower than the voice's percentile
+APP_TTS_HEDGE_ENABLED = os.getenv("APP_TTS_HEDGE_ENABLED", "false").lower() == "true"
+APP_TTS_HEDGE_PERCENTILE = float(os.getenv("APP_TTS_HEDGE_PERCENTILE", 90))
+APP_TTS_HEDGE_BUDGET = float(os.getenv("APP_TTS_HEDGE_BUDGET", 0.05))
+APP_TTS_HEDGE_MIN_SAMPLES = int(os.getenv("APP_TTS_HEDGE_MIN_SAMPLES", 20))
+
+# merge short sentences into one TTS request: flushed at APP_TTS_BATCH_MIN_CHARS, never above
+# APP_TTS_BATCH_MAX_CHARS, and at the latest APP_TTS_BATCH_MAX_WAIT_MS after the first pending sentence
+APP_TTS_BATCH_MIN_CHARS = int(os.getenv("APP_TTS_BATCH_MIN_CHARS", 80))
+APP_TTS_BATCH_MAX_CHARS = int(os.getenv("APP_TTS_BATCH_MAX_CHARS", 300))
+APP_TTS_BATCH_MAX_WAIT_MS = int(os.getenv("APP_TTS_BATCH_MAX_WAIT_MS", 400))
+
+# speak the first clause of a long opening sentence before the sentence is complete
+APP_TTS_SPECULATIVE_CLAUSE_ENABLED = os.getenv("APP_TTS_SPECULATIVE_CLAUSE_ENABLED", "false").lower() == "true"
+
+# shared on-disk store of synthesized clips (append-only data file + hash index), empty dir disables it
+APP_AUDIO_STORE_DIR = os.getenv("APP_AUDIO_STORE_DIR", "")
+APP_AUDIO_STORE_CAPACITY = int(os.getenv("APP_AUDIO_STORE_CAPACITY", 65536))
+APP_AUDIO_STORE_WRITE_THROUGH = os.getenv("APP_AUDIO_STORE_WRITE_THROUGH", "false").lower() == "true"
+
+# TTS engines: google, local (espeak-ng/piper style command) or fake; routes like "KOREAN:local,RUSSIAN:local"
+APP_TTS_PROVIDER = os.getenv("APP_TTS_PROVIDER", "google")
+APP_TTS_PROVIDER_ROUTES = os.getenv("APP_TTS_PROVIDER_ROUTES", "")
+# texts up to this many characters (short system phrases) go to APP_TTS_SHORT_TEXT_PROVIDER, 0 disables
+APP_TTS_SHORT_TEXT_PROVIDER = os.getenv("APP_TTS_SHORT_TEXT_PROVIDER", "local")
+APP_TTS_SHORT_TEXT_MAX_CHARS = int(os.getenv("APP_TTS_SHORT_TEXT_MAX_CHARS", 0))
+# reads the text on stdin, writes audio to stdout; {voice} and {wpm} are filled in
+APP_TTS_LOCAL_COMMAND = os.getenv("APP_TTS_LOCAL_COMMAND", "espeak-ng --stdin --stdout -v {voice} -s {wpm}")
+APP_TTS_LOCAL_FORMAT = os.getenv("APP_TTS_LOCAL_FORMAT", "wav")
+APP_TTS_LOCAL_TIMEOUT_SECONDS = float(os.getenv("APP_TTS_LOCAL_TIMEOUT_SECONDS", 10))
+
+# readiness: dependency checks are cached this long, so frequent probes don't hammer redis
+APP_HEALTH_CACHE_SECONDS = float(os.getenv("APP_HEALTH_CACHE_SECONDS", 2))
+APP_HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("APP_HEALTH_CHECK_TIMEOUT_SECONDS", 1))
+
 APP_WS_IDLE_TIMEOUT_SECONDS = int(os.getenv("APP_WS_IDLE_TIMEOUT_SECONDS", 600))
+# {"type": "ping"} to every connection this often (0 disables); a client that has answered with
+# {"type": "pong"} before and leaves more than APP_WS_HEARTBEAT_MISSED_PONGS unanswered is closed
+APP_WS_HEARTBEAT_SECONDS = float(os.getenv("APP_WS_HEARTBEAT_SECONDS", 20))
+APP_WS_HEARTBEAT_MISSED_PONGS = int(os.getenv("APP_WS_HEARTBEAT_MISSED_PONGS", 2))
+# a client that never answered a ping is closed after missing the pongs and this long without a message
+APP_WS_SILENT_TIMEOUT_SECONDS = float(os.getenv("APP_WS_SILENT_TIMEOUT_SECONDS", 120))
+# with APP_REPLAY_ENABLED, let the turns of a dead peer finish into the replay buffer instead of cancelling them
+APP_WS_DEAD_PEER_KEEP_TURNS = os.getenv("APP_WS_DEAD_PEER_KEEP_TURNS", "false").lower() == "true"
+
+# /mux-ws: concurrent streams per connection, and frames a stream may queue before its sender waits
+APP_MUX_MAX_STREAMS = int(os.getenv("APP_MUX_MAX_STREAMS", 4))
+APP_MUX_STREAM_QUEUE_FRAMES = int(os.getenv("APP_MUX_STREAM_QUEUE_FRAMES", 16))
+
+# per-session usage, counted in process and added to session/usage:{session_id} in redis every
+# APP_USAGE_FLUSH_SECONDS and when a connection closes
+APP_USAGE_FLUSH_SECONDS = float(os.getenv("APP_USAGE_FLUSH_SECONDS", 10))
+APP_USAGE_TTL_SECONDS = int(os.getenv("APP_USAGE_TTL_SECONDS", 30 * 24 * 3600))
+# per-session quotas, 0 means unlimited
+APP_USAGE_MAX_TTS_CHARS = int(os.getenv("APP_USAGE_MAX_TTS_CHARS", 0))
+APP_USAGE_MAX_AUDIO_BYTES = int(os.getenv("APP_USAGE_MAX_AUDIO_BYTES", 0))
+APP_USAGE_MAX_LLM_TURNS = int(os.getenv("APP_USAGE_MAX_LLM_TURNS", 0))
+
+# fallback language detection when the LLM answer has no language-name tag
+APP_LANGUAGE_DETECTION_MAX_CHARS = int(os.getenv("APP_LANGUAGE_DETECTION_MAX_CHARS", 200))
+APP_SESSION_LANGUAGE_TTL_SECONDS = int(os.getenv("APP_SESSION_LANGUAGE_TTL_SECONDS", 3600))
+APP_SESSION_LANGUAGE_CACHE_SIZE = int(os.getenv("APP_SESSION_LANGUAGE_CACHE_SIZE", 10000))
+
+# record upstream LLM streams (chunks + timing) for replay benchmarks, empty dir disables capture
+APP_STREAM_CAPTURE_DIR = os.getenv("APP_STREAM_CAPTURE_DIR", "")
+APP_STREAM_CAPTURE_SAMPLE_RATE = float(os.getenv("APP_STREAM_CAPTURE_SAMPLE_RATE", 1.0))
 
 APP_SPEECH_GOOGLE_VOICE_EN = os.getenv("APP_SPEECH_GOOGLE_VOICE_EN", "en-US-Wavenet-C")
 APP_SPEECH_GOOGLE_VOICE_FR = os.getenv("APP_SPEECH_GOOGLE_VOICE_FR", "fr-CA-Wavenet-A")
@@ -0,0 +1,208 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Optional
+
+from app_config import APP_AUDIO_STORE_DIR, APP_AUDIO_STORE_CAPACITY
+from logging_util import get_logger
+from metrics_util import Counter
+
+logger = get_logger("audio_store")
+
+audio_store_counter = Counter("chatagent_audio_store_total", "Audio store lookups and writes, by result", ("result",))
+
+DATA_FILE = "audio.data"
+INDEX_FILE = "audio.index"
+INDEX_MAGIC = b"CAIX"
+INDEX_VERSION = 1
+# magic, version, capacity, number of clips
+INDEX_HEADER = struct.Struct("<4sIQQ")
+# clip key (sha256), offset and length in the data file
+INDEX_SLOT = struct.Struct("<32sQI4x")
+EMPTY_KEY = bytes(32)
+# inserts stop at this load factor, probes stay short
+MAX_LOAD = 0.7
+
+
+def clip_key(text: str, voice_name: str, voice_code: str, speaking_rate: float = 1.0) -> bytes:
+    raw = f"{voice_code}\0{voice_name}\0{speaking_rate:.2f}\0{text.strip()}"
+    return hashlib.sha256(raw.encode("utf-8")).digest()
+
+
+class AudioStore:
+    """
+    Synthesized clips shared by all workers of a host and kept across
+    restarts. Clips are appended to a data file; a fixed-capacity open
+    addressing hash table in the index file maps clip keys to (offset,
+    length). Both files are memory-mapped read-only, so a lookup returns a
+    memoryview into the page cache without copying. Writers (the prerender
+    CLI, or workers with APP_AUDIO_STORE_WRITE_THROUGH) serialize on a lock
+    of the index file and write the slot's key last, so readers never see a
+    half written entry.
+    """
+
+    def __init__(self, directory: str = APP_AUDIO_STORE_DIR, capacity: int = APP_AUDIO_STORE_CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self.enabled = bool(directory)
+        self._index = None
+        self._data = None
+        self._opened = False
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, INDEX_FILE)
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.directory, DATA_FILE)
+
+    def _open(self) -> bool:
+        if self._opened:
+            return self._index is not None
+        self._opened = True
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.index_path, "a+b") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.capacity, 0))
+                        f.truncate(INDEX_HEADER.size + self.capacity * INDEX_SLOT.size)
+                    open(self.data_path, "ab").close()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            with open(self.index_path, "rb") as f:
+                self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            logger.error(f"Audio store at {self.directory} not available: {e}")
+            return False
+        magic, version, capacity, _ = INDEX_HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            logger.error(f"{self.index_path} is not an audio store index")
+            self._index = None
+            return False
+        # the file decides, APP_AUDIO_STORE_CAPACITY only applies to a new store
+        self.capacity = capacity
+        self._map_data()
+        logger.info(f"Audio store opened at {self.directory}: {self.count()} clips")
+        return True
+
+    def _map_data(self):
+        with open(self.data_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # an mmap can't be empty; views handed out keep an older map alive until released
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def _slots(self, key: bytes):
+        start = int.from_bytes(key[:8], "little") % self.capacity
+        for i in range(self.capacity):
+            yield (start + i) % self.capacity
+
+    def _read_slot(self, slot: int):
+        return INDEX_SLOT.unpack_from(self._index, INDEX_HEADER.size + slot * INDEX_SLOT.size)
+
+    def get(self, key: bytes) -> Optional[memoryview]:
+        if not self.enabled or not self._open():
+            return None
+        for slot in self._slots(key):
+            slot_key, offset, length = self._read_slot(slot)
+            if slot_key == EMPTY_KEY:
+                break
+            if slot_key == key:
+                if self._data is None or offset + length > len(self._data):
+                    # appended by another process since we mapped the data file
+                    self._map_data()
+                audio_store_counter.inc(result="hit")
+                return memoryview(self._data)[offset:offset + length]
+        audio_store_counter.inc(result="miss")
+        return None
+
+    def put(self, key: bytes, audio: bytes) -> bool:
+        """
+        Appends a clip. Blocking file I/O, run it in a thread from the loop.
+        """
+        if not self.enabled or not self._open() or not audio:
+            return False
+        with open(self.index_path, "r+b") as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                free_slot = None
+                for slot in self._slots(key):
+                    slot_key, _, _ = self._read_slot(slot)
+                    if slot_key == key:
+                        return True
+                    if slot_key == EMPTY_KEY:
+                        free_slot = slot
+                        break
+                count = self.count()
+                if free_slot is None or count + 1 > self.capacity * MAX_LOAD:
+                    audio_store_counter.inc(result="full")
+                    return False
+                with open(self.data_path, "ab") as data_file:
+                    offset = data_file.seek(0, os.SEEK_END)
+                    data_file.write(audio)
+                position = INDEX_HEADER.size + free_slot * INDEX_SLOT.size
+                entry = INDEX_SLOT.pack(key, offset, len(audio))
+                os.pwrite(index_file.fileno(), entry[32:], position + 32)
+                os.pwrite(index_file.fileno(), entry[:32], position)
+                os.pwrite(index_file.fileno(), struct.pack("<Q", count + 1), INDEX_HEADER.size - 8)
+            finally:
+                fcntl.flock(index_file, fcntl.LOCK_UN)
+        audio_store_counter.inc(result="stored")
+        return True
+
+    def count(self) -> int:
+        if not self.enabled or not self._open():
+            return 0
+        return INDEX_HEADER.unpack_from(self._index, 0)[3]
+
+
+audio_store = AudioStore()
+
+
+def prerender(phrases_path: str, store: AudioStore = audio_store):
+    """
+    Synthesizes every phrase of a {"LANGUAGE_NAME": [phrases]} file with the
+    engine and voice the service would use for it, skipping clips already in
+    the store.
+    """
+    from language_util import get_voice_code_name_by_language_name
+    from tts_provider import tts_router
+
+    with open(phrases_path, encoding="utf-8") as f:
+        phrases = json.load(f)
+    rendered = skipped = 0
+    for language_name, texts in phrases.items():
+        _, voice_code, voice_name = get_voice_code_name_by_language_name(language_name)
+        for text in texts:
+            # same engine, voice and key as ws_speech.synthesize_audio
+            provider = tts_router.provider_for(language_name, text)
+            voice = provider.voice_for(voice_code, voice_name)
+            key = clip_key(text, f"{provider.name}/{voice}", voice_code)
+            if store.get(key) is not None:
+                skipped += 1
+                continue
+            store.put(key, provider.synthesize(text, voice_code, voice))
+            rendered += 1
+        logger.info(f"{language_name}: {len(texts)} phrases with {voice_name}")
+    logger.info(f"Prerendered {rendered} clips, {skipped} already stored, {store.count()} clips in the store")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render common phrases into the shared audio store")
+    parser.add_argument("phrases", nargs="?", default=os.path.join(os.path.dirname(__file__), "audio_phrases.json"),
+                        help="JSON file of {LANGUAGE_NAME: [phrases]}")
+    parser.add_argument("--dir", default=APP_AUDIO_STORE_DIR, help="store directory (APP_AUDIO_STORE_DIR)")
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error("set APP_AUDIO_STORE_DIR or --dir")
+    prerender(args.phrases, AudioStore(args.dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from httpx import HTTPStatusError
+
+from app_config import APP_BACKEND_LIMIT_INITIAL, APP_BACKEND_LIMIT_MIN, APP_BACKEND_LIMIT_MAX, \
+    APP_BACKEND_LATENCY_TOLERANCE, APP_BACKEND_QUEUE_SIZE, APP_BACKEND_QUEUE_WAIT_SECONDS, APP_BREAKER_WINDOW, \
+    APP_BREAKER_MIN_CALLS, APP_BREAKER_ERROR_RATE, APP_BREAKER_SLOW_SECONDS, APP_BREAKER_SLOW_RATE, \
+    APP_BREAKER_OPEN_SECONDS
+from logging_util import get_logger
+from metrics_util import Gauge, Counter, Histogram
+
+logger = get_logger("backend_limiter")
+
+backend_limit_gauge = Gauge("chatagent_backend_limit", "Current adaptive concurrency limit", ("backend",))
+backend_in_flight_gauge = Gauge("chatagent_backend_in_flight", "Backend streams in flight", ("backend",))
+backend_queued_gauge = Gauge("chatagent_backend_queued", "Turns waiting for a backend slot", ("backend",))
+backend_rejected_counter = Counter("chatagent_backend_rejected_total", "Backend calls refused, by reason",
+                                   ("backend", "reason"))
+backend_circuit_gauge = Gauge("chatagent_backend_circuit_state", "0 closed, 1 half open, 2 open", ("backend",))
+backend_first_chunk_histogram = Histogram("chatagent_backend_first_chunk_seconds",
+                                          "Time to the first chunk of a backend stream", ("backend",))
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+class BackendUnavailable(Exception):
+    """
+    The backend call was refused without being made: the circuit is open or
+    no slot became free in time. The message is meant for the client.
+    """
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit. Latency samples (time to first chunk, the part of
+    a stream the backend controls) are compared with a slow moving baseline:
+    a fast success raises the limit by 1/limit, so about one per limit's worth
+    of calls, a slow one or a failure cuts it by backoff. Turns beyond the
+    limit wait in a bounded FIFO queue for at most max_wait seconds.
+    """
+
+    def __init__(self, name: str, initial_limit: int = APP_BACKEND_LIMIT_INITIAL,
+                 min_limit: int = APP_BACKEND_LIMIT_MIN, max_limit: int = APP_BACKEND_LIMIT_MAX,
+                 tolerance: float = APP_BACKEND_LATENCY_TOLERANCE, max_queue: int = APP_BACKEND_QUEUE_SIZE,
+                 max_wait: float = APP_BACKEND_QUEUE_WAIT_SECONDS, backoff: float = 0.9,
+                 baseline_alpha: float = 0.05):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.baseline_alpha = baseline_alpha
+        self.baseline = None
+        self.in_flight = 0
+        self._waiters = deque()
+        backend_limit_gauge.set(int(self.limit), backend=name)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        if self._has_capacity() and not self._waiters:
+            self._take()
+            return
+        if len(self._waiters) >= self.max_queue:
+            backend_rejected_counter.inc(backend=self.name, reason="queue_full")
+            raise BackendUnavailable("Service is busy, please try again shortly")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        backend_queued_gauge.set(len(self._waiters), backend=self.name)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            backend_rejected_counter.inc(backend=self.name, reason="queue_timeout")
+            raise BackendUnavailable("Service is busy, please try again shortly")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # got the slot just as we were cancelled, pass it on
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            backend_queued_gauge.set(len(self._waiters), backend=self.name)
+
+    def _take(self):
+        self.in_flight += 1
+        backend_in_flight_gauge.set(self.in_flight, backend=self.name)
+
+    def release(self):
+        self.in_flight -= 1
+        backend_in_flight_gauge.set(self.in_flight, backend=self.name)
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._take()
+                waiter.set_result(None)
+
+    def on_sample(self, latency: float):
+        if self.baseline is None:
+            self.baseline = latency
+        if latency > self.baseline * self.tolerance:
+            self._decrease()
+        else:
+            # only grow while the limit is actually in use
+            if self.in_flight + 1 >= int(self.limit) // 2:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.baseline += self.baseline_alpha * (latency - self.baseline)
+        self._limit_changed()
+
+    def on_failure(self):
+        self._decrease()
+        self._limit_changed()
+
+    def _decrease(self):
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def _limit_changed(self):
+        backend_limit_gauge.set(int(self.limit), backend=self.name)
+        self._wake_waiters()
+
+
+class CircuitBreaker:
+    """
+    Opens when, over the last `window` calls (at least min_calls of them),
+    the error rate or the rate of calls slower than slow_seconds to the first
+    chunk reaches its threshold. While open every call fails fast; after
+    open_seconds a single probe call is let through (half open) and its
+    outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, window: int = APP_BREAKER_WINDOW, min_calls: int = APP_BREAKER_MIN_CALLS,
+                 error_rate: float = APP_BREAKER_ERROR_RATE, slow_seconds: float = APP_BREAKER_SLOW_SECONDS,
+                 slow_rate: float = APP_BREAKER_SLOW_RATE, open_seconds: float = APP_BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        # (failed, slow) of the most recent calls
+        self._outcomes = deque(maxlen=window)
+        backend_circuit_gauge.set(CLOSED, backend=name)
+
+    def before_call(self):
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                backend_rejected_counter.inc(backend=self.name, reason="circuit_open")
+                raise BackendUnavailable("Service is temporarily unavailable, please try again later")
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self.probing:
+                backend_rejected_counter.inc(backend=self.name, reason="circuit_open")
+                raise BackendUnavailable("Service is temporarily unavailable, please try again later")
+            self.probing = True
+
+    def on_result(self, failed: bool, latency: float):
+        slow = latency > self.slow_seconds
+        if self.state == HALF_OPEN:
+            self.probing = False
+            if failed or slow:
+                self._open()
+            else:
+                self._outcomes.clear()
+                self._set_state(CLOSED)
+            return
+        self._outcomes.append((failed, slow))
+        if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+            calls = len(self._outcomes)
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, slow in self._outcomes if slow)
+            if failures / calls >= self.error_rate or slow_calls / calls >= self.slow_rate:
+                logger.warning(f"Circuit for {self.name} backend opened: {failures}/{calls} failed, "
+                               f"{slow_calls}/{calls} slower than {self.slow_seconds}s")
+                self._open()
+
+    def on_abandoned(self):
+        # the caller went away before an outcome, let the next call probe
+        if self.state == HALF_OPEN:
+            self.probing = False
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def _set_state(self, state: int):
+        if state != self.state:
+            logger.info(f"Circuit for {self.name} backend: {self.state} -> {state}")
+        self.state = state
+        backend_circuit_gauge.set(state, backend=self.name)
+
+
+def is_backend_failure(e: BaseException) -> bool:
+    # a 4xx is about the request, not the backend's health
+    if isinstance(e, HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return True
+
+
+class BackendCall:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_chunk_latency = None
+
+    def first_chunk(self):
+        if self.first_chunk_latency is None:
+            self.first_chunk_latency = time.monotonic() - self.started
+
+    def latency(self) -> float:
+        if self.first_chunk_latency is not None:
+            return self.first_chunk_latency
+        return time.monotonic() - self.started
+
+
+class BackendGuard:
+    """
+    Circuit breaker and adaptive limiter in front of one backend streaming
+    endpoint. Use as
+
+        async with guard.call() as backend_call:
+            ... open the stream ...
+            backend_call.first_chunk()
+
+    Raises BackendUnavailable instead of calling a backend that is down or
+    saturated.
+    """
+
+    def __init__(self, name: str, limiter: AdaptiveLimiter = None, breaker: CircuitBreaker = None):
+        self.name = name
+        self.limiter = limiter or AdaptiveLimiter(name)
+        self.breaker = breaker or CircuitBreaker(name)
+
+    @asynccontextmanager
+    async def call(self):
+        self.breaker.before_call()
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            self.breaker.on_abandoned()
+            raise
+        backend_call = BackendCall()
+        try:
+            yield backend_call
+        except (asyncio.CancelledError, GeneratorExit):
+            # client gone or turn cancelled mid-stream, only the first chunk says something about the backend
+            if backend_call.first_chunk_latency is None:
+                self.breaker.on_abandoned()
+            else:
+                self._on_success(backend_call.first_chunk_latency)
+            raise
+        except BaseException as e:
+            if is_backend_failure(e):
+                self.breaker.on_result(True, backend_call.latency())
+                self.limiter.on_failure()
+            else:
+                self.breaker.on_abandoned()
+            raise
+        else:
+            self._on_success(backend_call.latency())
+        finally:
+            self.limiter.release()
+
+    def _on_success(self, latency: float):
+        backend_first_chunk_histogram.observe(latency, backend=self.name)
+        self.breaker.on_result(False, latency)
+        self.limiter.on_sample(latency)
+
+
+chat_backend_guard = BackendGuard("chat")
+speech_backend_guard = BackendGuard("speech")
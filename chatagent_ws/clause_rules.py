@@ -0,0 +1,27 @@
+import re
+
+# Clause boundaries for speculative synthesis of an answer's opening clause, per language name:
+# (boundary pattern, minimum clause length in characters). The CJK comma "，" is also a sentence
+# boundary in custom_sentence_boundaries; CJK clauses carry more per character, hence the lower minimum.
+CLAUSE_RULES = {
+    "CHINESE": (re.compile(r"[，、；：]"), 8),
+    "JAPANESE": (re.compile(r"[、，；：]"), 10),
+    # Korean writes western punctuation, with spaces between words
+    "KOREAN": (re.compile(r"[,;:](?=\s)"), 16),
+    # "1,000" or "3:30" are not clause boundaries, a boundary is followed by whitespace
+    "DEFAULT": (re.compile(r"(?:[,;:]|\s[-–—])(?=\s)"), 32),
+}
+
+
+def find_clause_boundary(text: str, lang_name: str) -> int:
+    """
+    Returns the end of the first clause of text that is long enough to be
+    spoken on its own (the index just past its boundary punctuation), or -1.
+    """
+    pattern, min_chars = CLAUSE_RULES.get(lang_name, CLAUSE_RULES["DEFAULT"])
+    match = pattern.search(text, min_chars)
+    if match is None:
+        return -1
+    end = match.end()
+    # leave something after the boundary, so the clause is known to be complete
+    return end if text[end:].strip() else -1
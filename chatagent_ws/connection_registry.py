@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import WebSocket
+
+from app_config import APP_NODE_ID, APP_REGISTRY_HEARTBEAT_SECONDS, APP_REGISTRY_FLUSH_SECONDS
+from logging_util import get_logger
+from session_manager import session_redis_client
+
+logger = get_logger("connection_registry")
+
+CONTROL_CHANNEL_PREFIX = "control/worker:"
+
+CONTROL_DISCONNECT = "disconnect"
+CONTROL_CANCEL = "cancel"
+CONTROL_PUSH = "push"
+CONTROL_ACTIONS = (CONTROL_DISCONNECT, CONTROL_CANCEL, CONTROL_PUSH)
+
+
+class LocalConnection:
+    """
+    A live websocket of a session on this worker, as seen by the control channel.
+    """
+    __slots__ = ("session_id", "websocket", "endpoint", "turn_task")
+
+    def __init__(self, session_id: str, websocket: WebSocket, endpoint: str):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.endpoint = endpoint
+        self.turn_task: Optional[asyncio.Task] = None
+
+    def active_turns(self) -> list:
+        return [self.turn_task] if self.turn_task is not None and not self.turn_task.done() else []
+
+    async def send_json(self, data: dict):
+        """
+        Sends a frame of the server's own (push, cancel, reconnect hint).
+        Connections with a numbered answer stream send it there instead.
+        """
+        await self.websocket.send_json(data)
+
+    async def handle_control(self, action: str, payload: dict):
+        logger.info(f"control {action} for session {self.session_id} on {self.endpoint}")
+        if action == CONTROL_CANCEL or action == CONTROL_DISCONNECT:
+            if self.turn_task is not None and not self.turn_task.done():
+                self.turn_task.cancel()
+        if action == CONTROL_PUSH:
+            await self.send_json(payload.get("message", {}))
+        elif action == CONTROL_DISCONNECT:
+            await self.websocket.close(code=1008, reason=payload.get("reason", "Disconnected by server"))
+
+
+async def run_turn(connection: LocalConnection, coro):
+    """
+    Runs one process_input turn as a task the control channel can cancel.
+    A cancelled turn ends with a stream_error frame, while cancellation of the
+    endpoint itself (shutdown, disconnect) still propagates.
+    """
+    connection.turn_task = asyncio.create_task(coro)
+    try:
+        await connection.turn_task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        logger.info(f"turn cancelled for session {connection.session_id}")
+        try:
+            await connection.send_json({"type": "stream_error", "text": "Request cancelled"})
+        except Exception as e:
+            logger.info(f"cancelled turn of session {connection.session_id} not reported: {e}")
+    finally:
+        connection.turn_task = None
+
+
+class ConnectionRegistry:
+    """
+    Cross-node registry of live websocket sessions plus a control channel.
+
+    Every worker keeps a hash session/conn:{session_id} -> {worker_id: last heartbeat}
+    up to date for its local sessions. New and closed sessions are written in
+    one pipeline every APP_REGISTRY_FLUSH_SECONDS, all local sessions are
+    refreshed every APP_REGISTRY_HEARTBEAT_SECONDS, and entries not refreshed
+    for three heartbeats are treated as gone. Each worker subscribes to its own
+    control/worker:{worker_id} channel; send_control publishes to the workers
+    holding the session.
+    """
+
+    def __init__(self, redis_client: redis.Redis, heartbeat_seconds: float = APP_REGISTRY_HEARTBEAT_SECONDS,
+                 flush_seconds: float = APP_REGISTRY_FLUSH_SECONDS):
+        self.redis_client = redis_client
+        self.heartbeat_seconds = heartbeat_seconds
+        self.flush_seconds = flush_seconds
+        self.expiry_seconds = heartbeat_seconds * 3
+        self.worker_id = None
+        self.local = {}
+        self._added = set()
+        self._removed = set()
+        self._tasks = []
+        self._pubsub = None
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"session/conn:{session_id}"
+
+    async def start(self):
+        # the worker id is taken here, after the gunicorn fork, not at import
+        self.worker_id = f"{APP_NODE_ID or socket.gethostname()}:{os.getpid()}"
+        self._pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(f"{CONTROL_CHANNEL_PREFIX}{self.worker_id}")
+        self._tasks = [asyncio.create_task(self._heartbeat_loop()), asyncio.create_task(self._listen_loop())]
+        logger.info(f"connection registry started for worker {self.worker_id}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._removed.update(self.local)
+        self._added.clear()
+        try:
+            await self._flush(full=False)
+            if self._pubsub is not None:
+                await self._pubsub.aclose()
+        except redis.RedisError as e:
+            logger.error(f"Redis access failed: {e}")
+
+    def register(self, connection: LocalConnection):
+        connections = self.local.setdefault(connection.session_id, set())
+        if not connections:
+            self._added.add(connection.session_id)
+            self._removed.discard(connection.session_id)
+        connections.add(connection)
+
+    def unregister(self, connection: LocalConnection):
+        connections = self.local.get(connection.session_id)
+        if not connections:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.local[connection.session_id]
+            self._removed.add(connection.session_id)
+            self._added.discard(connection.session_id)
+
+    async def _flush(self, full: bool):
+        added = set(self._added)
+        removed = set(self._removed)
+        session_ids = set(self.local) if full else added
+        if not session_ids and not removed:
+            return
+        now = int(time.time())
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                pipe.hset(self._key(session_id), self.worker_id, now)
+                pipe.expire(self._key(session_id), int(self.expiry_seconds))
+            for session_id in removed:
+                pipe.hdel(self._key(session_id), self.worker_id)
+            await pipe.execute()
+        # keep what changed while the pipeline was in flight for the next flush
+        self._added -= added
+        self._removed -= removed
+
+    async def _heartbeat_loop(self):
+        last_full = 0.0
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            now = time.monotonic()
+            full = now - last_full >= self.heartbeat_seconds
+            try:
+                await self._flush(full)
+                if full:
+                    last_full = now
+            except redis.RedisError as e:
+                logger.error(f"Connection registry heartbeat failed: {e}")
+
+    async def _listen_loop(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Control channel listener failed: {e}")
+                await asyncio.sleep(1)
+
+    async def _dispatch(self, data: str):
+        try:
+            command = json.loads(data)
+            session_id = command["session_id"]
+            action = command["action"]
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring invalid control message {data}: {e}")
+            return
+        for connection in list(self.local.get(session_id, ())):
+            try:
+                await connection.handle_control(action, command.get("payload") or {})
+            except Exception as e:
+                logger.error(f"Control {action} for session {session_id} failed: {e}")
+
+    async def lookup(self, session_id: str) -> list[str]:
+        """
+        Returns the ids of the workers holding a live connection of the session.
+        """
+        entries = await self.redis_client.hgetall(self._key(session_id))
+        oldest = time.time() - self.expiry_seconds
+        return [worker_id for worker_id, heartbeat in entries.items() if int(heartbeat) >= oldest]
+
+    async def send_control(self, session_id: str, action: str, payload: Optional[dict] = None) -> int:
+        """
+        Sends a control command to every live connection of the session, on any node.
+
+        Returns:
+            The number of workers that received the command.
+        """
+        if action not in CONTROL_ACTIONS:
+            raise ValueError(f"Unknown control action {action}")
+        message = json.dumps({"session_id": session_id, "action": action, "payload": payload or {}})
+        delivered = 0
+        for worker_id in await self.lookup(session_id):
+            delivered += await self.redis_client.publish(f"{CONTROL_CHANNEL_PREFIX}{worker_id}", message)
+        return delivered
+
+
+connection_registry = ConnectionRegistry(session_redis_client)
@@ -0,0 +1,141 @@
+import re
+from typing import Optional
+
+from logging_util import get_logger
+
+logger = get_logger("control_tags")
+
+# in-band directives the LLM backend may put in the answer text, e.g. "language-name:french\n"
+LANGUAGE_NAME_TAG = "language-name"
+VOICE_NAME_TAG = "voice-name"
+SPEAKING_RATE_TAG = "speaking-rate"
+
+DEFAULT_CONTROL_TAGS = (LANGUAGE_NAME_TAG, VOICE_NAME_TAG, SPEAKING_RATE_TAG)
+
+_TAG_VALUE_CHARS = r"[A-Za-z0-9_.\-]"
+_WORD_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_"
+
+
+def _parse_tag_value(name: str, value: str):
+    if name == LANGUAGE_NAME_TAG:
+        return value.upper()
+    if name == SPEAKING_RATE_TAG:
+        return float(value)
+    return value
+
+
+class ControlTagParser:
+    """
+    Incremental parser that strips in-band control tags (``name:value``
+    followed by whitespace) from a streamed LLM answer.
+
+    Only the new chunk plus a short held-back tail is scanned on each feed, so
+    the cost per chunk does not grow with the answer. A tag split across
+    chunks is held back until its value is terminated; text that is only a
+    possible tag prefix ("langu") is held back until the next chunk decides.
+    The first value of each tag wins and later occurrences are stripped but
+    ignored, so e.g. the language stays locked once resolved.
+    """
+
+    def __init__(self, tags=DEFAULT_CONTROL_TAGS):
+        self.tags = tuple(tags)
+        self.values = {}
+        self._pending = ""
+        # the character before _pending, so a tag is only taken at the start of a word across chunks too
+        self._before = ""
+        # a tag starts a word and has a value, "language-name: french" and "mylanguage-name:x" are just text
+        self._tag_pattern = re.compile(
+            r"(?<![A-Za-z0-9_])(?:" + "|".join(re.escape(tag) for tag in self.tags) + r"):(" + _TAG_VALUE_CHARS
+            + r"+)")
+        self._prefixes = {tag[:i] + (":" if i > len(tag) else "")
+                          for tag in self.tags for i in range(1, len(tag) + 2)}
+        self._max_prefix_len = max(len(tag) for tag in self.tags) + 1
+
+    @property
+    def language_name(self) -> Optional[str]:
+        return self.values.get(LANGUAGE_NAME_TAG)
+
+    @property
+    def voice_name(self) -> Optional[str]:
+        return self.values.get(VOICE_NAME_TAG)
+
+    @property
+    def speaking_rate(self) -> Optional[float]:
+        return self.values.get(SPEAKING_RATE_TAG)
+
+    def apply(self, name: str, value: str):
+        """
+        Applies a tag the way an in-band one would be, for tags the upstream
+        sends as frames of their own. Unknown tags are ignored.
+        """
+        if name not in self.tags:
+            logger.debug(f"Ignoring unknown control tag {name}")
+            return
+        self._apply(name, value)
+
+    def _apply(self, name: str, value: str):
+        if not value or name in self.values:
+            return
+        try:
+            self.values[name] = _parse_tag_value(name, value)
+            logger.debug(f"control tag {name}:{value}")
+        except ValueError:
+            logger.warning(f"Ignoring invalid control tag {name}:{value}")
+
+    def _held_prefix_len(self, text: str, pos: int) -> int:
+        # length of the longest suffix after pos that could still grow into a tag
+        for size in range(min(self._max_prefix_len, len(text) - pos), 0, -1):
+            start = len(text) - size
+            if text[start:] in self._prefixes and (start == 0 or text[start - 1] not in _WORD_CHARS):
+                return size
+        return 0
+
+    def _hold(self, text: str, start: int):
+        self._pending = text[start:]
+        self._before = text[start - 1] if start > 0 else ""
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consumes the next chunk of the stream.
+
+        Returns:
+            The text that is now known to be free of control tags.
+        """
+        text = self._before + self._pending + chunk
+        self._pending = ""
+        out = []
+        pos = len(self._before)
+        while True:
+            match = self._tag_pattern.search(text, pos)
+            if match is None:
+                break
+            end = match.end()
+            if end == len(text):
+                # value may continue in the next chunk
+                out.append(text[pos:match.start()])
+                self._hold(text, match.start())
+                return "".join(out)
+            name = match.group(0).split(":", 1)[0]
+            self._apply(name, match.group(1))
+            out.append(text[pos:match.start()])
+            # drop the whitespace that terminates the tag, usually the newline after it
+            while end < len(text) and text[end].isspace():
+                end += 1
+            pos = end
+        held = self._held_prefix_len(text, pos)
+        out.append(text[pos:len(text) - held])
+        self._hold(text, len(text) - held)
+        return "".join(out)
+
+    def finish(self) -> str:
+        """
+        Flushes the held-back tail at the end of the stream. An unterminated
+        tag at the very end is still applied, as the old regex did with ``$``.
+        """
+        text = self._pending
+        self._pending = self._before = ""
+        match = self._tag_pattern.fullmatch(text) if text else None
+        if match:
+            self._apply(text.split(":", 1)[0], match.group(1))
+            return ""
+        return text
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from app_config import APP_DRAIN_TIMEOUT_SECONDS, APP_DRAIN_RECONNECT_DELAY_MS
+from connection_registry import connection_registry
+from logging_util import get_logger
+from metrics_util import Gauge, Counter
+
+logger = get_logger("drain_manager")
+
+draining_gauge = Gauge("chatagent_draining", "1 while the worker is draining connections")
+drain_active_turns_gauge = Gauge("chatagent_drain_active_turns", "Turns still running during the drain")
+drain_active_connections_gauge = Gauge("chatagent_drain_active_connections",
+                                       "Connections still open during the drain")
+drain_turns_counter = Counter("chatagent_drain_turns_total", "Turns seen by a drain, by outcome", ("outcome",))
+drain_duration_gauge = Gauge("chatagent_drain_duration_seconds", "Duration of the last completed drain")
+
+
+def reconnect_hint_frame() -> dict:
+    return {"type": "reconnect", "reason": "server_draining", "retry_after_ms": APP_DRAIN_RECONNECT_DELAY_MS}
+
+
+class DrainManager:
+    """
+    Takes a worker out of rotation without dropping answers: new websockets
+    and new turns are refused, /health turns not-ready, running turns get up
+    to APP_DRAIN_TIMEOUT_SECONDS to finish, then every client gets a
+    reconnect hint frame and is closed with 1012 (service restart).
+    """
+
+    def __init__(self):
+        self.draining = False
+        self._drain_task = None
+
+    def start(self, timeout: float = APP_DRAIN_TIMEOUT_SECONDS) -> asyncio.Task:
+        """
+        Starts draining, or returns the drain already in progress.
+        """
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain(timeout))
+        return self._drain_task
+
+    async def drain(self, timeout: float = APP_DRAIN_TIMEOUT_SECONDS):
+        await self.start(timeout)
+
+    @staticmethod
+    def _local_connections():
+        return [connection for connections in connection_registry.local.values() for connection in connections]
+
+    async def _drain(self, timeout: float):
+        self.draining = True
+        draining_gauge.set(1)
+        started = time.monotonic()
+        turns = [task for connection in self._local_connections() for task in connection.active_turns()]
+        logger.info(f"Draining: {len(self._local_connections())} connections, {len(turns)} turns in flight, "
+                    f"deadline {timeout}s")
+
+        pending = set(turns)
+        deadline = started + timeout
+        while pending:
+            drain_active_turns_gauge.set(len(pending))
+            drain_active_connections_gauge.set(len(self._local_connections()))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=min(remaining, 1.0))
+            drain_turns_counter.inc(len(done), outcome="completed")
+        if pending:
+            logger.warning(f"Drain deadline reached, cancelling {len(pending)} turns")
+            drain_turns_counter.inc(len(pending), outcome="cancelled")
+            for task in pending:
+                task.cancel()
+        drain_active_turns_gauge.set(0)
+
+        for connection in self._local_connections():
+            try:
+                await connection.send_json(reconnect_hint_frame())
+                await connection.websocket.close(code=1012, reason="Server restarting")
+            except Exception as e:
+                logger.debug(f"closing drained connection failed: {e}")
+        drain_active_connections_gauge.set(0)
+        drain_duration_gauge.set(round(time.monotonic() - started, 3))
+        logger.info(f"Drain finished in {time.monotonic() - started:.1f}s")
+
+
+drain_manager = DrainManager()
@@ -0,0 +1,43 @@
+import gc
+import os
+
+from app_config import APP_WS_PORT, APP_WS_WORKERS, APP_WS_TIMEOUT_SECONDS, APP_WS_WORKER_TIMEOUT_SECONDS, \
+    APP_WS_GRACEFUL_TIMEOUT_SECONDS
+from logging_util import get_logger
+
+logger = get_logger("gunicorn_conf")
+
+bind = f"0.0.0.0:{APP_WS_PORT}"
+workers = APP_WS_WORKERS
+worker_class = "server_runner.ChatAgentUvicornWorker"
+
+# import main:app in the master and warm the models there (when_ready), so workers share the pages copy-on-write
+preload_app = True
+
+# a worker whose event loop stops notifying the arbiter for this long is killed and respawned
+timeout = APP_WS_WORKER_TIMEOUT_SECONDS
+graceful_timeout = APP_WS_GRACEFUL_TIMEOUT_SECONDS
+keepalive = APP_WS_TIMEOUT_SECONDS
+
+
+def when_ready(server):
+    from readiness import readiness, model_components
+
+    readiness.warm_up_blocking(model_components())
+    # everything loaded so far is shared with the workers, keep the gc from touching (and copying) it
+    gc.collect()
+    gc.freeze()
+    logger.info(f"gunicorn master {os.getpid()} ready, frozen {gc.get_freeze_count()} objects, "
+                f"starting {workers} workers")
+
+
+def post_fork(server, worker):
+    logger.info(f"worker {worker.pid} started")
+
+
+def worker_abort(worker):
+    logger.error(f"worker {worker.pid} timed out and was aborted")
+
+
+def child_exit(server, worker):
+    logger.warning(f"worker {worker.pid} exited, the arbiter will replace it")
@@ -1,9 +1,12 @@
 # import nltk
 from dotenv import load_dotenv
 from lingua import LanguageDetectorBuilder, Language
+import functools
 import re
+import threading
 from spacy.tokens import Doc
 
+from app_config import APP_LANGUAGE_DETECTION_MAX_CHARS
 from app_config import APP_SPEECH_GOOGLE_VOICE_CN, APP_SPEECH_GOOGLE_VOICE_ES, APP_SPEECH_GOOGLE_VOICE_FR, \
     APP_SPEECH_GOOGLE_VOICE_DE, APP_SPEECH_GOOGLE_VOICE_JP, APP_SPEECH_GOOGLE_VOICE_KR, \
     APP_SPEECH_GOOGLE_VOICE_EN, APP_SPEECH_GOOGLE_VOICE_RU
@@ -34,9 +37,36 @@ voice_code_cn = "cmn-CN"
 lingua_languages = [Language.ENGLISH, Language.FRENCH, Language.GERMAN, Language.SPANISH,
                     Language.CHINESE, Language.KOREAN, Language.JAPANESE
                     ]
-lingua_detector = (LanguageDetectorBuilder.from_languages(*lingua_languages)
-                   .with_preloaded_language_models().build())
-logger.info(f"lingua language detector initiated successfully")
+# detectors and spaCy models are built by the startup warm-up (or on first use), not at import
+lingua_detector = None
+lingua_fast_detector = None
+spacy_models = {}
+_init_lock = threading.Lock()
+
+
+def get_lingua_detector():
+    global lingua_detector
+    if lingua_detector is not None:
+        return lingua_detector
+    with _init_lock:
+        if lingua_detector is None:
+            lingua_detector = (LanguageDetectorBuilder.from_languages(*lingua_languages)
+                               .with_preloaded_language_models().build())
+            logger.info(f"lingua language detector initiated successfully")
+    return lingua_detector
+
+
+def get_lingua_fast_detector():
+    global lingua_fast_detector
+    if lingua_fast_detector is not None:
+        return lingua_fast_detector
+    with _init_lock:
+        if lingua_fast_detector is None:
+            # low accuracy mode only uses trigrams, good enough for a first sentence and much cheaper
+            lingua_fast_detector = (LanguageDetectorBuilder.from_languages(*lingua_languages)
+                                    .with_low_accuracy_mode().build())
+            logger.info(f"lingua fast language detector initiated successfully")
+    return lingua_fast_detector
 
 # NLTK setup
 # try:
@@ -102,23 +132,49 @@ def load_spacy_model(model_name):
             return None
 
 
+_spacy_locks = {lang_name: threading.Lock() for lang_name in spacy_models_names}
+
+
+def get_spacy_model(lang_name: str):
+    if lang_name in spacy_models:
+        return spacy_models[lang_name]
+    # one lock per language, so the warm-up loads the models in parallel
+    with _spacy_locks[lang_name]:
+        if lang_name not in spacy_models:
+            model_name = spacy_models_names[lang_name]
+            try:
+                spacy_models[lang_name] = load_spacy_model(model_name)
+                logger.info(f"Loaded model for {lang_name}")
+            except OSError:
+                logger.error(f"Error: Could not load model '{lang_name}). "
+                      f"Please run: python -m spacy download {model_name}")
+                spacy_models[lang_name] = None
+    return spacy_models[lang_name]
+
+
 def load_spacy_models():
-    models={}
-    for lang_name, model_name in spacy_models_names.items():
-        try:
-            models[lang_name] = load_spacy_model(model_name)
-            logger.info(f"Loaded model for {lang_name}")
-        except OSError:
-            logger.error(f"Error: Could not load model '{lang_name}). "
-                  f"Please run: python -m spacy download {model_name}")
-            models[lang_name] = None
-    return models
+    return {lang_name: get_spacy_model(lang_name) for lang_name in spacy_models_names}
+
+
+def _warm_up_spacy_model(lang_name: str):
+    if get_spacy_model(lang_name) is None:
+        raise RuntimeError(f"spaCy model {spacy_models_names[lang_name]} not available")
+
 
-spacy_models = load_spacy_models()
+def warm_up_components():
+    """
+    The heavy objects to build before serving, by component name. The full
+    lingua detector is left out: only detect_language_code_and_voice_name
+    uses it, and preloading all its models costs more than it saves.
+    """
+    components = {"lingua_fast": get_lingua_fast_detector}
+    for lang_name in spacy_models_names:
+        components[f"spacy_{lang_name.lower()}"] = functools.partial(_warm_up_spacy_model, lang_name)
+    return components
 
 
 def spacy_tokenize_text(input_text:str, lang_name:str):
-    nlp=spacy_models[lang_name]
+    nlp=get_spacy_model(lang_name)
     # if lang_name == Language.ENGLISH.name or lang_name == Language.JAPANESE.name:
     #     nlp.remove_pipe("senter") if "senter" in nlp.pipe_names else None
     #     nlp.add_pipe("custom_sentence_boundaries", before="parser")
@@ -134,7 +190,7 @@ def detect_language_code_and_voice_name(text: str):
         #     logger.debug(f"detected multi language: {result_name} on: {text}")
         #     if result.language.name != "ENGLISH":
         #         result_name = result.language.name
-        result_name=lingua_detector.detect_language_of(text).name
+        result_name=get_lingua_detector().detect_language_of(text).name
         logger.debug(f"detected final language: {result_name} : {text}")
 
         if result_name == "ENGLISH":
@@ -161,9 +217,26 @@ def detect_language_code_and_voice_name(text: str):
     except Exception as e:
         return lang_code_cn, lang_code_en, APP_SPEECH_GOOGLE_VOICE_EN, result_name
 
+def detect_language_name(text: str, max_chars: int = APP_LANGUAGE_DETECTION_MAX_CHARS):
+    """
+    Cheap fallback detection for answers without a language-name tag.
+    Only a bounded prefix of the text is looked at.
+
+    Returns:
+        The lingua language name (e.g. "FRENCH"), or None if lingua can't decide.
+    """
+    try:
+        language = get_lingua_fast_detector().detect_language_of(text[:max_chars])
+        return language.name if language is not None else None
+    except Exception as e:
+        logger.error(f"Language detection failed: {e}")
+        return None
+
+language_name_pattern = re.compile(r"language-name:([a-zA-Z]+)(?:\s+|\n|$)")
+
+
 def extract_language_name_from_llm_text(text:str):
-    pattern = r"language-name:([a-zA-Z]+)(?:\s+|\n|$)"
-    match = re.search(pattern, text)
+    match = language_name_pattern.search(text)
     if match:
         return match.group(1)
     else:
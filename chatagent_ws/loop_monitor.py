@@ -0,0 +1,98 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from app_config import APP_LOOP_MONITOR_INTERVAL_MS, APP_LOOP_STALL_THRESHOLD_MS
+from logging_util import get_logger
+from metrics_util import Counter, Gauge, Histogram
+
+logger = get_logger("loop_monitor")
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+loop_lag_histogram = Histogram("chatagent_event_loop_lag_seconds",
+                               "How late the event loop ran a callback scheduled by the lag sampler",
+                               buckets=LAG_BUCKETS)
+loop_stall_counter = Counter("chatagent_event_loop_stalls_total",
+                             "Event loop stalls longer than APP_LOOP_STALL_THRESHOLD_MS")
+loop_info_gauge = Gauge("chatagent_event_loop_info", "Event loop implementation of the worker", ("loop",))
+
+
+class LoopLagMonitor:
+    """
+    Samples event loop lag: a task sleeps for the interval and measures how
+    much later than that it gets to run again, which is the time other code
+    held the loop. A watchdog thread watches the sampler's heartbeat and,
+    while a stall is still going on, captures the stack of the loop thread,
+    i.e. the code that is blocking it.
+    """
+
+    def __init__(self, interval: float = APP_LOOP_MONITOR_INTERVAL_MS / 1000,
+                 stall_threshold: float = APP_LOOP_STALL_THRESHOLD_MS / 1000):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.last_stall: Optional[dict] = None
+        self._last_beat = 0.0
+        self._loop_thread_id = None
+        self._stall_captured = False
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        loop_name = f"{type(loop).__module__}.{type(loop).__name__}"
+        loop_info_gauge.set(1, loop=loop_name)
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._sample())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Event loop monitor started on {loop_name}, sampling every {self.interval * 1000:.0f}ms, "
+                    f"stall threshold {self.stall_threshold * 1000:.0f}ms")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _sample(self):
+        while True:
+            scheduled = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_beat = now
+            lag = max(0.0, now - scheduled - self.interval)
+            loop_lag_histogram.observe(lag)
+            if lag >= self.stall_threshold:
+                loop_stall_counter.inc()
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+            self._stall_captured = False
+
+    def _watch(self):
+        # checks twice per threshold, a stall is caught at most half a threshold late
+        while not self._stop.wait(self.stall_threshold / 2):
+            blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked >= self.stall_threshold and not self._stall_captured:
+                self._stall_captured = True
+                self._capture(blocked)
+
+    def _capture(self, blocked: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        self.last_stall = {"at": time.time(), "blocked_ms": round(blocked * 1000), "stack": stack}
+        logger.warning(f"Event loop blocked for {blocked * 1000:.0f}ms so far, in:\n{stack}")
+
+
+loop_monitor = LoopLagMonitor()
@@ -1,3 +1,6 @@
+import asyncio
+import os
+import time
 import uuid
 from contextlib import asynccontextmanager
 from typing import Dict
@@ -7,18 +10,35 @@ import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Depends, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from app_config import (
     APP_SECURITY_TOKEN_EXPIRY_SECONDS,
+    APP_SECURITY_TOKEN_BULK_MAX,
     APP_WS_PORT,
     APP_ENV,
     APP_WS_TIMEOUT_SECONDS,
-    APP_WS_ALLOWED_ORIGIN
+    APP_WS_ALLOWED_ORIGIN,
+    APP_WS_WORKERS,
+    APP_WS_LOOP,
+    APP_WS_HTTP,
+    APP_LOOP_MONITOR_ENABLED,
+    APP_PROFILE_MAX_SECONDS
 )
+from connection_registry import connection_registry, CONTROL_ACTIONS
+from drain_manager import drain_manager
 from logging_util import get_logger
-from session_manager import session_redis_client, generate_session_token, verify_api_key, validate_token, \
-    get_client_ip_from_request
+from loop_monitor import loop_monitor
+from metrics_util import render_metrics
+from profiler import profiler, ProfileBusy, PROFILE_MODES, PROFILE_FORMATS
+from readiness import readiness, worker_components
+from session_manager import session_redis_client, session_redis_binary_client, generate_session_token, \
+    generate_session_tokens, verify_api_key, validate_token, get_client_ip_from_request
+from usage_meter import usage_meter
+from ws_connection import connection_reaper
+from ws_mux import websocket_mux_endpoint
 from ws_speech import websocket_speech_endpoint
+from server_runner import DrainingServer
 from ws_text import websocket_text_endpoint
 
 load_dotenv()
@@ -28,6 +48,8 @@ logger = get_logger("main")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Application starting up")
+    # lifespan runs in every worker after the fork, import time would be the gunicorn master's
+    app.state.started_at = time.time()
     try:
         await session_redis_client.ping()
         logger.info("Successfully connected to Redis")
@@ -37,8 +59,24 @@ async def lifespan(app: FastAPI):
     except redis.ConnectionError as e:
         logger.error(f"Failed to connect to Redis: {e}")
         raise
+    await connection_registry.start()
+    connection_reaper.start()
+    usage_meter.start()
+    if APP_LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    # models, detectors and TTS clients build in threads while the worker already answers /health/live;
+    # under gunicorn the master has loaded the models before the fork and only the clients are left
+    app.state.warm_up_task = asyncio.create_task(readiness.warm_up(worker_components()))
     yield
+    # normally already drained on SIGTERM, this covers other shutdown paths
+    await drain_manager.drain()
+    await connection_registry.stop()
+    await connection_reaper.stop()
+    await usage_meter.stop()
+    if APP_LOOP_MONITOR_ENABLED:
+        await loop_monitor.stop()
     await session_redis_client.close()
+    await session_redis_binary_client.close()
     logger.info("Application shutting down")
 
 
@@ -62,6 +100,7 @@ app.add_middleware(
 
 app.websocket("/speech-ws")(websocket_speech_endpoint)
 app.websocket("/text-ws")(websocket_text_endpoint)
+app.websocket("/mux-ws")(websocket_mux_endpoint)
 
 
 @app.post("/api/get_session_token")
@@ -88,6 +127,34 @@ async def get_session_token(request: Request, api_key: str = Depends(verify_api_
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+@app.post("/api/get_session_tokens")
+async def get_session_tokens(
+        request: Request,
+        count: int = Body(..., embed=True),
+        api_key: str = Depends(verify_api_key)
+) -> Dict[str, list | int]:
+    """
+    Issues count session tokens at once, each for a new session, for backends
+    that hand them out to their pages; one request and one redis round trip
+    instead of one per token.
+    """
+    if not 0 < count <= APP_SECURITY_TOKEN_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"count must be between 1 and {APP_SECURITY_TOKEN_BULK_MAX}")
+    client_ip = get_client_ip_from_request(request)
+    try:
+        tokens = await generate_session_tokens(count, client_ip)
+    except redis.RedisError as e:
+        logger.error(f"Redis access failed: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    except Exception as e:
+        logger.error(f"Session token generation failed: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {
+        "session_tokens": tokens,
+        "expires_in": APP_SECURITY_TOKEN_EXPIRY_SECONDS
+    }
+
+
 @app.post("/api/refresh_session_token")
 async def refresh_session_token(
         request: Request,
@@ -127,9 +194,133 @@ async def refresh_session_token(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+@app.post("/api/session_control")
+async def session_control(
+        session_id: str = Body(..., embed=True),
+        action: str = Body(..., embed=True),
+        message: Dict | None = Body(None, embed=True),
+        reason: str | None = Body(None, embed=True),
+        api_key: str = Depends(verify_api_key)
+) -> Dict[str, str | int]:
+    """
+    Targets the live websockets of a session on whichever node holds them:
+    disconnect (e.g. after revoking its token), cancel the in-flight answer,
+    or push a message frame.
+    """
+    if action not in CONTROL_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown action, expected one of {', '.join(CONTROL_ACTIONS)}")
+    payload = {}
+    if message is not None:
+        payload["message"] = message
+    if reason is not None:
+        payload["reason"] = reason
+    try:
+        delivered = await connection_registry.send_control(session_id, action, payload)
+    except redis.RedisError as e:
+        logger.error(f"Redis access failed: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    logger.info(f"AUDIT: session control {action} for session {session_id} delivered to {delivered} workers")
+    return {"session_id": session_id, "action": action, "delivered": delivered}
+
+
+@app.get("/api/usage/{session_id}")
+async def session_usage(session_id: str, api_key: str = Depends(verify_api_key)) -> Dict[str, str | int]:
+    """
+    Usage of a session so far: TTS characters, audio bytes and LLM turns. Counts
+    of other workers not flushed yet (APP_USAGE_FLUSH_SECONDS) are missing.
+    """
+    try:
+        usage = await usage_meter.usage(session_id)
+    except redis.RedisError as e:
+        logger.error(f"Redis access failed: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    return {"session_id": session_id, **usage}
+
+
+@app.post("/api/drain")
+async def drain(api_key: str = Depends(verify_api_key)) -> Dict[str, str | int]:
+    """
+    Starts draining this worker, e.g. from a preStop hook, without waiting for it to finish.
+    """
+    drain_manager.start()
+    logger.info(f"AUDIT: drain requested for worker {os.getpid()}")
+    return {"status": "draining", "worker_pid": os.getpid()}
+
+
+@app.post("/api/profile")
+async def profile(
+        mode: str = Body("wall", embed=True),
+        seconds: float = Body(10, embed=True),
+        output_format: str = Body("speedscope", embed=True, alias="format"),
+        interval_ms: int | None = Body(None, embed=True),
+        api_key: str = Depends(verify_api_key)
+):
+    """
+    Profiles the worker that gets the request for the given seconds: wall or cpu
+    stack samples as a speedscope file or collapsed stacks, or a tracemalloc diff
+    of the memory allocated and kept meanwhile (mode memory).
+    """
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode, expected one of {', '.join(PROFILE_MODES)}")
+    if output_format not in PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format, expected one of {', '.join(PROFILE_FORMATS)}")
+    if not 0 < seconds <= APP_PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {APP_PROFILE_MAX_SECONDS}")
+    if interval_ms is not None and interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+    logger.info(f"AUDIT: {mode} profile of {seconds}s requested for worker {os.getpid()}")
+    kwargs = {"interval": interval_ms / 1000} if interval_ms else {}
+    try:
+        result = await profiler.profile(mode, seconds, output_format, **kwargs)
+    except ProfileBusy:
+        raise HTTPException(status_code=409, detail="A profile is already running in this worker")
+    filename = f"profile-{os.getpid()}-{mode}"
+    if isinstance(result, str):
+        return PlainTextResponse(result, headers={"Content-Disposition": f'attachment; filename="{filename}.txt"'})
+    if mode != "memory":
+        filename += ".speedscope"
+    return JSONResponse(result, headers={"Content-Disposition": f'attachment; filename="{filename}.json"'})
+
+
+@app.get("/health/live")
+async def liveness_check(request: Request):
+    """
+    The worker's event loop is running. Restart the container only when this fails.
+    """
+    return {
+        "status": "alive",
+        "worker_pid": os.getpid(),
+        "uptime_seconds": int(time.time() - request.app.state.started_at)
+    }
+
+
+@app.get("/health/ready")
 @app.get("/health")
-async def health_check() -> Dict[str, str]:
-    return {"status": "healthy"}
+async def readiness_check(request: Request):
+    """
+    Whether this worker should get traffic: warmed up, redis reachable and not draining.
+    Dependency checks are cached for APP_HEALTH_CACHE_SECONDS.
+    """
+    report = await readiness.check()
+    if drain_manager.draining:
+        status = "draining"
+    else:
+        status = "healthy" if report["ready"] else "not_ready"
+    # answered by whichever worker got the request, pid tells them apart
+    body = {
+        "status": status,
+        "worker_pid": os.getpid(),
+        "uptime_seconds": int(time.time() - request.app.state.started_at),
+        "checks": report["checks"]
+    }
+    if status != "healthy":
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 
 async def main():
@@ -145,21 +336,27 @@ async def main():
         host=APP_WS_HOST,
         port=PORT,
         log_level="info",
-        workers=2 if APP_ENV != "dev" else 1,
         reload=APP_ENV == "dev",
-        timeout_keep_alive=APP_WS_TIMEOUT_SECONDS
+        timeout_keep_alive=APP_WS_TIMEOUT_SECONDS,
+        loop=APP_WS_LOOP,
+        http=APP_WS_HTTP
     )
-    server = uvicorn.Server(config)
+    server = DrainingServer(config)
 
-    logger.info(f"Starting server on {APP_WS_HOST}:{PORT} in {APP_ENV} mode with timeout {APP_WS_TIMEOUT_SECONDS}")
+    logger.info(f"Starting server on {APP_WS_HOST}:{PORT} in {APP_ENV} mode with timeout {APP_WS_TIMEOUT_SECONDS}, "
+                f"loop {APP_WS_LOOP}, http {APP_WS_HTTP}")
     await server.serve()
 
 
 if __name__ == "__main__":
-    import asyncio
-
     try:
-        asyncio.run(main())
+        if APP_WS_WORKERS > 1:
+            # uvicorn.Server.serve() only ever runs one process, use gunicorn for more
+            from server_runner import run_gunicorn
+
+            run_gunicorn()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Server shutdown requested")
     except Exception as e:
@@ -0,0 +1,203 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from app_config import APP_PROFILE_INTERVAL_MS, APP_PROFILE_MEMORY_TOP, APP_PROFILE_MEMORY_FRAMES
+from logging_util import get_logger
+
+logger = get_logger("profiler")
+
+PROFILE_MODES = ("wall", "cpu", "memory")
+PROFILE_FORMATS = ("speedscope", "collapsed")
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+class ProfileBusy(Exception):
+    """
+    A profile is already running in this worker.
+    """
+
+
+def _short_path(path: str) -> str:
+    marker = f"site-packages{os.sep}"
+    if marker in path:
+        return path.split(marker, 1)[1]
+    return os.path.basename(path)
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_qualname} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _thread_cpu_seconds(ident: int):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (OSError, AttributeError):
+        # the thread is gone, or the platform has no per-thread CPU clocks
+        return None
+
+
+class StackSampler:
+    """
+    Samples the stacks of every thread of the process from a thread of its
+    own, nothing is installed in the profiled code. In wall mode each stack
+    is weighted by the time since the previous sample, waiting included; in
+    cpu mode by the CPU time the thread used since then, so threads blocked
+    in I/O or an idle event loop drop out. Stacks are rooted at the thread
+    name, the event loop shows up as MainThread.
+    """
+
+    def __init__(self, mode: str = "wall", interval: float = APP_PROFILE_INTERVAL_MS / 1000):
+        self.mode = mode
+        self.interval = interval
+        # stack (root first) -> seconds
+        self.stacks = defaultdict(float)
+        self.samples = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def _stack(frame) -> tuple:
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        return tuple(names)
+
+    def run(self, seconds: float):
+        own = threading.get_ident()
+        thread_names = {}
+        cpu_seen = {}
+        started = previous = time.monotonic()
+        deadline = started + seconds
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            elapsed = now - previous
+            previous = now
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if self.mode == "cpu":
+                    used = _thread_cpu_seconds(ident)
+                    last = cpu_seen.get(ident)
+                    cpu_seen[ident] = used
+                    if used is None or last is None or used <= last:
+                        continue
+                    weight = used - last
+                elif self.samples:
+                    weight = elapsed
+                else:
+                    continue
+                if ident not in thread_names:
+                    thread_names.update((t.ident, t.name) for t in threading.enumerate())
+                self.stacks[(thread_names.get(ident, f"thread-{ident}"),) + self._stack(frame)] += weight
+            self.samples += 1
+            time.sleep(self.interval)
+        self.seconds = time.monotonic() - started
+
+    def collapsed(self) -> str:
+        """
+        Brendan Gregg's folded format, one "frame;frame;frame microseconds"
+        line per stack, for flamegraph.pl, speedscope or inferno.
+        """
+        lines = []
+        for stack, weight in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            micros = round(weight * 1_000_000)
+            if micros:
+                lines.append(f"{';'.join(name.replace(';', ':') for name in stack)} {micros}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str) -> dict:
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        for stack, weight in self.stacks.items():
+            micros = round(weight * 1_000_000)
+            if not micros:
+                continue
+            sample = []
+            for frame_name in stack:
+                if frame_name not in frame_index:
+                    frame_index[frame_name] = len(frames)
+                    frames.append({"name": frame_name})
+                sample.append(frame_index[frame_name])
+            samples.append(sample)
+            weights.append(micros)
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": name,
+            "exporter": "chatagent-ws",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{"type": "sampled", "name": name, "unit": "microseconds", "startValue": 0,
+                          "endValue": sum(weights), "samples": samples, "weights": weights}],
+        }
+
+
+def memory_diff(seconds: float, top: int = APP_PROFILE_MEMORY_TOP, frames: int = APP_PROFILE_MEMORY_FRAMES) -> dict:
+    """
+    Traces allocations for the given time and returns the call sites holding
+    the most memory allocated in that window and still alive at its end,
+    i.e. what the worker grew by. tracemalloc only runs during the window.
+    """
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "traceback")
+    return {
+        "seconds": seconds,
+        "traced_bytes": traced,
+        "peak_bytes": peak,
+        "top": [{"size_diff": stat.size_diff, "size": stat.size, "count_diff": stat.count_diff, "count": stat.count,
+                 "traceback": [f"{_short_path(frame.filename)}:{frame.lineno}" for frame in stat.traceback]}
+                for stat in stats[:top] if stat.size_diff > 0],
+    }
+
+
+class Profiler:
+    """
+    One profile at a time per worker, run in a thread so the event loop keeps
+    serving (and shows up in the samples) while it is being profiled.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    async def profile(self, mode: str, seconds: float, output_format: str = "speedscope",
+                      interval: float = APP_PROFILE_INTERVAL_MS / 1000):
+        """
+        Returns the collapsed stacks as text, or the speedscope file or the
+        memory diff as a dict.
+        """
+        if self._lock.locked():
+            raise ProfileBusy()
+        async with self._lock:
+            logger.info(f"Profiling worker {os.getpid()}: {mode} for {seconds}s")
+            if mode == "memory":
+                return await asyncio.to_thread(memory_diff, seconds)
+            sampler = StackSampler(mode, interval)
+            await asyncio.to_thread(sampler.run, seconds)
+            logger.info(f"Profile of worker {os.getpid()} done: {sampler.samples} samples, "
+                        f"{len(sampler.stacks)} stacks")
+            if output_format == "collapsed":
+                return sampler.collapsed()
+            return sampler.speedscope(f"chatagent-ws worker {os.getpid()} {mode}")
+
+
+profiler = Profiler()
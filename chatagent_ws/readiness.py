@@ -0,0 +1,120 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis.asyncio as redis
+
+from app_config import APP_HEALTH_CACHE_SECONDS, APP_HEALTH_CHECK_TIMEOUT_SECONDS
+from backend_limiter import chat_backend_guard, speech_backend_guard, OPEN
+from drain_manager import drain_manager
+from logging_util import get_logger
+from metrics_util import Gauge
+from session_manager import session_redis_client
+
+logger = get_logger("readiness")
+
+startup_component_gauge = Gauge("chatagent_startup_component_seconds", "Warm-up time of a startup component",
+                                ("component",))
+ready_gauge = Gauge("chatagent_ready", "1 when the worker reports ready")
+
+
+def model_components() -> dict:
+    """
+    Components safe to build before fork (no threads, sockets or channels
+    left behind), so the gunicorn master can warm them for all workers.
+    """
+    from language_util import warm_up_components
+    return warm_up_components()
+
+
+def worker_components() -> dict:
+    """
+    Everything a worker needs before it serves, TTS clients included.
+    """
+    from tts_provider import tts_router
+    components = model_components()
+    for provider in tts_router.active_providers():
+        components[f"tts_{provider.name}"] = provider.warm_up
+    return components
+
+
+class Readiness:
+    """
+    Tracks the startup warm-up of the heavy components and answers the
+    readiness probe: ready once every component is built, redis answers and
+    the worker isn't draining. Backend circuits are reported, not required,
+    a backend outage shouldn't take every worker out of rotation.
+    """
+
+    def __init__(self, redis_client: redis.Redis = session_redis_client):
+        self.redis_client = redis_client
+        self.components = {}
+        self.warm_up_done = False
+        self._cached = None
+        self._cached_at = 0.0
+        self._check_lock = asyncio.Lock()
+
+    def _run_component(self, name: str, build):
+        started = time.perf_counter()
+        status = {"ready": False}
+        self.components[name] = status
+        try:
+            build()
+            status["ready"] = True
+        except Exception as e:
+            logger.error(f"Warm-up of {name} failed: {e}")
+            status["error"] = str(e)
+        status["seconds"] = round(time.perf_counter() - started, 3)
+        startup_component_gauge.set(status["seconds"], component=name)
+
+    def warm_up_blocking(self, components: dict):
+        """
+        Builds the components on a thread pool and waits, for the gunicorn
+        master before it forks the workers.
+        """
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(components) or 1, thread_name_prefix="warm-up") as executor:
+            list(executor.map(lambda item: self._run_component(*item), components.items()))
+        logger.info(f"Warm-up of {len(components)} components took {time.perf_counter() - started:.2f}s")
+
+    async def warm_up(self, components: dict):
+        started = time.perf_counter()
+        await asyncio.gather(*(asyncio.to_thread(self._run_component, name, build)
+                               for name, build in components.items()))
+        self.warm_up_done = True
+        self._cached = None
+        timings = ", ".join(f"{name} {status['seconds']}s" for name, status in self.components.items())
+        logger.info(f"Warm-up of {len(components)} components took {time.perf_counter() - started:.2f}s: {timings}")
+
+    async def _check_redis(self) -> dict:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.redis_client.ping(), APP_HEALTH_CHECK_TIMEOUT_SECONDS)
+        except (redis.RedisError, asyncio.TimeoutError) as e:
+            return {"ok": False, "error": str(e) or type(e).__name__}
+        return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    async def check(self) -> dict:
+        """
+        Returns the readiness report, at most APP_HEALTH_CACHE_SECONDS old.
+        """
+        async with self._check_lock:
+            now = time.monotonic()
+            if self._cached is not None and now - self._cached_at < APP_HEALTH_CACHE_SECONDS:
+                return self._cached
+            warm_up_ok = self.warm_up_done and all(status["ready"] for status in self.components.values())
+            checks = {
+                "warm_up": {"ok": warm_up_ok, "components": dict(self.components)},
+                "redis": await self._check_redis(),
+            }
+            for guard in (chat_backend_guard, speech_backend_guard):
+                checks[f"backend_{guard.name}"] = {"ok": guard.breaker.state != OPEN,
+                                                   "circuit_state": guard.breaker.state, "required": False}
+            ready = warm_up_ok and checks["redis"]["ok"]
+            self._cached = {"ready": ready, "checks": checks}
+            self._cached_at = now
+            ready_gauge.set(1 if ready and not drain_manager.draining else 0)
+            return self._cached
+
+
+readiness = Readiness()
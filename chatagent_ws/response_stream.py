@@ -0,0 +1,149 @@
+import asyncio
+import json
+
+import redis.asyncio as redis
+from fastapi import WebSocket
+
+from app_config import APP_REPLAY_ENABLED, APP_REPLAY_TTL_SECONDS, APP_REPLAY_MAX_FRAMES, APP_REPLAY_WAIT_SECONDS
+from logging_util import get_logger
+from session_manager import session_redis_binary_client
+
+logger = get_logger("response_stream")
+
+FRAME_JSON = b"j"
+FRAME_BYTES = b"b"
+TERMINAL_FRAME_TYPES = ("response_end", "stream_error")
+
+
+def replay_key(session_id: str, endpoint: str) -> str:
+    return f"session/replay:{session_id}:{endpoint}"
+
+
+class ResponseStream:
+    """
+    Outbound answer frames of one websocket.
+
+    Every frame gets the next sequence number of the session: JSON frames
+    carry it as "seq", a binary audio frame takes the number just before its
+    audio_metadata frame. With APP_REPLAY_ENABLED the frames are also appended
+    to the session's replay stream, and a turn keeps running and recording
+    after the client is gone, so a reconnecting client can resume it.
+    Redis writes happen in a background pipeline, off the send path.
+    """
+    __slots__ = ("websocket", "key", "redis_client", "seq", "detached", "_pending", "_flush_task")
+
+    def __init__(self, websocket: WebSocket, session_id: str, endpoint: str,
+                 redis_client: redis.Redis = session_redis_binary_client):
+        self.websocket = websocket
+        self.key = replay_key(session_id, endpoint)
+        self.redis_client = redis_client
+        self.seq = None
+        self.detached = False
+        self._pending = []
+        self._flush_task = None
+
+    async def _next_seq(self) -> int:
+        if self.seq is None:
+            # continue the numbering of an earlier connection of the session
+            self.seq = await self._last_recorded_seq() if APP_REPLAY_ENABLED else 0
+        self.seq += 1
+        return self.seq
+
+    async def _last_recorded_seq(self) -> int:
+        try:
+            entries = await self.redis_client.xrevrange(self.key, count=1)
+        except redis.RedisError as e:
+            logger.error(f"Redis access failed: {e}")
+            return 0
+        return int(entries[0][1][b"s"]) if entries else 0
+
+    async def send_json(self, data: dict):
+        seq = await self._next_seq()
+        frame = {**data, "seq": seq}
+        if APP_REPLAY_ENABLED:
+            self._record(seq, FRAME_JSON, json.dumps(frame).encode("utf-8"), data.get("type") in TERMINAL_FRAME_TYPES)
+        await self._send(self.websocket.send_json, frame)
+
+    async def send_bytes(self, data: bytes):
+        seq = await self._next_seq()
+        if APP_REPLAY_ENABLED:
+            self._record(seq, FRAME_BYTES, data, False)
+        await self._send(self.websocket.send_bytes, data)
+
+    async def _send(self, send, payload):
+        if self.detached:
+            return
+        try:
+            await send(payload)
+        except Exception as e:
+            if not APP_REPLAY_ENABLED:
+                raise
+            # the rest of the answer is only recorded, for a resume from another connection
+            logger.info(f"client gone during answer, recording to {self.key} only: {e}")
+            self.detached = True
+
+    def _record(self, seq: int, kind: bytes, data: bytes, terminal: bool):
+        self._pending.append({"s": seq, "k": kind, "d": data, "t": int(terminal)})
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending:
+            entries, self._pending = self._pending, []
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for entry in entries:
+                        pipe.xadd(self.key, entry, maxlen=APP_REPLAY_MAX_FRAMES, approximate=True)
+                    pipe.expire(self.key, APP_REPLAY_TTL_SECONDS)
+                    await pipe.execute()
+            except redis.RedisError as e:
+                logger.error(f"Replay buffer write failed: {e}")
+
+    async def wait_flushed(self):
+        if self._flush_task is not None:
+            await self._flush_task
+
+
+async def resume_response_stream(stream: ResponseStream, last_seq: int):
+    """
+    Sends the frames recorded after last_seq to the stream's websocket, with
+    their original sequence numbers. If the answer is still being generated
+    (by this or another worker) the replay follows it until its
+    response_end/stream_error frame or APP_REPLAY_WAIT_SECONDS.
+    """
+    websocket = stream.websocket
+    if not APP_REPLAY_ENABLED:
+        await stream.send_json({"type": "stream_error", "text": "Resume not available"})
+        return
+    entries = await stream.redis_client.xrange(stream.key)
+    if not entries:
+        await stream.send_json({"type": "stream_error", "text": "Resume not available"})
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + APP_REPLAY_WAIT_SECONDS
+    last_id = None
+    recorded_seq = 0
+    terminal = False
+    replayed = 0
+    while True:
+        for entry_id, fields in entries:
+            last_id = entry_id
+            recorded_seq = int(fields[b"s"])
+            terminal = fields[b"t"] == b"1"
+            if recorded_seq <= last_seq:
+                continue
+            if fields[b"k"] == FRAME_BYTES:
+                await websocket.send_bytes(fields[b"d"])
+            else:
+                await websocket.send_text(fields[b"d"].decode("utf-8"))
+            replayed += 1
+        remaining = deadline - loop.time()
+        if terminal or remaining <= 0:
+            break
+        result = await stream.redis_client.xread({stream.key: last_id}, block=int(min(remaining, 1.0) * 1000),
+                                                 count=100)
+        entries = result[0][1] if result else []
+
+    stream.seq = max(stream.seq or 0, recorded_seq)
+    logger.info(f"resumed {stream.key} after seq {last_seq}: {replayed} frames, complete={terminal}")
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+
+from app_config import APP_TTS_BATCH_MIN_CHARS, APP_TTS_BATCH_MAX_CHARS, APP_TTS_BATCH_MAX_WAIT_MS
+
+# sentences ending like this are joined without a space
+CJK_SENTENCE_ENDINGS = ("。", "！", "？", "…", "」", "』")
+
+
+class SentenceBatcher:
+    """
+    Groups the sentences of an answer into TTS requests. The first sentence
+    goes out alone right away (time to first audio), later ones are merged
+    until the batch reaches min_chars, would pass max_chars, or has waited
+    max_wait seconds.
+    """
+
+    def __init__(self, min_chars: int = APP_TTS_BATCH_MIN_CHARS, max_chars: int = APP_TTS_BATCH_MAX_CHARS,
+                 max_wait: float = APP_TTS_BATCH_MAX_WAIT_MS / 1000):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_wait = max_wait
+        self.first = True
+        self.pending = ""
+        self.deadline = None
+
+    def add(self, sentence: str) -> list[str]:
+        """
+        Adds a complete sentence, returns the batches ready to synthesize.
+        """
+        sentence = sentence.strip()
+        if not sentence:
+            return []
+        if self.first:
+            self.first = False
+            return [sentence]
+
+        batches = []
+        if self.pending and len(self.pending) + 1 + len(sentence) > self.max_chars:
+            batches.append(self._take())
+        if self.pending:
+            separator = "" if self.pending.endswith(CJK_SENTENCE_ENDINGS) else " "
+            self.pending = f"{self.pending}{separator}{sentence}"
+        else:
+            self.pending = sentence
+            self.deadline = time.monotonic() + self.max_wait
+        if len(self.pending) >= self.min_chars:
+            batches.append(self._take())
+        return batches
+
+    def time_left(self) -> Optional[float]:
+        """
+        Seconds until the pending batch is due, None when nothing is pending.
+        """
+        if not self.pending:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def due(self) -> Optional[str]:
+        if self.pending and time.monotonic() >= self.deadline:
+            return self._take()
+        return None
+
+    def flush(self) -> Optional[str]:
+        return self._take() if self.pending else None
+
+    def _take(self) -> str:
+        batch, self.pending, self.deadline = self.pending, "", None
+        return batch
+
+
+async def chunks_with_deadline(chunks: AsyncIterator[str], batcher: SentenceBatcher) \
+        -> AsyncIterator[Optional[str]]:
+    """
+    Yields the chunks, and None whenever the batcher's pending batch comes due
+    while the next chunk is still on its way.
+    """
+    iterator = chunks.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({next_chunk}, timeout=batcher.time_left())
+            if not done:
+                yield None
+                continue
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                next_chunk = None
+                return
+            next_chunk = None
+            yield chunk
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
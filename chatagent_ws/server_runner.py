@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+import gunicorn_conf
+import uvicorn
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn.workers import UvicornWorker
+
+from app_config import APP_WS_LOOP, APP_WS_HTTP
+from drain_manager import drain_manager
+from logging_util import get_logger
+
+logger = get_logger("server_runner")
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    uvicorn server that drains connections on the first SIGTERM/SIGINT before
+    shutting down. A second signal exits right away.
+    """
+
+    def __init__(self, config: uvicorn.Config):
+        super().__init__(config)
+        self.drain_requested = False
+
+    def handle_exit(self, sig, frame):
+        if self.drain_requested or self.should_exit:
+            return super().handle_exit(sig, frame)
+        self.drain_requested = True
+        logger.info(f"Received signal {sig}, draining before shutdown")
+        # signal handlers run between bytecodes, hand over to the loop (and wake it up)
+        asyncio.get_event_loop().call_soon_threadsafe(self._start_drain, sig, frame)
+
+    def _start_drain(self, sig, frame):
+        # joins a drain already started through /api/drain
+        task = drain_manager.start()
+        task.add_done_callback(lambda _: super(DrainingServer, self).handle_exit(sig, frame))
+
+
+class ChatAgentUvicornWorker(UvicornWorker):
+    """
+    Gunicorn worker running the app on uvicorn. The arbiter restarts it when
+    it dies or stops heartbeating for longer than the gunicorn timeout.
+    """
+    CONFIG_KWARGS = {"loop": APP_WS_LOOP, "http": APP_WS_HTTP, "log_level": "info"}
+
+    async def _serve(self):
+        # same as UvicornWorker._serve, with the draining server
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+class ChatAgentApplication(BaseApplication):
+    """
+    Runs main:app under gunicorn with the settings from gunicorn_conf, so
+    `python main.py` and `gunicorn -c gunicorn_conf.py main:app` behave the same.
+    """
+
+    def load_config(self):
+        for key, value in vars(gunicorn_conf).items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def run_gunicorn():
+    logger.info(f"Starting gunicorn on {gunicorn_conf.bind} with {gunicorn_conf.workers} workers")
+    ChatAgentApplication().run()
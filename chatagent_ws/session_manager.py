@@ -1,10 +1,13 @@
+import hmac
 import json
 import secrets
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Annotated
 
 import redis.asyncio as redis
 import time
+import uuid
 from dotenv import load_dotenv
 from fastapi import HTTPException, Header, Request
 from starlette.websockets import WebSocket
@@ -16,6 +19,7 @@ from app_config import (
 )
 from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD, \
     APP_SECURITY_TOKEN_EXPIRY_SECONDS
+from app_config import APP_SESSION_LANGUAGE_TTL_SECONDS, APP_SESSION_LANGUAGE_CACHE_SIZE
 from logging_util import get_logger
 
 load_dotenv()
@@ -30,6 +34,19 @@ session_redis_client = redis.Redis(
     decode_responses=True
 )
 
+# same server, raw bytes in and out, for values holding audio
+session_redis_binary_client = redis.Redis(
+    host=APP_REDIS_HOST,
+    port=APP_REDIS_PORT,
+    db=APP_REDIS_DB,
+    password=APP_REDIS_PASSWORD,
+    decode_responses=False
+)
+
+# session_id -> language name, in front of the session/lang:{session_id} redis key
+session_language_cache = OrderedDict()
+
+
 def get_client_ip_from_websocket(websocket: WebSocket):
     try:
         headers = dict(websocket.scope["headers"])
@@ -58,22 +75,42 @@ def get_client_ip_from_request(request:Request):
     except Exception as e:
         return "unknown"
 
-async def generate_session_token(session_id: str, client_ip: str) -> str:
-    token = secrets.token_urlsafe(32)
-    token_key=f"session/token:{token}"
-    token_data = {
+def _token_data(session_id: str, client_ip: str) -> str:
+    return json.dumps({
         "expiry": (datetime.now() + timedelta(seconds=APP_SECURITY_TOKEN_EXPIRY_SECONDS)).isoformat(),
         "session_id": session_id,
         "ip": client_ip
-    }
+    })
+
+
+async def generate_session_token(session_id: str, client_ip: str) -> str:
+    token = secrets.token_urlsafe(32)
+    token_key=f"session/token:{token}"
     await session_redis_client.setex(
         token_key,
         APP_SECURITY_TOKEN_EXPIRY_SECONDS,
-        json.dumps(token_data)
+        _token_data(session_id, client_ip)
     )
     return token
 
 
+async def generate_session_tokens(count: int, client_ip: str) -> list[str]:
+    """
+    Issues count tokens, each for a new session, and counts them against the
+    client IP, all in one redis round trip.
+    """
+    tokens = [secrets.token_urlsafe(32) for _ in range(count)]
+    session_count_key = f"session/ip:{client_ip}"
+    async with session_redis_client.pipeline(transaction=False) as pipe:
+        for token in tokens:
+            pipe.setex(f"session/token:{token}", APP_SECURITY_TOKEN_EXPIRY_SECONDS,
+                       _token_data(str(uuid.uuid4()), client_ip))
+        pipe.incrby(session_count_key, count)
+        pipe.expire(session_count_key, APP_SECURITY_TOKEN_EXPIRY_SECONDS)
+        await pipe.execute()
+    return tokens
+
+
 async def check_rate_limits(client_ip: str, session_id: str) -> tuple[bool, str]:
     # disable rate limit since cant get web socket client ip
     # current_time = time.time()
@@ -116,9 +153,46 @@ async def validate_token(token: str, client_ip: str) -> tuple[bool, str]:
 
 async def verify_api_key(x_api_key: Annotated[str, Header()], request: Request):
     client_ip = request.client.host
-    logger.debug(f"x_api_key:{x_api_key}")
-    logger.debug(f"APP_WS_API_KEY:{APP_WS_API_KEY}")
-    if x_api_key != APP_WS_API_KEY:
+    # constant time, the comparison must not tell how much of a guessed key was right
+    if not hmac.compare_digest(x_api_key.encode("utf-8"), APP_WS_API_KEY.encode("utf-8")):
         logger.warning(f"AUDIT: Invalid APP_API_KEY from IP {client_ip}")
         raise HTTPException(status_code=401, detail="Invalid API Key")
     return x_api_key
+
+
+async def get_session_language(session_id: str):
+    """
+    Returns the language last used in this session, from the in-process cache
+    first and from Redis when the session moved here from another worker.
+    """
+    language_name = session_language_cache.get(session_id)
+    if language_name is not None:
+        session_language_cache.move_to_end(session_id)
+        return language_name
+    try:
+        language_name = await session_redis_client.get(f"session/lang:{session_id}")
+    except redis.RedisError as e:
+        logger.error(f"Redis access failed: {e}")
+        return None
+    if language_name:
+        _cache_session_language(session_id, language_name)
+    return language_name
+
+
+async def set_session_language(session_id: str, language_name: str):
+    # only write through to redis when the language of the session changes
+    if session_language_cache.get(session_id) == language_name:
+        session_language_cache.move_to_end(session_id)
+        return
+    _cache_session_language(session_id, language_name)
+    try:
+        await session_redis_client.setex(f"session/lang:{session_id}", APP_SESSION_LANGUAGE_TTL_SECONDS, language_name)
+    except redis.RedisError as e:
+        logger.error(f"Redis access failed: {e}")
+
+
+def _cache_session_language(session_id: str, language_name: str):
+    session_language_cache[session_id] = language_name
+    session_language_cache.move_to_end(session_id)
+    while len(session_language_cache) > APP_SESSION_LANGUAGE_CACHE_SIZE:
+        session_language_cache.popitem(last=False)
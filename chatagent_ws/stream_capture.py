@@ -0,0 +1,131 @@
+import asyncio
+import codecs
+import gzip
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from app_config import APP_STREAM_CAPTURE_DIR, APP_STREAM_CAPTURE_SAMPLE_RATE
+from logging_util import get_logger
+
+logger = get_logger("stream_capture")
+
+TRACE_FORMAT_VERSION = 1
+TRACE_FILE_SUFFIX = ".ndjson.gz"
+
+
+class StreamCapture:
+    """
+    Records the chunks of one upstream LLM stream together with their
+    inter-arrival times, so the stream can be replayed later with the
+    exact same splits and pacing.
+
+    Trace file layout (gzip'd NDJSON):
+        line 1: {"v": 1, "endpoint": "chat", "message": "...", "started": "...", "content_type": "..."}
+        line n: [delay_ms, "chunk text"]
+    delay_ms of the first chunk is the time to first byte from the request start.
+    Chunks are the decoded reads, framing (SSE, NDJSON) included, so
+    content_type tells how to parse them; it is missing in older traces.
+    """
+
+    def __init__(self, endpoint: str, message: str):
+        self.endpoint = endpoint
+        self.message = message
+        self.started = datetime.now().isoformat()
+        self.content_type: Optional[str] = None
+        self.events = []
+        self._last = time.perf_counter()
+
+    def record(self, chunk: str):
+        now = time.perf_counter()
+        self.events.append((round((now - self._last) * 1000, 1), chunk))
+        self._last = now
+
+    async def capture_reads(self, reads: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Yields the reads of an upstream response and records each one as it
+        arrives. A task of its own drains the response, so the recorded
+        delays are the upstream's pacing; a slow consumer (TTS, websocket
+        sends) only makes the reads queue up here. The queue holds at most one
+        answer, which the pipelines cap anyway.
+        """
+        queue = asyncio.Queue()
+        utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        async def drain():
+            try:
+                async for data in reads:
+                    text = utf8.decode(data)
+                    if text:
+                        self.record(text)
+                    queue.put_nowait(data)
+            except Exception as e:
+                queue.put_nowait(e)
+            else:
+                queue.put_nowait(None)
+
+        task = asyncio.create_task(drain())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _write(self, path: str):
+        header = {"v": TRACE_FORMAT_VERSION, "endpoint": self.endpoint, "message": self.message,
+                  "started": self.started}
+        if self.content_type:
+            header["content_type"] = self.content_type
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for delay_ms, chunk in self.events:
+                f.write(json.dumps([delay_ms, chunk], ensure_ascii=False) + "\n")
+
+    async def save(self):
+        if not self.events:
+            return
+        file_name = f"{self.endpoint}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}{TRACE_FILE_SUFFIX}"
+        path = os.path.join(APP_STREAM_CAPTURE_DIR, file_name)
+        try:
+            os.makedirs(APP_STREAM_CAPTURE_DIR, exist_ok=True)
+            await asyncio.to_thread(self._write, path)
+            logger.debug(f"stream capture saved: {path} ({len(self.events)} chunks)")
+        except Exception as e:
+            logger.error(f"Failed to save stream capture {path}: {e}")
+
+
+def open_stream_capture(endpoint: str, message: str) -> Optional[StreamCapture]:
+    """
+    Returns a StreamCapture when capture mode is on (APP_STREAM_CAPTURE_DIR set)
+    and this call is sampled, otherwise None so callers pay nothing per chunk.
+    """
+    if not APP_STREAM_CAPTURE_DIR:
+        return None
+    if APP_STREAM_CAPTURE_SAMPLE_RATE < 1.0 and random.random() >= APP_STREAM_CAPTURE_SAMPLE_RATE:
+        return None
+    return StreamCapture(endpoint, message)
+
+
+def load_trace(path: str) -> tuple[dict, list[tuple[float, str]]]:
+    """
+    Reads a trace written by StreamCapture.
+
+    Returns:
+        The header dict and the list of (delay_ms, chunk) events.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("v") != TRACE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported trace version {header.get('v')} in {path}")
+        events = [tuple(json.loads(line)) for line in f if line.strip()]
+    return header, events
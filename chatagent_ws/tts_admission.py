@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from app_config import APP_TTS_RATE_PER_SECOND, APP_TTS_BURST, APP_TTS_QUEUE_SIZE, APP_TTS_QUEUE_WAIT_SECONDS
+from logging_util import get_logger
+from metrics_util import Counter, Gauge, Histogram
+
+logger = get_logger("tts_admission")
+
+# lower is more urgent: the first sentence of a turn decides how long the user waits for audio
+PRIORITY_FIRST_SENTENCE = 0
+PRIORITY_NEXT_SENTENCE = 1
+
+tts_admission_counter = Counter("chatagent_tts_admission_total", "TTS synthesis admission decisions",
+                                ("priority", "result"))
+tts_queued_gauge = Gauge("chatagent_tts_queued", "Sentences waiting for a TTS token")
+tts_wait_histogram = Histogram("chatagent_tts_admission_wait_seconds", "Time waited for a TTS token", ("priority",))
+
+
+class TtsAdmission:
+    """
+    Token bucket in front of TTS synthesis, so a worker stays under its share
+    of the project's quota instead of getting quota errors. Requests that find
+    the bucket empty queue by priority (then arrival) for at most max_wait
+    seconds; acquire() returns False when a request is not admitted and the
+    caller should go without audio.
+    """
+
+    def __init__(self, rate: float = APP_TTS_RATE_PER_SECOND, burst: int = APP_TTS_BURST,
+                 max_queue: int = APP_TTS_QUEUE_SIZE, max_wait: float = APP_TTS_QUEUE_WAIT_SECONDS):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._waiters = []
+        self._order = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = PRIORITY_NEXT_SENTENCE) -> bool:
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            tts_admission_counter.inc(priority=priority, result="admitted")
+            return True
+        if len(self._waiters) >= self.max_queue:
+            tts_admission_counter.inc(priority=priority, result="queue_full")
+            return False
+
+        started = time.monotonic()
+        entry = (priority, next(self._order), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        tts_queued_gauge.set(len(self._waiters))
+        self._schedule()
+        try:
+            await asyncio.wait_for(entry[2], self.max_wait)
+        except asyncio.TimeoutError:
+            tts_admission_counter.inc(priority=priority, result="timeout")
+            return False
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            tts_queued_gauge.set(len(self._waiters))
+        tts_wait_histogram.observe(time.monotonic() - started, priority=priority)
+        tts_admission_counter.inc(priority=priority, result="admitted")
+        return True
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a token only if one is free right now and nobody is queued.
+        """
+        self._refill()
+        if self._waiters or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _schedule(self):
+        if self._timer is None:
+            self._dispatch()
+
+    def _dispatch(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        if self._waiters:
+            delay = (1 - self.tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def on_quota_exceeded(self):
+        # the provider disagrees with our count, empty the bucket to back off
+        logger.warning("TTS quota exceeded, emptying the admission bucket")
+        self._refill()
+        self.tokens = 0
+
+
+tts_admission = TtsAdmission()
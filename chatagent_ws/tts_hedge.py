@@ -0,0 +1,147 @@
+import asyncio
+import time
+from collections import deque
+
+from app_config import APP_TTS_HEDGE_ENABLED, APP_TTS_HEDGE_PERCENTILE, APP_TTS_HEDGE_BUDGET, \
+    APP_TTS_HEDGE_MIN_SAMPLES
+from logging_util import get_logger
+from metrics_util import Counter, Histogram
+from tts_admission import tts_admission
+
+logger = get_logger("tts_hedge")
+
+tts_synthesis_histogram = Histogram("chatagent_tts_synthesis_seconds", "TTS synthesis latency seen by the turn",
+                                    ("hedged",))
+tts_hedge_counter = Counter("chatagent_tts_hedge_total", "Synthesis calls by hedging outcome", ("result",))
+tts_hedge_saved_histogram = Histogram("chatagent_tts_hedge_saved_seconds",
+                                      "Latency saved when the hedge request won")
+
+
+class LatencyTracker:
+    """
+    Recent synthesis latencies per voice, for the hedging delay.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = APP_TTS_HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+
+    def record(self, key: str, latency: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(latency)
+
+    def percentile(self, key: str, percentile: float):
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class HedgeBudget:
+    """
+    Caps hedges at `ratio` of all calls: every call earns ratio of a token, a
+    hedge spends one. `burst` bounds the savings from quiet periods.
+    """
+
+    def __init__(self, ratio: float = APP_TTS_HEDGE_BUDGET, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def on_call(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class HedgedSynthesizer:
+    """
+    Runs blocking synthesis calls in threads. With hedging enabled, a call
+    still running after the voice's APP_TTS_HEDGE_PERCENTILE latency gets a
+    duplicate (if the budget allows, and the TTS admission bucket for an
+    engine that is rate limited) and the first result wins. The losing call
+    is left to finish in its thread.
+    """
+
+    def __init__(self, enabled: bool = APP_TTS_HEDGE_ENABLED, percentile: float = APP_TTS_HEDGE_PERCENTILE,
+                 tracker: LatencyTracker = None, budget: HedgeBudget = None):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.tracker = tracker or LatencyTracker()
+        self.budget = budget or HedgeBudget()
+
+    def _start(self, key: str, synthesize):
+        started = time.monotonic()
+        task = asyncio.ensure_future(asyncio.to_thread(synthesize))
+
+        def record(done):
+            if not done.cancelled() and done.exception() is None:
+                self.tracker.record(key, time.monotonic() - started)
+
+        task.add_done_callback(record)
+        return task
+
+    async def synthesize(self, key: str, synthesize, rate_limited: bool = True):
+        """
+        Returns synthesize() for a voice `key`, possibly from a hedge request.
+        A hedge to a rate_limited engine takes a TTS admission token, and is
+        skipped when none is free.
+        """
+        started = time.monotonic()
+        self.budget.on_call()
+        primary = self._start(key, synthesize)
+        delay = self.tracker.percentile(key, self.percentile) if self.enabled else None
+        if delay is None:
+            result = await primary
+            tts_synthesis_histogram.observe(time.monotonic() - started, hedged="false")
+            return result
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            tts_synthesis_histogram.observe(time.monotonic() - started, hedged="false")
+            return primary.result()
+        if not self.budget.try_spend() or (rate_limited and not tts_admission.try_acquire()):
+            tts_hedge_counter.inc(result="skipped")
+            result = await primary
+            tts_synthesis_histogram.observe(time.monotonic() - started, hedged="false")
+            return result
+
+        hedge = self._start(key, synthesize)
+        tts_hedge_counter.inc(result="sent")
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                break
+        else:
+            # both failed, report the primary's error
+            tts_synthesis_histogram.observe(time.monotonic() - started, hedged="true")
+            return primary.result()
+
+        finished = time.monotonic()
+        tts_synthesis_histogram.observe(finished - started, hedged="true")
+        if winner is hedge:
+            tts_hedge_counter.inc(result="won")
+            if primary.done():
+                tts_hedge_saved_histogram.observe(0)
+            else:
+                # the primary's own latency is only known once it is done
+                primary.add_done_callback(lambda _: tts_hedge_saved_histogram.observe(time.monotonic() - finished))
+        else:
+            tts_hedge_counter.inc(result="lost")
+        for task in pending:
+            # retrieves the exception of a failed loser so asyncio doesn't log it
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return winner.result()
+
+
+hedged_synthesizer = HedgedSynthesizer()
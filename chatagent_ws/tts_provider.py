@@ -0,0 +1,186 @@
+import hashlib
+import shlex
+from abc import ABC, abstractmethod
+import subprocess
+import threading
+
+from app_config import APP_TTS_PROVIDER, APP_TTS_PROVIDER_ROUTES, APP_TTS_SHORT_TEXT_PROVIDER, \
+    APP_TTS_SHORT_TEXT_MAX_CHARS, APP_TTS_LOCAL_COMMAND, APP_TTS_LOCAL_FORMAT, APP_TTS_LOCAL_TIMEOUT_SECONDS
+from logging_util import get_logger
+
+logger = get_logger("tts_provider")
+
+
+class TtsQuotaExceeded(Exception):
+    """
+    The engine refused the request for quota reasons, the sentence goes out
+    without audio.
+    """
+
+
+class TtsEngineError(Exception):
+    """
+    The engine failed (crashed, missing, timed out), the sentence goes out
+    without audio.
+    """
+
+
+class TtsProvider(ABC):
+    """
+    A TTS engine. synthesize() blocks and is run in a worker thread; voices
+    come from get_voice_code_name_by_language_name and each engine maps them
+    to its own.
+    """
+    name = ""
+    audio_format = "mp3"
+    # counts against the per worker TTS admission bucket
+    rate_limited = False
+
+    def voice_for(self, voice_code: str, voice_name: str) -> str:
+        return voice_name
+
+    @abstractmethod
+    def synthesize(self, text: str, voice_code: str, voice: str, speaking_rate: float = 1.0) -> bytes:
+        pass
+
+    def warm_up(self):
+        """
+        Builds clients or loads engines ahead of the first request.
+        """
+
+
+class GoogleTtsProvider(TtsProvider):
+    name = "google"
+    audio_format = "mp3"
+    rate_limited = True
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        # created on first use in each worker process, a gRPC channel must not be shared across fork
+        with self._lock:
+            if self._client is None:
+                from google.cloud import texttospeech
+                self._client = texttospeech.TextToSpeechClient()
+        return self._client
+
+    def warm_up(self):
+        self._get_client()
+
+    def synthesize(self, text: str, voice_code: str, voice: str, speaking_rate: float = 1.0) -> bytes:
+        from google.api_core.exceptions import ResourceExhausted
+        from google.cloud import texttospeech
+
+        try:
+            response = self._get_client().synthesize_speech(
+                input=texttospeech.SynthesisInput(text=text),
+                voice=texttospeech.VoiceSelectionParams(language_code=voice_code, name=voice),
+                audio_config=texttospeech.AudioConfig(
+                    # audio_encoding=texttospeech.AudioEncoding.LINEAR16,  # Uncompressed 16-bit PCM
+                    # sample_rate_hertz=24000,
+                    audio_encoding=texttospeech.AudioEncoding.MP3,
+                    speaking_rate=speaking_rate,
+                    pitch=0.0
+                )
+            )
+        except ResourceExhausted as e:
+            raise TtsQuotaExceeded(str(e)) from e
+        return response.audio_content
+
+
+# espeak-ng voices by the language part of the voice code
+LOCAL_VOICES = {"en": "en-us", "fr": "fr-fr", "es": "es", "de": "de", "cmn": "cmn", "zh": "cmn", "ja": "ja",
+                "jp": "ja", "ko": "ko", "ru": "ru", "hi": "hi"}
+
+
+class LocalTtsProvider(TtsProvider):
+    """
+    Offline engine run as a subprocess per request: APP_TTS_LOCAL_COMMAND
+    gets the text on stdin and writes the audio (APP_TTS_LOCAL_FORMAT) to
+    stdout. No network round trip, so it suits short system phrases.
+    """
+    name = "local"
+
+    def __init__(self, command: str = APP_TTS_LOCAL_COMMAND, audio_format: str = APP_TTS_LOCAL_FORMAT,
+                 timeout: float = APP_TTS_LOCAL_TIMEOUT_SECONDS):
+        self.command = command
+        self.audio_format = audio_format
+        self.timeout = timeout
+
+    def voice_for(self, voice_code: str, voice_name: str) -> str:
+        return LOCAL_VOICES.get(voice_code.split("-")[0].lower(), "en-us")
+
+    def synthesize(self, text: str, voice_code: str, voice: str, speaking_rate: float = 1.0) -> bytes:
+        # espeak-ng speaks 175 words per minute by default
+        args = [arg.format(voice=voice, rate=speaking_rate, wpm=int(175 * speaking_rate))
+                for arg in shlex.split(self.command)]
+        try:
+            result = subprocess.run(args, input=text.encode("utf-8"), capture_output=True, timeout=self.timeout,
+                                    check=True)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode("utf-8", errors="replace").strip()
+            raise TtsEngineError(f"{args[0]} exited with {e.returncode}: {stderr}") from e
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise TtsEngineError(f"{args[0]} failed: {e}") from e
+        return result.stdout
+
+
+class FakeTtsProvider(TtsProvider):
+    """
+    Deterministic audio for tests and load tests: the same text and voice
+    always give the same bytes, with no credentials or engine needed.
+    """
+    name = "fake"
+    audio_format = "fake"
+
+    def synthesize(self, text: str, voice_code: str, voice: str, speaking_rate: float = 1.0) -> bytes:
+        digest = hashlib.sha256(f"{voice_code}\0{voice}\0{speaking_rate:.2f}\0{text}".encode("utf-8")).digest()
+        return b"FAKE" + digest[:8] + text.encode("utf-8")
+
+
+def parse_routes(routes: str) -> dict:
+    # "KOREAN:local, RUSSIAN:local" -> {"KOREAN": "local", "RUSSIAN": "local"}
+    parsed = {}
+    for route in routes.split(","):
+        if ":" in route:
+            language_name, provider_name = route.split(":", 1)
+            parsed[language_name.strip().upper()] = provider_name.strip()
+    return parsed
+
+
+class TtsRouter:
+    """
+    Picks the engine for a text: short texts go to the short text engine
+    when configured, otherwise the route for the language or the default.
+    """
+
+    def __init__(self, providers: dict, default: str = APP_TTS_PROVIDER, routes: str = APP_TTS_PROVIDER_ROUTES,
+                 short_text_provider: str = APP_TTS_SHORT_TEXT_PROVIDER,
+                 short_text_max_chars: int = APP_TTS_SHORT_TEXT_MAX_CHARS):
+        self.providers = providers
+        self.default = default
+        self.routes = parse_routes(routes)
+        self.short_text_provider = short_text_provider
+        self.short_text_max_chars = short_text_max_chars
+        for name in [default, short_text_provider, *self.routes.values()]:
+            if name and name not in providers:
+                logger.error(f"Unknown TTS provider {name}, using {default}")
+
+    def _get(self, name: str) -> TtsProvider:
+        return self.providers.get(name) or self.providers.get(self.default) or self.providers["google"]
+
+    def active_providers(self) -> list:
+        names = {self.default, *self.routes.values()}
+        if self.short_text_max_chars:
+            names.add(self.short_text_provider)
+        return [self._get(name) for name in sorted(names)]
+
+    def provider_for(self, language_name: str, text: str) -> TtsProvider:
+        if self.short_text_max_chars and len(text) <= self.short_text_max_chars:
+            return self._get(self.short_text_provider)
+        return self._get(self.routes.get((language_name or "").upper(), self.default))
+
+
+tts_router = TtsRouter({"google": GoogleTtsProvider(), "local": LocalTtsProvider(), "fake": FakeTtsProvider()})
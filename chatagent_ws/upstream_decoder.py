@@ -0,0 +1,225 @@
+import codecs
+import json
+from typing import NamedTuple, Optional
+
+from logging_util import get_logger
+
+logger = get_logger("upstream_decoder")
+
+EVENT_TEXT = "text"
+EVENT_DONE = "done"
+EVENT_ERROR = "error"
+EVENT_CONTROL = "control"
+
+FRAMING_PLAIN = "plain"
+FRAMING_SSE = "sse"
+FRAMING_NDJSON = "ndjson"
+
+DONE_SENTINEL = "[DONE]"
+ERROR_MARKER = "Error:"
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/jsonlines")
+
+
+class UpstreamEvent(NamedTuple):
+    """
+    One event of an upstream answer: a piece of answer text, the end of the
+    answer, an error, or a control tag (tag is its name, text its value).
+    """
+    kind: str
+    text: str = ""
+    tag: Optional[str] = None
+
+
+DONE_EVENT = UpstreamEvent(EVENT_DONE)
+
+
+def framing_for(content_type: Optional[str]) -> str:
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    if media_type == "text/event-stream":
+        return FRAMING_SSE
+    if media_type in NDJSON_CONTENT_TYPES:
+        return FRAMING_NDJSON
+    return FRAMING_PLAIN
+
+
+def _held_marker_len(text: str) -> int:
+    # length of the longest suffix that could still grow into a marker
+    for size in range(min(len(ERROR_MARKER), len(text)), 0, -1):
+        tail = text[-size:]
+        if DONE_SENTINEL.startswith(tail) or ERROR_MARKER.startswith(tail):
+            return size
+    return 0
+
+
+class UpstreamDecoder:
+    """
+    Turns the raw bytes of an upstream answer into events, whatever the
+    network splits look like. UTF-8 is decoded incrementally, so a character
+    split across reads comes out whole. The framing follows the response
+    content type:
+
+    - sse (text/event-stream): "data:" lines up to a blank line make an
+      event, "event: error|control|done" types it, "data: [DONE]" ends;
+    - ndjson: one JSON object per line, {"type": "text", "text": "..."},
+      {"type": "control", "name": "language-name", "value": "french"},
+      {"type": "error", "text": "..."} or {"type": "done"};
+    - plain: the answer text as is, with the "[DONE]" sentinel and "Error:"
+      found anywhere in it, glued to text or split across reads.
+
+    Lines are only joined once they are complete, a read is never appended
+    to the text that came before it.
+    """
+
+    def __init__(self, framing: str = FRAMING_PLAIN):
+        self.framing = framing
+        self.done = False
+        self._utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # sse / ndjson: fragments of the line still being received
+        self._line = []
+        # sse: the event being assembled
+        self._event_type = ""
+        self._data = []
+        # plain: a held back tail that may be the start of a marker
+        self._held = ""
+
+    def _parse(self, text: str) -> list[UpstreamEvent]:
+        # the events completed by the next piece of decoded text, nothing after the done event
+        if self.done or not text:
+            return []
+        if self.framing == FRAMING_PLAIN:
+            return self._parse_plain(text)
+        events = []
+        start = 0
+        while not self.done:
+            end = text.find("\n", start)
+            if end < 0:
+                if start < len(text):
+                    self._line.append(text[start:])
+                break
+            if self._line:
+                self._line.append(text[start:end])
+                line = "".join(self._line)
+                self._line = []
+            else:
+                line = text[start:end]
+            self._parse_line(line.removesuffix("\r"), events)
+            start = end + 1
+        return events
+
+    def feed(self, data: bytes) -> list[UpstreamEvent]:
+        """
+        Returns the events completed by the next read of the response.
+        """
+        return self._parse(self._utf8.decode(data))
+
+    def finish(self) -> list[UpstreamEvent]:
+        """
+        Returns the events still pending at the end of the stream: a last
+        line without a newline, an sse event without its blank line, or
+        held back plain text.
+        """
+        events = self._parse(self._utf8.decode(b"", final=True))
+        if self.done:
+            return events
+        if self.framing == FRAMING_PLAIN:
+            if self._held:
+                events.append(UpstreamEvent(EVENT_TEXT, self._held))
+                self._held = ""
+            return events
+        if self._line:
+            line = "".join(self._line)
+            self._line = []
+            self._parse_line(line.removesuffix("\r"), events)
+        if self.framing == FRAMING_SSE and not self.done:
+            self._dispatch_sse(events)
+        return events
+
+    def _parse_plain(self, text: str) -> list[UpstreamEvent]:
+        if self._held:
+            # the held tail is at most a few characters, only then is anything joined to the new text
+            text = self._held + text
+            self._held = ""
+        events = []
+        done_at = text.find(DONE_SENTINEL)
+        error_at = text.find(ERROR_MARKER)
+        if error_at >= 0 and (done_at < 0 or error_at < done_at):
+            if error_at:
+                events.append(UpstreamEvent(EVENT_TEXT, text[:error_at]))
+            message = text[error_at:] if done_at < 0 else text[error_at:done_at]
+            events.append(UpstreamEvent(EVENT_ERROR, message.strip()))
+            self.done = True
+            return events
+        if done_at >= 0:
+            if done_at:
+                events.append(UpstreamEvent(EVENT_TEXT, text[:done_at]))
+            events.append(DONE_EVENT)
+            self.done = True
+            return events
+        held_len = _held_marker_len(text)
+        if held_len:
+            self._held = text[-held_len:]
+            text = text[:-held_len]
+        if text:
+            events.append(UpstreamEvent(EVENT_TEXT, text))
+        return events
+
+    def _parse_line(self, line: str, events: list):
+        if self.framing == FRAMING_SSE:
+            self._parse_sse_line(line, events)
+        elif line.strip():
+            self._parse_ndjson_line(line, events)
+
+    def _parse_sse_line(self, line: str, events: list):
+        if not line:
+            self._dispatch_sse(events)
+            return
+        if line.startswith(":"):
+            # comment, e.g. a keep-alive
+            return
+        field, _, value = line.partition(":")
+        value = value.removeprefix(" ")
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event_type = value
+
+    def _dispatch_sse(self, events: list):
+        event_type = self._event_type or "message"
+        data = "\n".join(self._data)
+        had_data = bool(self._data)
+        self._event_type = ""
+        self._data = []
+        if event_type == "done" or (event_type == "message" and data == DONE_SENTINEL):
+            events.append(DONE_EVENT)
+            self.done = True
+        elif event_type == "error":
+            events.append(UpstreamEvent(EVENT_ERROR, data))
+            self.done = True
+        elif event_type == "control":
+            name, _, value = data.partition(":")
+            events.append(UpstreamEvent(EVENT_CONTROL, value.strip(), name.strip()))
+        elif had_data and data:
+            events.append(UpstreamEvent(EVENT_TEXT, data))
+
+    def _parse_ndjson_line(self, line: str, events: list):
+        try:
+            frame = json.loads(line)
+        except ValueError:
+            logger.warning(f"Malformed upstream frame: {line[:200]}")
+            events.append(UpstreamEvent(EVENT_ERROR, "Error: malformed upstream frame"))
+            self.done = True
+            return
+        if not isinstance(frame, dict):
+            return
+        event_type = frame.get("type", EVENT_TEXT)
+        if event_type == EVENT_DONE:
+            events.append(DONE_EVENT)
+            self.done = True
+        elif event_type == EVENT_ERROR:
+            events.append(UpstreamEvent(EVENT_ERROR, str(frame.get("text", ""))))
+            self.done = True
+        elif event_type == EVENT_CONTROL:
+            events.append(UpstreamEvent(EVENT_CONTROL, str(frame.get("value", "")), frame.get("name")))
+        elif event_type == EVENT_TEXT and frame.get("text"):
+            events.append(UpstreamEvent(EVENT_TEXT, str(frame["text"])))
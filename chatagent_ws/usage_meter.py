@@ -0,0 +1,173 @@
+import asyncio
+import collections
+from typing import Optional
+
+import redis.asyncio as redis
+
+from app_config import APP_USAGE_FLUSH_SECONDS, APP_USAGE_TTL_SECONDS, APP_USAGE_MAX_TTS_CHARS, \
+    APP_USAGE_MAX_AUDIO_BYTES, APP_USAGE_MAX_LLM_TURNS
+from logging_util import get_logger
+from metrics_util import Counter
+from session_manager import session_redis_client
+
+logger = get_logger("usage_meter")
+
+TTS_CHARS = "tts_chars"
+AUDIO_BYTES = "audio_bytes"
+LLM_TURNS = "llm_turns"
+USAGE_FIELDS = (TTS_CHARS, AUDIO_BYTES, LLM_TURNS)
+
+usage_counter = Counter("chatagent_usage_total", "Usage counted for sessions, by kind", ("kind",))
+usage_flush_counter = Counter("chatagent_usage_flushes_total", "Usage flushes to redis, by result", ("result",))
+
+
+class UsageMeter:
+    """
+    Per-session usage: TTS characters and audio bytes spoken, LLM turns.
+    Recording is a dict update, nothing waits for redis on the hot path; the
+    counts pile up in process and are added to the session/usage:{session_id}
+    hash with one pipeline of HINCRBYs every flush_seconds, and for a session
+    when its last connection on the worker closes.
+
+    Quotas are checked against local totals: what redis had for the session
+    when it connected here (read once) plus what this worker counted since.
+    Usage of the same session on other workers meanwhile shows up on its next
+    connection, a quota may be overrun by that much.
+    """
+
+    def __init__(self, redis_client: redis.Redis, flush_seconds: float = APP_USAGE_FLUSH_SECONDS,
+                 ttl_seconds: int = APP_USAGE_TTL_SECONDS, quotas: Optional[dict] = None):
+        self.redis_client = redis_client
+        self.flush_seconds = flush_seconds
+        self.ttl_seconds = ttl_seconds
+        if quotas is None:
+            quotas = {TTS_CHARS: APP_USAGE_MAX_TTS_CHARS, AUDIO_BYTES: APP_USAGE_MAX_AUDIO_BYTES,
+                      LLM_TURNS: APP_USAGE_MAX_LLM_TURNS}
+        # 0 means unlimited
+        self.quotas = {field: limit for field, limit in quotas.items() if limit > 0}
+        # session_id -> collections.Counter of counts not in redis yet
+        self.pending = {}
+        # session_id -> collections.Counter of the session's usage as far as this worker knows, for quotas
+        self.totals = {}
+        # session_id -> open connections on this worker
+        self._connections = collections.Counter()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"session/usage:{session_id}"
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def record(self, session_id: str, **counts: int):
+        """
+        Counts usage of a session, e.g. record(session_id, tts_chars=42, audio_bytes=8192).
+        """
+        pending = self.pending.get(session_id)
+        if pending is None:
+            pending = self.pending[session_id] = collections.Counter()
+        pending.update(counts)
+        if self.quotas:
+            self.totals.setdefault(session_id, collections.Counter()).update(counts)
+        for field, count in counts.items():
+            usage_counter.inc(count, kind=field)
+
+    def exceeded(self, session_id: str, fields: tuple = USAGE_FIELDS) -> Optional[str]:
+        """
+        Returns the first of the fields whose quota the session has used up, None if there is none.
+        """
+        totals = self.totals.get(session_id)
+        if totals is None:
+            return None
+        for field in fields:
+            limit = self.quotas.get(field)
+            if limit is not None and totals[field] >= limit:
+                return field
+        return None
+
+    async def open(self, session_id: str):
+        """
+        A connection of the session opened on this worker. With quotas the
+        usage so far is read from redis, once per session and worker.
+        """
+        self._connections[session_id] += 1
+        if not self.quotas or self._connections[session_id] > 1:
+            return
+        try:
+            stored = await self.redis_client.hgetall(self._key(session_id))
+        except redis.RedisError as e:
+            logger.error(f"Redis access failed: {e}")
+            return
+        totals = self.totals.setdefault(session_id, collections.Counter())
+        totals.update({field: int(value) for field, value in stored.items() if field in USAGE_FIELDS})
+
+    async def close(self, session_id: str):
+        """
+        A connection of the session closed. The session's counts are flushed
+        when it was the last one on this worker.
+        """
+        self._connections[session_id] -= 1
+        if self._connections[session_id] > 0:
+            return
+        del self._connections[session_id]
+        self.totals.pop(session_id, None)
+        if session_id in self.pending:
+            await self.flush([session_id])
+
+    async def flush(self, session_ids: Optional[list] = None):
+        """
+        Adds the pending counts of the given sessions, or of all sessions, to
+        redis in one pipeline. Counts that fail to flush are kept for the next one.
+        """
+        if session_ids is None:
+            batch, self.pending = self.pending, {}
+            # sessions counted without a connection here, e.g. by a mux stream's own token
+            for session_id in [session_id for session_id in self.totals if session_id not in self._connections]:
+                del self.totals[session_id]
+        else:
+            batch = {session_id: self.pending.pop(session_id) for session_id in session_ids
+                     if session_id in self.pending}
+        if not batch:
+            return
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for session_id, counts in batch.items():
+                    key = self._key(session_id)
+                    for field, count in counts.items():
+                        if count:
+                            pipe.hincrby(key, field, count)
+                    pipe.expire(key, self.ttl_seconds)
+                await pipe.execute()
+            usage_flush_counter.inc(result="ok")
+        except redis.RedisError as e:
+            usage_flush_counter.inc(result="error")
+            logger.error(f"Usage flush of {len(batch)} sessions failed: {e}")
+            for session_id, counts in batch.items():
+                self.pending.setdefault(session_id, collections.Counter()).update(counts)
+
+    async def usage(self, session_id: str) -> dict:
+        """
+        Returns the usage of a session: what redis has plus this worker's
+        counts not flushed yet. Other workers' counts arrive with their next flush.
+        """
+        stored = await self.redis_client.hgetall(self._key(session_id))
+        usage = {field: int(stored.get(field, 0)) for field in USAGE_FIELDS}
+        for field, count in self.pending.get(session_id, {}).items():
+            usage[field] += count
+        return usage
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+
+usage_meter = UsageMeter(session_redis_client)
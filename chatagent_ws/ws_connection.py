@@ -0,0 +1,407 @@
+import asyncio
+import functools
+import json
+from typing import Optional
+from urllib.parse import parse_qs
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from app_config import APP_WS_IDLE_TIMEOUT_SECONDS, APP_WS_HEARTBEAT_SECONDS, APP_WS_HEARTBEAT_MISSED_PONGS, \
+    APP_WS_SILENT_TIMEOUT_SECONDS, APP_WS_DEAD_PEER_KEEP_TURNS, APP_REPLAY_ENABLED
+from connection_registry import connection_registry, LocalConnection, run_turn
+from drain_manager import drain_manager, reconnect_hint_frame
+from logging_util import get_logger
+from metrics_util import Counter, Gauge, Histogram
+from response_stream import ResponseStream, resume_response_stream
+from session_manager import validate_token, check_rate_limits, get_client_ip_from_websocket
+from usage_meter import usage_meter, LLM_TURNS
+
+logger = get_logger("ws_connection")
+
+dead_peer_counter = Counter("chatagent_ws_dead_peers_total", "Connections closed for unanswered heartbeats",
+                            ("endpoint",))
+dead_peer_detect_histogram = Histogram("chatagent_ws_dead_peer_detect_seconds",
+                                       "Time from the last message of a dead peer until it was detected",
+                                       ("endpoint",), buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600))
+
+
+def parse_last_seq(data: dict) -> Optional[int]:
+    """
+    The last_seq of a resume message, None when it isn't a sequence number.
+    """
+    try:
+        last_seq = int(data.get("last_seq", 0))
+    except (TypeError, ValueError):
+        return None
+    return last_seq if last_seq >= 0 else None
+
+
+class Connection(LocalConnection):
+    """
+    State of one accepted websocket, shared by every endpoint: the session it
+    authenticated as, the client address, when the client last sent input
+    and last sent anything (heartbeat pongs included), unanswered pings,
+    message and turn counters and the outbound answer stream.
+    Slotted, a worker holds thousands of these while they sit idle.
+
+    serve() runs the lifecycle every endpoint shares; an endpoint subclasses
+    this and fills in on_open, on_message and on_close.
+    """
+    __slots__ = ("client_ip", "last_activity", "last_seen", "unanswered_pings", "heartbeat_acked", "messages",
+                 "turns", "stream")
+
+    def __init__(self, websocket: WebSocket, endpoint: str):
+        super().__init__(None, websocket, endpoint)
+        self.client_ip = get_client_ip_from_websocket(websocket)
+        self.last_activity = self.last_seen = asyncio.get_running_loop().time()
+        self.unanswered_pings = 0
+        # clients that never answered a ping may not speak the heartbeat, they get APP_WS_SILENT_TIMEOUT_SECONDS
+        self.heartbeat_acked = False
+        self.messages = 0
+        self.turns = 0
+        self.stream: Optional[ResponseStream] = None
+
+    @property
+    def authenticated(self) -> bool:
+        return self.session_id is not None
+
+    async def send_json(self, data: dict):
+        # numbered and recorded like the answers around it, a resume finds it
+        if self.stream is not None:
+            await self.stream.send_json(data)
+        else:
+            await self.websocket.send_json(data)
+
+    async def send_signal(self, data: dict):
+        """
+        Sends a frame outside the answers: heartbeat pings and pongs, a
+        rejected message. Not numbered and never recorded for a resume.
+        """
+        await self.websocket.send_json(data)
+
+    async def _refuse(self, text: str, reason: str):
+        await self.websocket.send_json({"type": "stream_error", "text": text})
+        await self.websocket.close(code=1002, reason=reason)
+
+    async def authenticate(self) -> bool:
+        """
+        Checks the session token of the connection URL and the rate limits,
+        and closes the websocket when either fails. The token in later
+        messages may differ, tokens get refreshed while connected.
+        """
+        token = parse_qs(self.websocket.url.query).get("session_token", [None])[0]
+        if not token:
+            await self._refuse("Missing session_token", "Missing session token")
+            return False
+        is_valid, session_id = await validate_token(token, self.client_ip)
+        if not is_valid:
+            await self._refuse("Session_token invalid or expired", "Invalid session token")
+            return False
+        is_in_ratelimit, result = await check_rate_limits(self.client_ip, token)
+        if not is_in_ratelimit:
+            await self._refuse(f"{result}", "Rate limit exceeded")
+            return False
+        self.session_id = session_id
+        return True
+
+    async def receive(self) -> tuple:
+        """
+        Returns the next client message and its parsed JSON, answering
+        heartbeat pings and taking pongs on the way.
+        """
+        while True:
+            message = await self.websocket.receive_text()
+            self.last_seen = asyncio.get_running_loop().time()
+            self.unanswered_pings = 0
+            try:
+                data = json.loads(message)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                # one bad message doesn't cost the client its connection and the answers in flight
+                await self.send_signal({"type": "stream_error", "text": "Invalid message"})
+                continue
+            message_type = data.get("type")
+            if message_type == "pong":
+                self.heartbeat_acked = True
+                continue
+            if message_type == "ping":
+                await self.send_signal({"type": "pong"})
+                continue
+            self.last_activity = self.last_seen
+            self.messages += 1
+            return message, data
+
+    async def check_message_token(self, data: dict, stream) -> Optional[str]:
+        """
+        Returns the session id of the token a message carries, or None after
+        telling the client on the given stream.
+        """
+        session_token = data.get("session_token")
+        if not session_token:
+            await stream.send_json({"type": "stream_error", "text": "Missing session_token"})
+            return None
+        is_valid, session_id = await validate_token(session_token, self.client_ip)
+        if not is_valid:
+            await stream.send_json({"type": "stream_error", "text": "Session_token invalid or expired"})
+            return None
+        return session_id
+
+    async def check_usage(self, session_id: str, stream) -> bool:
+        """
+        Whether the session may start another turn, from the worker's own
+        usage counts. Tells the client on the given stream when it may not.
+        """
+        exceeded = usage_meter.exceeded(session_id, (LLM_TURNS,))
+        if exceeded is None:
+            return True
+        logger.info(f"Session {session_id} used up its {exceeded} quota")
+        await stream.send_json({"type": "stream_error", "text": "Usage quota exceeded"})
+        return False
+
+    async def on_open(self):
+        """
+        The connection is authenticated and registered, messages come next.
+        """
+
+    async def on_message(self, message: str, data: dict):
+        """
+        Handles a client message other than heartbeat pings and pongs.
+        """
+
+    async def on_close(self):
+        """
+        The connection is closing, after on_open; ends the turns in flight.
+        """
+        await self.end_turns()
+
+    async def end_turns(self):
+        active = self.active_turns()
+        if not APP_REPLAY_ENABLED:
+            for task in active:
+                task.cancel()
+        # with replay the answers in flight finish into their replay buffers for a resume, queued ones are dropped
+        await asyncio.gather(*active, return_exceptions=True)
+
+    async def serve(self):
+        """
+        Accepts and authenticates the websocket, then hands every client
+        message to on_message until the client goes away.
+        """
+        websocket, endpoint = self.websocket, self.endpoint
+        if drain_manager.draining:
+            # not accepted, the load balancer retries on another instance
+            await websocket.close(code=1013, reason="Server draining")
+            return
+        await websocket.accept()
+        logger.info(f"{endpoint} connection established")
+
+        connection_reaper.connections.add(self)
+        opened = False
+        try:
+            if not await self.authenticate():
+                return
+            connection_registry.register(self)
+            await usage_meter.open(self.session_id)
+            await self.on_open()
+            opened = True
+            while True:
+                message, data = await self.receive()
+                await self.on_message(message, data)
+        except WebSocketDisconnect:
+            logger.info(f"{endpoint} disconnected by client")
+        except Exception as e:
+            logger.error(f"{endpoint} connection error: {e}")
+            await websocket.close(code=1011)  # 1011: Service restart
+        finally:
+            logger.info(f"{endpoint} connection closing after {self.messages} messages, {self.turns} turns")
+            connection_reaper.connections.discard(self)
+            if opened:
+                await self.on_close()
+            if self.authenticated:
+                connection_registry.unregister(self)
+                # the session's counts go to redis when its last connection here closes
+                await usage_meter.close(self.session_id)
+            try:
+                if self.stream is not None:
+                    await self.stream.wait_flushed()
+                await websocket.close()
+            except Exception as e:
+                logger.info(f"{endpoint} connection closing error: {e}")
+
+
+class ConnectionReaper:
+    """
+    Closes the connections of a worker that are gone or unused, from one
+    task for all of them instead of timer tasks per connection:
+
+    - idle: no client input for APP_WS_IDLE_TIMEOUT_SECONDS and no turn in
+      flight;
+    - dead: a ping every APP_WS_HEARTBEAT_SECONDS and more than
+      APP_WS_HEARTBEAT_MISSED_PONGS of them unanswered, e.g. a phone that
+      lost signal. A client that never answered a ping is also silent for
+      APP_WS_SILENT_TIMEOUT_SECONDS first. Its turns are cancelled right
+      away, upstream and TTS calls with them, unless
+      APP_WS_DEAD_PEER_KEEP_TURNS lets them finish for a resume.
+    """
+
+    def __init__(self, idle_timeout: float = APP_WS_IDLE_TIMEOUT_SECONDS, check_seconds: float = 60,
+                 heartbeat_seconds: float = APP_WS_HEARTBEAT_SECONDS,
+                 missed_pongs: int = APP_WS_HEARTBEAT_MISSED_PONGS,
+                 silent_timeout: float = APP_WS_SILENT_TIMEOUT_SECONDS):
+        self.idle_timeout = idle_timeout
+        self.check_seconds = check_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.missed_pongs = missed_pongs
+        self.silent_timeout = silent_timeout
+        self.connections = set()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._reap_loop())]
+        if self.heartbeat_seconds > 0:
+            self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _close(self, connection: Connection, code: int, reason: str):
+        self.connections.discard(connection)
+        try:
+            await connection.websocket.close(code=code, reason=reason)
+        except Exception as e:
+            logger.info(f"closing {connection.endpoint} connection failed: {e}")
+
+    async def reap(self):
+        now = asyncio.get_running_loop().time()
+        idle = [connection for connection in self.connections
+                if now - connection.last_activity > self.idle_timeout and not connection.active_turns()]
+        for connection in idle:
+            logger.info(f"{connection.endpoint} connection of session {connection.session_id} idle, closing")
+            await self._close(connection, 1001, "Idle timeout")
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            await self.reap()
+
+    async def _ping(self, connection: Connection):
+        connection.unanswered_pings += 1
+        try:
+            await connection.send_signal({"type": "ping"})
+        except Exception as e:
+            logger.debug(f"ping to {connection.endpoint} connection failed: {e}")
+
+    async def _reclaim(self, connection: Connection, now: float):
+        detect_seconds = now - connection.last_seen
+        dead_peer_counter.inc(endpoint=connection.endpoint)
+        dead_peer_detect_histogram.observe(detect_seconds, endpoint=connection.endpoint)
+        turns = connection.active_turns()
+        logger.info(f"{connection.endpoint} connection of session {connection.session_id} missed "
+                    f"{connection.unanswered_pings} pings, silent for {detect_seconds:.1f}s, closing with "
+                    f"{len(turns)} turns in flight")
+        if not (APP_REPLAY_ENABLED and APP_WS_DEAD_PEER_KEEP_TURNS):
+            for task in turns:
+                task.cancel()
+        await self._close(connection, 1001, "Heartbeat timeout")
+
+    def _is_dead(self, connection: Connection, now: float) -> bool:
+        if connection.unanswered_pings <= self.missed_pongs:
+            return False
+        return connection.heartbeat_acked or now - connection.last_seen > self.silent_timeout
+
+    async def heartbeat(self):
+        now = asyncio.get_running_loop().time()
+        alive = []
+        for connection in list(self.connections):
+            if connection.authenticated and self._is_dead(connection, now):
+                await self._reclaim(connection, now)
+            elif connection.authenticated:
+                alive.append(connection)
+        # a send to a dead peer may block on a full socket buffer, don't let it hold up the others
+        pings = [asyncio.create_task(self._ping(connection)) for connection in alive]
+        if pings:
+            await asyncio.wait(pings, timeout=self.heartbeat_seconds)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Heartbeat failed: {e}")
+
+
+connection_reaper = ConnectionReaper()
+open_connections_gauge = Gauge("chatagent_ws_connections", "Open websocket connections",
+                               function=lambda: len(connection_reaper.connections))
+
+
+class PipelineConnection(Connection):
+    """
+    A connection of /text-ws or /speech-ws: runs process_input(message,
+    stream, session_id) for every input message, one turn at a time, and
+    handles resume. Turns run in a task of their own so the socket is still
+    read meanwhile: heartbeat pongs count while an answer streams, and
+    "cancel" stops the turn.
+    """
+    __slots__ = ("process_input", "message_types", "pending_turns", "turn_runner")
+
+    def __init__(self, websocket: WebSocket, endpoint: str, process_input, message_types: tuple):
+        super().__init__(websocket, endpoint)
+        self.process_input = process_input
+        self.message_types = message_types
+        self.pending_turns = asyncio.Queue()
+        self.turn_runner: Optional[asyncio.Task] = None
+
+    async def on_open(self):
+        self.stream = ResponseStream(self.websocket, self.session_id, self.endpoint)
+        self.turn_runner = asyncio.create_task(self._run_turns())
+
+    async def _run_turns(self):
+        # one turn at a time, in the order the messages came in
+        while True:
+            start_turn = await self.pending_turns.get()
+            await run_turn(self, start_turn())
+
+    async def on_message(self, message: str, data: dict):
+        stream = self.stream
+        message_type = data.get("type")
+        if message_type == "cancel":
+            for task in self.active_turns():
+                task.cancel()
+            return
+        if message_type not in self.message_types:
+            return
+        session_id = await self.check_message_token(data, stream)
+        if session_id is None:
+            return
+        if message_type == "resume":
+            last_seq = parse_last_seq(data)
+            if last_seq is None:
+                await stream.send_json({"type": "stream_error", "text": "Invalid last_seq"})
+                return
+            self.pending_turns.put_nowait(functools.partial(resume_response_stream, stream, last_seq))
+            return
+        if drain_manager.draining:
+            await stream.send_json(reconnect_hint_frame())
+            return
+        if not await self.check_usage(session_id, stream):
+            return
+        self.turns += 1
+        self.pending_turns.put_nowait(functools.partial(self.process_input, message, stream, session_id))
+
+    async def on_close(self):
+        await self.end_turns()
+        self.turn_runner.cancel()
+        await asyncio.gather(self.turn_runner, return_exceptions=True)
+
+
+async def serve_connection(websocket: WebSocket, endpoint: str, process_input, message_types: tuple):
+    """
+    The websocket endpoint of a pipeline, see PipelineConnection.
+    """
+    await PipelineConnection(websocket, endpoint, process_input, message_types).serve()
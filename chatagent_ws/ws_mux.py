@@ -0,0 +1,247 @@
+import asyncio
+import json
+from collections import deque
+from typing import Optional
+
+from fastapi import WebSocket
+
+import ws_speech
+import ws_text
+from app_config import APP_MUX_MAX_STREAMS, APP_MUX_STREAM_QUEUE_FRAMES
+from connection_registry import CONTROL_CANCEL, CONTROL_DISCONNECT
+from drain_manager import drain_manager, reconnect_hint_frame
+from logging_util import get_logger
+from metrics_util import Gauge
+from response_stream import ResponseStream, resume_response_stream
+from ws_connection import Connection, parse_last_seq
+
+logger = get_logger("ws_mux")
+
+mux_streams_gauge = Gauge("chatagent_mux_streams", "Streams in flight on multiplexed websockets")
+
+# the same turn pipelines as /text-ws and /speech-ws
+PIPELINES = {"text": ws_text.process_input, "speech": ws_speech.process_input}
+# bytes of UTF-8, the binary frame header stores the length in one byte
+MAX_STREAM_ID_BYTES = 64
+
+
+class MuxClosed(Exception):
+    """
+    The multiplexed websocket is gone, frames can't be sent any more.
+    """
+
+
+class MuxStream:
+    """
+    One logical stream of a multiplexed websocket. It stands in for the
+    websocket of a ResponseStream: JSON frames get the stream_id, binary
+    frames are prefixed with the length of the stream id (one byte) and the
+    id, and everything goes through the connection's fair writer.
+    """
+
+    def __init__(self, stream_id: str, writer: "MuxWriter"):
+        self.stream_id = stream_id
+        self.writer = writer
+        self.header = bytes([len(stream_id.encode("utf-8"))]) + stream_id.encode("utf-8")
+        self.frames = deque()
+        self.space = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def send_json(self, data: dict):
+        await self.writer.enqueue(self, (False, {**data, "stream_id": self.stream_id}))
+
+    async def send_bytes(self, data: bytes):
+        await self.writer.enqueue(self, (True, self.header + data))
+
+    async def send_text(self, data: str):
+        # replayed frames come in as recorded, without the stream id
+        await self.send_json(json.loads(data))
+
+
+class MuxWriter:
+    """
+    Sends the frames of all streams of a websocket, one frame per stream with
+    pending frames in turn, so a speech answer's audio doesn't hold up a text
+    answer on the same connection. A stream may queue up to queue_frames
+    frames before its sender waits.
+    """
+
+    def __init__(self, websocket: WebSocket, queue_frames: int = APP_MUX_STREAM_QUEUE_FRAMES):
+        self.websocket = websocket
+        self.queue_frames = queue_frames
+        self.closed = False
+        # streams with queued frames, in the order they get their next turn
+        self._ready = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._write_loop())
+
+    def stream(self, stream_id: str) -> MuxStream:
+        return MuxStream(stream_id, self)
+
+    async def enqueue(self, stream: MuxStream, frame: tuple):
+        while len(stream.frames) >= self.queue_frames and not self.closed:
+            stream.space.clear()
+            await stream.space.wait()
+        if self.closed:
+            raise MuxClosed("websocket closed")
+        if not stream.frames:
+            self._ready.append(stream)
+        stream.frames.append(frame)
+        self._wakeup.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._ready:
+                    stream = self._ready.popleft()
+                    binary, payload = stream.frames.popleft()
+                    if stream.frames:
+                        self._ready.append(stream)
+                    stream.space.set()
+                    if binary:
+                        await self.websocket.send_bytes(payload)
+                    else:
+                        await self.websocket.send_json(payload)
+        except Exception as e:
+            logger.info(f"mux writer stopped: {e}")
+        finally:
+            self._close()
+
+    def _close(self):
+        self.closed = True
+        for stream in self._ready:
+            stream.frames.clear()
+            stream.space.set()
+        self._ready.clear()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._close()
+
+
+class MuxConnection(Connection):
+    """
+    A multiplexed websocket: its streams in flight by id, all written by one
+    MuxWriter. Cancel and disconnect from the control channel apply to
+    every stream; frames that belong to no stream go out with stream_id "".
+    """
+    __slots__ = ("streams", "writer")
+
+    def __init__(self, websocket: WebSocket):
+        super().__init__(websocket, "mux")
+        self.streams = {}
+        self.writer = MuxWriter(websocket)
+
+    def active_turns(self) -> list:
+        return [stream.task for stream in self.streams.values()]
+
+    async def send_json(self, data: dict):
+        # through the writer, a direct send would race it on the socket
+        await self.writer.stream("").send_json(data)
+
+    async def send_signal(self, data: dict):
+        await self.writer.stream("").send_json(data)
+
+    async def handle_control(self, action: str, payload: dict):
+        if action == CONTROL_CANCEL or action == CONTROL_DISCONNECT:
+            for stream in self.streams.values():
+                stream.task.cancel()
+        await super().handle_control(action, payload)
+
+    async def on_open(self):
+        self.writer.start()
+
+    async def on_message(self, message: str, data: dict):
+        stream_id = data.get("stream_id")
+        if not isinstance(stream_id, str) or not stream_id or len(stream_id.encode("utf-8")) > MAX_STREAM_ID_BYTES:
+            await self.send_signal({"type": "stream_error", "text": "Invalid stream_id"})
+            return
+        stream = self.writer.stream(stream_id)
+        message_type = data.get("type")
+
+        if message_type == "cancel":
+            running = self.streams.get(stream_id)
+            if running is not None:
+                running.task.cancel()
+            return
+        if message_type not in ("userInput", "user_input", "resume"):
+            return
+
+        endpoint = data.get("endpoint", "text")
+        if endpoint not in PIPELINES:
+            await stream.send_json({"type": "stream_error", "text": "Unknown endpoint"})
+            return
+        session_id = await self.check_message_token(data, stream)
+        if session_id is None:
+            return
+        if stream_id in self.streams:
+            await stream.send_json({"type": "stream_error", "text": "Stream busy"})
+            return
+        if len(self.streams) >= APP_MUX_MAX_STREAMS:
+            await stream.send_json({"type": "stream_error", "text": "Too many streams"})
+            return
+
+        # numbered and recorded per stream, so each one resumes on its own
+        response_stream = ResponseStream(stream, session_id, f"mux:{endpoint}:{stream_id}")
+        if message_type == "resume":
+            last_seq = parse_last_seq(data)
+            if last_seq is None:
+                await stream.send_json({"type": "stream_error", "text": "Invalid last_seq"})
+                return
+            coro = resume_response_stream(response_stream, last_seq)
+        elif drain_manager.draining:
+            await response_stream.send_json(reconnect_hint_frame())
+            return
+        elif not await self.check_usage(session_id, stream):
+            return
+        else:
+            self.turns += 1
+            coro = PIPELINES[endpoint](message, response_stream, session_id)
+        self.streams[stream_id] = stream
+        mux_streams_gauge.inc()
+        stream.task = asyncio.create_task(run_stream(self, stream, response_stream, coro))
+
+    async def on_close(self):
+        await self.writer.stop()
+        await self.end_turns()
+
+
+async def run_stream(connection: MuxConnection, stream: MuxStream, response_stream: ResponseStream, coro):
+    """
+    Runs one turn of a stream, cancellable on its own like run_turn.
+    """
+    try:
+        await coro
+        await response_stream.wait_flushed()
+    except asyncio.CancelledError:
+        logger.info(f"stream {stream.stream_id} cancelled for session {connection.session_id}")
+        try:
+            await response_stream.send_json({"type": "stream_error", "text": "Request cancelled"})
+        except MuxClosed:
+            pass
+    except MuxClosed:
+        pass
+    finally:
+        if connection.streams.get(stream.stream_id) is stream:
+            del connection.streams[stream.stream_id]
+        mux_streams_gauge.dec()
+
+
+async def websocket_mux_endpoint(websocket: WebSocket):
+    """
+    Carries several conversation streams over one websocket. Every client
+    message names its stream_id; userInput also picks the pipeline with
+    "endpoint" ("text" or "speech"), cancel stops that stream only and resume
+    replays it. Frames of concurrent streams interleave fairly.
+
+    Args:
+        websocket: The WebSocket connection object.
+    """
+    await MuxConnection(websocket).serve()
@@ -1,27 +1,38 @@
 import asyncio
 import json
-from typing import AsyncIterator, Optional, Dict
-from urllib.parse import parse_qs
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, Dict, Tuple
 
 from dotenv import load_dotenv
-from fastapi import WebSocket, WebSocketDisconnect
-from google.cloud import texttospeech
+from fastapi import WebSocket
 from httpx import AsyncClient, TimeoutException, RequestError, HTTPStatusError
 
-from app_config import APP_API_HOST, APP_API_PORT, APP_WS_IDLE_TIMEOUT_SECONDS
-from language_util import spacy_tokenize_text, extract_language_name_from_llm_text, \
-    get_voice_code_name_by_language_name
+from answer_cache import answer_with_cache, mark_uncacheable
+from app_config import APP_API_HOST, APP_API_PORT, APP_TTS_SPECULATIVE_CLAUSE_ENABLED, APP_AUDIO_STORE_WRITE_THROUGH
+from audio_store import audio_store, clip_key
+from backend_limiter import speech_backend_guard, BackendUnavailable
+from clause_rules import find_clause_boundary
+from control_tags import ControlTagParser
+from language_util import spacy_tokenize_text, get_voice_code_name_by_language_name, detect_language_name
 from logging_util import get_logger
-from session_manager import validate_token, check_rate_limits, get_client_ip_from_websocket
+from response_stream import ResponseStream
+from sentence_batcher import SentenceBatcher, chunks_with_deadline
+from session_manager import get_session_language, set_session_language
+from stream_capture import open_stream_capture
+from tts_admission import tts_admission, PRIORITY_FIRST_SENTENCE, PRIORITY_NEXT_SENTENCE
+from tts_hedge import hedged_synthesizer
+from tts_provider import tts_router, TtsQuotaExceeded, TtsEngineError
+from upstream_decoder import UpstreamDecoder, UpstreamEvent, framing_for, EVENT_CONTROL, EVENT_DONE, EVENT_ERROR
+from usage_meter import usage_meter, TTS_CHARS, AUDIO_BYTES
+from ws_connection import serve_connection
 
 load_dotenv()
 
 logger = get_logger("ws_speech")
 
-text_to_speech_client = texttospeech.TextToSpeechClient()
-
 MAX_BUFFER_SIZE = 1024 * 1024  # 1MB buffer limit
 MAX_INPUT_SIZE = 10 * 1024  # 10KB input limit
+MESSAGE_TYPES = ("userInput", "user_input", "resume")
 
 
 async def call_speech_streaming_api(
@@ -30,7 +41,8 @@ async def call_speech_streaming_api(
         base_url: str = f"{APP_API_HOST}:{APP_API_PORT}",
         timeout: float = 60.0,
         headers: Optional[Dict[str, str]] = None,
-) -> AsyncIterator[str]:
+        response_info: Optional[dict] = None,
+) -> AsyncIterator[UpstreamEvent]:
     logger.info("Calling speech streaming API")
     url = f"{base_url}/api/speech/streaming"
     payload = {"message": message}
@@ -41,27 +53,48 @@ async def call_speech_streaming_api(
     if headers:
         default_headers.update(headers)
 
-    async with AsyncClient() as client:
-        try:
-            async with client.stream(
-                    "POST",
-                    url,
-                    json=payload,
-                    headers=default_headers,
-                    timeout=timeout,
-            ) as response:
-                response.raise_for_status()
-                async for chunk in response.aiter_text():
-                    yield chunk
-        except (TimeoutException, RequestError, HTTPStatusError) as e:
-            logger.error(f"API call failed: {e}")
-            raise
-
-
-async def process_input(user_input: str, websocket: WebSocket, session_id: str):
+    capture = open_stream_capture("speech", message)
+    async with speech_backend_guard.call() as backend_call:
+        async with AsyncClient() as client:
+            try:
+                async with client.stream(
+                        "POST",
+                        url,
+                        json=payload,
+                        headers=default_headers,
+                        timeout=timeout,
+                ) as response:
+                    response.raise_for_status()
+                    usage_meter.record(x_session_id, llm_turns=1)
+                    if response_info is not None:
+                        response_info["headers"] = response.headers
+                    content_type = response.headers.get("content-type")
+                    decoder = UpstreamDecoder(framing_for(content_type))
+                    reads = response.aiter_bytes()
+                    if capture:
+                        capture.content_type = content_type
+                        reads = capture.capture_reads(reads)
+                    async with aclosing(reads):
+                        async for data in reads:
+                            backend_call.first_chunk()
+                            for event in decoder.feed(data):
+                                yield event
+                            if decoder.done:
+                                break
+                    for event in decoder.finish():
+                        yield event
+            except (TimeoutException, RequestError, HTTPStatusError) as e:
+                logger.error(f"API call failed: {e}")
+                raise
+            finally:
+                if capture:
+                    await capture.save()
+
+
+async def process_input(user_input: str, stream: ResponseStream, session_id: str):
     logger.info("Processing input")
     if len(user_input) > MAX_INPUT_SIZE:
-        await websocket.send_json({
+        await stream.send_json({
             "type": "stream_error",
             "text": "Input exceeds maximum size limit"
         })
@@ -71,100 +104,221 @@ async def process_input(user_input: str, websocket: WebSocket, session_id: str):
     text_input = data.get("text", "").strip()
 
     if not text_input:
-        await websocket.send_json({
+        await stream.send_json({
             "type": "stream_error",
             "text": "Empty input received"
         })
         return
 
+    await answer_with_cache("speech", text_input, stream,
+                            lambda answer_stream, response_info: stream_answer(text_input, answer_stream, session_id,
+                                                                               response_info),
+                            session_id)
+
+
+async def stream_answer(text_input: str, stream: ResponseStream, session_id: str, response_info: dict):
     try:
         buffer = ""
-        language_name = "ENGLISH"
-        async for chunk in call_speech_streaming_api(text_input, session_id):
+        # language of the previous turn until this answer's tag or first sentence tells otherwise
+        language_name = await get_session_language(session_id) or "ENGLISH"
+        language_resolved = False
+        speaking_rate = 1.0
+        sentence_priority = PRIORITY_FIRST_SENTENCE
+        tag_parser = ControlTagParser()
+        batcher = SentenceBatcher()
+
+        async def send_batch(batch: str):
+            nonlocal sentence_priority
+            lang_code, voice_code, voice_name = get_voice_code_name_by_language_name(language_name)
+            await send_text_and_audio(batch, stream, lang_code, voice_code, tag_parser.voice_name or voice_name,
+                                      speaking_rate, sentence_priority, language_name, session_id)
+            sentence_priority = PRIORITY_NEXT_SENTENCE
+
+        events = call_speech_streaming_api(text_input, session_id, response_info=response_info)
+        async for event in chunks_with_deadline(events, batcher):
+            if event is None:
+                # no new sentence in time, don't hold back the merged ones any longer
+                batch = batcher.due()
+                if batch:
+                    await send_batch(batch)
+                continue
+
+            if event.kind == EVENT_CONTROL:
+                # a tag framed on its own, it takes effect like an in-band one
+                tag_parser.apply(event.tag, event.text)
+                continue
+
+            chunk = event.text
             if len(buffer) + len(chunk) > MAX_BUFFER_SIZE:
                 logger.error("Buffer size exceeded")
-                await websocket.send_json({
+                await stream.send_json({
                     "type": "stream_error",
                     "text": "Response too large"
                 })
                 return
 
-            if chunk == "[DONE]":
+            if event.kind == EVENT_DONE:
+                buffer += tag_parser.finish()
                 if buffer.strip():
-                    lang_code, voice_code, voice_name = get_voice_code_name_by_language_name(language_name)
+                    if tag_parser.language_name is not None:
+                        language_name = tag_parser.language_name
+                    if not language_resolved:
+                        language_name = await resolve_turn_language(buffer, session_id, language_name, tag_parser)
                     # lang_code, voice_code, voice_name, lang_name = detect_language_code_and_voice_name(buffer.strip())
-                    await send_text_and_audio(buffer, websocket, lang_code, voice_code, voice_name)
+                for batch in batcher.add(buffer) + [batcher.flush()]:
+                    if batch:
+                        await send_batch(batch)
                 break
-            elif "Error:" in chunk:
-                await websocket.send_json({"type": "stream_error", "text": chunk})
+            elif event.kind == EVENT_ERROR:
+                await stream.send_json({"type": "stream_error", "text": chunk})
                 return
             else:
                 logger.debug(f"received llm chunk:{chunk}")
-                cleaned_chunk = (chunk.replace("** ", "").replace("-- ", "")
+                # control tags are stripped from the new chunk only, the buffer is never rescanned
+                cleaned_chunk = (tag_parser.feed(chunk).replace("** ", "").replace("-- ", "")
                                  .replace("* ", ""))
+                if not cleaned_chunk:
+                    continue
                 buffer += cleaned_chunk
-                llm_language_name=extract_language_name_from_llm_text(buffer)
-                if llm_language_name is not None:
-                    buffer=buffer.replace(f"language-name:{llm_language_name}","").replace("\n","")
-                    language_name=llm_language_name.upper()
-                    # logger.info(f"language name: {llm_language_name}")
+                if tag_parser.language_name is not None:
+                    language_name = tag_parser.language_name
+                    if not language_resolved:
+                        await set_session_language(session_id, language_name)
+                        language_resolved = True
+                if tag_parser.speaking_rate is not None:
+                    speaking_rate = tag_parser.speaking_rate
                 # lang_code, voice_code, voice_name, lang_name = detect_language_code_and_voice_name(buffer.strip())
-                lang_code, voice_code, voice_name = get_voice_code_name_by_language_name(language_name)
-                logger.info(f"detected language: {language_name} {lang_code}, {voice_name}")
+                logger.debug(f"detected language: {language_name}")
                 sentences=spacy_tokenize_text(buffer,language_name)
                 logger.debug(f"sentences list:{sentences}")
-                if len(sentences) > 1 or (sentences and cleaned_chunk.endswith(('. ', '? ', '! '))):
-                    if sentences[0].strip():
-                        await send_text_and_audio(sentences[0], websocket, lang_code, voice_code, voice_name)
-                    else:
-                        logger.debug(f"skip empty sentence:{sentences[0]}")
-                    buffer = sentences[-1]
-
-        await websocket.send_json({"type": "response_end"})
+                if len(sentences) > 1:
+                    # every sentence but the last (incomplete) one
+                    complete, buffer = sentences[:-1], sentences[-1]
+                elif sentences and cleaned_chunk.endswith(('. ', '? ', '! ')):
+                    complete, buffer = sentences, ""
+                else:
+                    complete = []
+                    if APP_TTS_SPECULATIVE_CLAUSE_ENABLED and batcher.first:
+                        # nothing spoken yet and the opening sentence runs long: speak its first clause now
+                        boundary = find_clause_boundary(buffer, language_name)
+                        if boundary > 0:
+                            logger.debug(f"speculative first clause: {buffer[:boundary]}")
+                            complete, buffer = [buffer[:boundary]], buffer[boundary:].lstrip()
+                for sentence in complete:
+                    if not sentence.strip():
+                        logger.debug(f"skip empty sentence:{sentence}")
+                        continue
+                    if not language_resolved:
+                        language_name = await resolve_turn_language(sentence, session_id, language_name,
+                                                                    tag_parser)
+                        language_resolved = True
+                    for batch in batcher.add(sentence):
+                        await send_batch(batch)
+
+        batch = batcher.flush()
+        if batch:
+            # stream ended without [DONE]
+            await send_batch(batch)
+        await stream.send_json({"type": "response_end"})
+    except BackendUnavailable as e:
+        # refused before calling the backend, fail fast
+        logger.warning(f"Backend unavailable: {e}")
+        await stream.send_json({"type": "stream_error", "text": str(e)})
     except Exception as e:
         logger.error(f"Processing error: {e}")
         logger.exception(e)
-        await websocket.send_json({"type": "stream_error", "text": str(e)})
+        await stream.send_json({"type": "stream_error", "text": str(e)})
 
 
-async def send_text_and_audio(text: str, websocket: WebSocket, lang_code: str, voice_code: str, voice_name: str):
+async def resolve_turn_language(first_sentence: str, session_id: str, current_language_name: str,
+                                tag_parser: ControlTagParser) -> str:
+    """
+    Picks the language for a turn whose answer carries no language-name tag.
+    Runs lingua once, on the first sentence only, and remembers the result for
+    the session so short or ambiguous openers ("OK!") keep the last language.
+    """
+    if tag_parser.language_name is not None:
+        language_name = tag_parser.language_name
+    else:
+        language_name = detect_language_name(first_sentence) or current_language_name
+        logger.debug(f"fallback language detection: {language_name} for: {first_sentence}")
+    await set_session_language(session_id, language_name)
+    return language_name
+
+
+async def synthesize_audio(text: str, voice_code: str, voice_name: str, speaking_rate: float = 1.0,
+                           priority: int = PRIORITY_NEXT_SENTENCE, language_name: Optional[str] = None) \
+        -> Optional[Tuple[bytes, str]]:
+    """
+    Returns the audio for text and its format, from the shared audio store or
+    from the TTS engine routed for the language, or None when the sentence
+    has to go without audio (TTS budget or quota exhausted, engine failure).
+    """
+    provider = tts_router.provider_for(language_name, text)
+    voice = provider.voice_for(voice_code, voice_name)
+    key = clip_key(text, f"{provider.name}/{voice}", voice_code, speaking_rate) if audio_store.enabled else None
+    if key is not None:
+        stored = audio_store.get(key)
+        if stored is not None:
+            # the websocket needs bytes, the copy is made here and only here
+            return bytes(stored), provider.audio_format
+
+    if provider.rate_limited and not await tts_admission.acquire(priority):
+        # over the TTS budget: the sentence still gets to the client, without audio
+        logger.warning(f"TTS admission refused, sending text only: {text}")
+        return None
+    try:
+        # runs in a thread, hedged when APP_TTS_HEDGE_ENABLED
+        audio_data = await hedged_synthesizer.synthesize(
+            f"{provider.name}/{voice}",
+            lambda: provider.synthesize(text, voice_code, voice, speaking_rate),
+            provider.rate_limited
+        )
+    except TtsQuotaExceeded as e:
+        tts_admission.on_quota_exceeded()
+        logger.warning(f"TTS quota exceeded, sending text only: {e}")
+        return None
+    except TtsEngineError as e:
+        logger.error(f"TTS engine {provider.name} failed, sending text only: {e}")
+        return None
+    if key is not None and APP_AUDIO_STORE_WRITE_THROUGH:
+        await asyncio.to_thread(audio_store.put, key, audio_data)
+    return audio_data, provider.audio_format
+
+
+async def send_text_and_audio(text: str, stream: ResponseStream, lang_code: str, voice_code: str, voice_name: str,
+                              speaking_rate: float = 1.0, priority: int = PRIORITY_NEXT_SENTENCE,
+                              language_name: Optional[str] = None, session_id: Optional[str] = None):
     try:
         # lang_code, voice_code, voice_name, lang_name = detect_language_code_and_voice_name(text.strip())
         # logger.debug(f"detected language code: {lang_code}, {voice_name}")
         logger.debug(f"send_text_and_audio: {text}")
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-        voice = texttospeech.VoiceSelectionParams(
-            language_code=f"{voice_code}",
-            name=voice_name
-        )
-        audio_config = texttospeech.AudioConfig(
-            # audio_encoding=texttospeech.AudioEncoding.LINEAR16,  # Uncompressed 16-bit PCM
-            # sample_rate_hertz=24000,
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=1.0,
-            pitch=0.0
-        )
-
-        response = text_to_speech_client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
-        )
-        audio_data = response.audio_content
-        # base64_audio = base64.b64encode(audio_data).decode('utf-8')
-        # await websocket.send_json({
-        #     "type": "audio_chunk",
-        #     "audio": base64_audio,
-        #     "voice_name": voice_name
-        # })
-        logger.debug(f"before send audio")
-        await websocket.send_bytes(audio_data)
-        logger.debug(f"before send metadata")
-        metadata = {"type": "audio_metadata", "format": "mp3", "lang_code": lang_code,
-                    "length": len(response.audio_content)}
-        await websocket.send_json(metadata)
+        exceeded = usage_meter.exceeded(session_id, (TTS_CHARS, AUDIO_BYTES)) if session_id else None
+        if exceeded:
+            logger.warning(f"Session {session_id} used up its {exceeded} quota, sending text only: {text}")
+            audio = None
+        else:
+            audio = await synthesize_audio(text, voice_code, voice_name, speaking_rate, priority, language_name)
+        if audio is not None:
+            audio_data, audio_format = audio
+            if session_id:
+                usage_meter.record(session_id, tts_chars=len(text), audio_bytes=len(audio_data))
+            # base64_audio = base64.b64encode(audio_data).decode('utf-8')
+            # await websocket.send_json({
+            #     "type": "audio_chunk",
+            #     "audio": base64_audio,
+            #     "voice_name": voice_name
+            # })
+            logger.debug(f"before send audio")
+            await stream.send_bytes(audio_data)
+            logger.debug(f"before send metadata")
+            metadata = {"type": "audio_metadata", "format": audio_format, "lang_code": lang_code,
+                        "length": len(audio_data)}
+            await stream.send_json(metadata)
+        else:
+            mark_uncacheable(stream)
         logger.debug(f"before send text")
-        await websocket.send_json({
+        await stream.send_json({
             "type": "response_chunk",
             "text": text
         })
@@ -176,101 +330,9 @@ async def send_text_and_audio(text: str, websocket: WebSocket, lang_code: str, v
 
 async def websocket_speech_endpoint(websocket: WebSocket):
     """
-    Handles a WebSocket connection for speech input, including a connection
-    idle check.  If the client is idle for more than 10 minutes, the
-    connection is closed.
+    Handles a speech WebSocket connection, see ws_connection.serve_connection.
 
     Args:
         websocket: The WebSocket connection object.
     """
-    await websocket.accept()
-    logger.info("websocket_speech_endpoint connection established")
-
-    last_activity = asyncio.get_event_loop().time()  # Track last activity time
-    idle_timeout = APP_WS_IDLE_TIMEOUT_SECONDS
-
-    async def check_idle():
-        """
-        Periodically checks if the connection has been idle for too long
-        and closes it if necessary.
-        """
-        nonlocal last_activity  # Access the last_activity variable from the outer scope
-        while True:
-            now = asyncio.get_event_loop().time()
-            if now - last_activity > idle_timeout:
-                logger.info("Connection idle timeout exceeded. Closing connection.")
-                await websocket.close(code=1001, reason="Idle timeout")  # Use 1001 for going away
-                return  # Exit the idle check task
-            await asyncio.sleep(60)  # Check every 60 seconds (adjust as needed)
-
-    # Start the idle check task
-    idle_check_task = asyncio.create_task(check_idle())
-
-    try:
-        # session token at connection may be different from token in payload
-        # since token may be expired and refreshed during connection
-        connection_session_token = parse_qs(websocket.url.query).get("session_token", [None])[0]
-
-        if not connection_session_token:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": "Missing session_token"
-            })
-            await websocket.close(code=1002, reason="Missing session token")
-            return
-
-        client_ip = get_client_ip_from_websocket(websocket)
-        is_valid, session_id = await validate_token(connection_session_token, client_ip)
-        if not is_valid:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": "Session_token invalid or expired"
-            })
-            await websocket.close(code=1002, reason="Invalid session token")
-            return
-
-        is_in_ratelimit, result = await check_rate_limits(client_ip, connection_session_token)
-        if not is_in_ratelimit:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": f"{result}"
-            })
-            await websocket.close(code=1002, reason="Rate limit exceeded")
-            return
-        # Send a message to the client to indicate successful connection and session validation
-        #        await websocket.send_json({"type": "connection_success", "session_id": session_id})
-
-        while True:
-            message = await websocket.receive_text()
-            last_activity = asyncio.get_event_loop().time()  # update last_activity
-            data = json.loads(message)
-            if data.get("type") == "userInput" or data.get("type") == "user_input":
-                session_token = data.get("session_token")
-                if not session_token:
-                    await websocket.send_json({
-                        "type": "stream_error",
-                        "text": "Missing session_token"
-                    })
-                    continue
-                client_ip = get_client_ip_from_websocket(websocket)
-                is_valid, session_id = await validate_token(session_token, client_ip)
-                if not is_valid:
-                    await websocket.send_json({
-                        "type": "stream_error",
-                        "text": "Session_token invalid or expired"
-                    })
-                    continue
-
-                await process_input(message, websocket, session_id)
-    except WebSocketDisconnect:
-        logger.info("websocket_speech_endpoint disconnected by client")
-    except Exception as e:
-        logger.error(f"websocket_speech_endpoint error: {e}")
-        await websocket.close(code=1011)  # 1011: Service restart
-    finally:
-        logger.info("websocket_speech_endpoint connection closing")
-        try:
-            idle_check_task.cancel()  # Stop the idle check task
-            await websocket.close()
-        except Exception as e:
-            logger.info(f"websocket_speech_endpoint connection closing error: {e}")
+    await serve_connection(websocket, "speech", process_input, MESSAGE_TYPES)
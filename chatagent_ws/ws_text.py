@@ -1,18 +1,23 @@
-import asyncio
 import json
 import logging
+from contextlib import aclosing
 from typing import AsyncIterator, Optional, Dict
-from urllib.parse import parse_qs
 
 # import nltk
 from dotenv import load_dotenv
-from fastapi import WebSocket, WebSocketDisconnect
+from fastapi import WebSocket
 from httpx import AsyncClient, TimeoutException, RequestError, HTTPStatusError
 
-from app_config import APP_API_HOST, APP_API_PORT, APP_WS_IDLE_TIMEOUT_SECONDS
+from answer_cache import answer_with_cache
+from app_config import APP_API_HOST, APP_API_PORT
+from backend_limiter import chat_backend_guard, BackendUnavailable
 from language_util import fix_markdown_list_spacing, fix_markdown_list_whitespace
 from logging_util import get_logger
-from session_manager import validate_token, check_rate_limits, get_client_ip_from_websocket
+from response_stream import ResponseStream
+from stream_capture import open_stream_capture
+from upstream_decoder import UpstreamDecoder, UpstreamEvent, framing_for, EVENT_TEXT, EVENT_DONE, EVENT_ERROR
+from usage_meter import usage_meter
+from ws_connection import serve_connection
 
 load_dotenv()
 
@@ -27,6 +32,7 @@ logging.basicConfig(level=logging.INFO)
 
 MAX_BUFFER_SIZE = 1024 * 1024  # 1MB buffer limit
 MAX_INPUT_SIZE = 10 * 1024  # 10KB input limit
+MESSAGE_TYPES = ("userInput", "resume")
 
 
 async def call_api(
@@ -35,7 +41,8 @@ async def call_api(
         base_url: str = f"{APP_API_HOST}:{APP_API_PORT}",
         timeout: float = 60.0,
         headers: Optional[Dict[str, str]] = None,
-) -> AsyncIterator[str]:
+        response_info: Optional[dict] = None,
+) -> AsyncIterator[UpstreamEvent]:
     """
     Calls the streaming API, handling potential errors and timeouts.
 
@@ -45,9 +52,11 @@ async def call_api(
         base_url: The base URL of the API.
         timeout: The timeout for the API call.
         headers: Optional headers to include in the request.
+        response_info: Optional dict that receives the response headers.
 
     Returns:
-        An asynchronous iterator yielding chunks of the response text.
+        An asynchronous iterator yielding the events of the answer, see
+        upstream_decoder.UpstreamDecoder.
 
     Raises:
         Exception: If the API call fails or times out.
@@ -62,30 +71,52 @@ async def call_api(
     if headers:
         default_headers.update(headers)
 
-    async with AsyncClient() as client:
-        try:
-            async with client.stream(
-                    "POST",
-                    url,
-                    json=payload,
-                    headers=default_headers,
-                    timeout=timeout,
-            ) as response:
-                logger.info("receiving from streaming API")
-                response.raise_for_status()
-                async for chunk in response.aiter_text():
-                    logger.info(f"receiving from streaming API {chunk}")
-                    yield chunk
-                logger.info(f"receiving from streaming API done")
-        except (TimeoutException, RequestError, HTTPStatusError) as e:
-            logger.error(f"API call failed: {e}")
-            raise
-
-
-async def process_input(user_input: str, websocket: WebSocket, session_id: str):
+    capture = open_stream_capture("chat", message)
+    async with chat_backend_guard.call() as backend_call:
+        async with AsyncClient() as client:
+            try:
+                async with client.stream(
+                        "POST",
+                        url,
+                        json=payload,
+                        headers=default_headers,
+                        timeout=timeout,
+                ) as response:
+                    logger.info("receiving from streaming API")
+                    response.raise_for_status()
+                    usage_meter.record(x_session_id, llm_turns=1)
+                    if response_info is not None:
+                        response_info["headers"] = response.headers
+                    content_type = response.headers.get("content-type")
+                    decoder = UpstreamDecoder(framing_for(content_type))
+                    # each read as it comes off the socket, up to 64 KiB; a chunk_size would hold reads back
+                    # until that many bytes arrived
+                    reads = response.aiter_bytes()
+                    if capture:
+                        capture.content_type = content_type
+                        reads = capture.capture_reads(reads)
+                    async with aclosing(reads):
+                        async for data in reads:
+                            backend_call.first_chunk()
+                            for event in decoder.feed(data):
+                                yield event
+                            if decoder.done:
+                                break
+                    for event in decoder.finish():
+                        yield event
+                    logger.info(f"receiving from streaming API done")
+            except (TimeoutException, RequestError, HTTPStatusError) as e:
+                logger.error(f"API call failed: {e}")
+                raise
+            finally:
+                if capture:
+                    await capture.save()
+
+
+async def process_input(user_input: str, stream: ResponseStream, session_id: str):
     logger.info("Processing input")
     if len(user_input) > MAX_INPUT_SIZE:
-        await websocket.send_json({
+        await stream.send_json({
             "type": "stream_error",
             "text": "Input exceeds maximum size limit"
         })
@@ -95,16 +126,22 @@ async def process_input(user_input: str, websocket: WebSocket, session_id: str):
     text_input = data.get("text", "").strip()
 
     if not text_input:
-        await websocket.send_json({
+        await stream.send_json({
             "type": "stream_error",
             "text": "Empty input received"
         })
         return
 
+    await answer_with_cache("text", text_input, stream,
+                            lambda answer_stream, response_info: stream_answer(text_input, answer_stream, session_id,
+                                                                               response_info),
+                            session_id)
+
+
+async def stream_answer(text_input: str, stream: ResponseStream, session_id: str, response_info: dict):
     try:
         buffer = ""
-        async for chunk in call_api(text_input, session_id):
-            logger.info(f"receiving from streaming API {chunk}")
+        async for event in call_api(text_input, session_id, response_info=response_info):
             # if len(buffer) + len(chunk) > MAX_BUFFER_SIZE:
             #     logger.error("Buffer size exceeded")
             #     await websocket.send_json({
@@ -116,26 +153,17 @@ async def process_input(user_input: str, websocket: WebSocket, session_id: str):
             # buffer += chunk
 
             # Send chunks as they come, respecting sentence boundaries
-            if chunk == "[DONE]":
-                # if buffer.strip():
-                #     # Remove [DONE] and send final buffer
-                #     buffer = buffer.replace("[DONE]", "").strip()
-                #     if buffer:
-                #         await websocket.send_json({
-                #             "type": "response_chunk",
-                #             "text": buffer,
-                #             "session_id": session_id
-                #         })
-                await websocket.send_json({"type": "response_end"})
+            if event.kind == EVENT_DONE:
+                await stream.send_json({"type": "response_end"})
                 break
-            elif "Error:" in chunk:
-                await websocket.send_json({"type": "stream_error", "text": chunk})
+            elif event.kind == EVENT_ERROR:
+                await stream.send_json({"type": "stream_error", "text": event.text})
                 return
-            else:
+            elif event.kind == EVENT_TEXT:
                 # send chunk directly
-                fixed_chunk=fix_markdown_list_spacing(chunk)
+                fixed_chunk=fix_markdown_list_spacing(event.text)
                 fixed_chunk=fix_markdown_list_whitespace(fixed_chunk)
-                await websocket.send_json({
+                await stream.send_json({
                     "type": "response_chunk",
                     "text": fixed_chunk
                     # "session_id": session_id
@@ -151,109 +179,20 @@ async def process_input(user_input: str, websocket: WebSocket, session_id: str):
                 #     })
                 # buffer = sentences[-1] if sentences else buffer  # Keep incomplete sentence
 
+    except BackendUnavailable as e:
+        # refused before calling the backend, fail fast
+        logger.warning(f"Backend unavailable: {e}")
+        await stream.send_json({"type": "stream_error", "text": str(e)})
     except Exception as e:
         logger.error(f"Processing error: {e}")
-        await websocket.send_json({"type": "stream_error", "text": str(e)})
+        await stream.send_json({"type": "stream_error", "text": str(e)})
 
 
 async def websocket_text_endpoint(websocket: WebSocket):
     """
-    Handles a WebSocket connection, including a connection
-    idle check.  If the client is idle for more than 10 minutes, the
-    connection is closed.
+    Handles a text WebSocket connection, see ws_connection.serve_connection.
 
     Args:
         websocket: The WebSocket connection object.
     """
-    await websocket.accept()
-    logger.info("websocket_text_endpoint connection established")
-
-    last_activity = asyncio.get_event_loop().time()  # Track last activity time
-    idle_timeout = APP_WS_IDLE_TIMEOUT_SECONDS  # 10 minutes in seconds
-
-    async def check_idle():
-        """
-        Periodically checks if the connection has been idle for too long
-        and closes it if necessary.
-        """
-        nonlocal last_activity  # Access the last_activity variable from the outer scope
-        while True:
-            now = asyncio.get_event_loop().time()
-            if now - last_activity > idle_timeout:
-                logger.info("websocket_text_endpoint Connection idle timeout exceeded. Closing connection.")
-                await websocket.close(code=1001, reason="Idle timeout")  # Use 1001 for going away
-                return  # Exit the idle check task
-            await asyncio.sleep(60)  # Check every 60 seconds (adjust as needed)
-
-    # Start the idle check task
-    idle_check_task = asyncio.create_task(check_idle())
-
-    try:
-        # session token at connection may be different from token in payload
-        # since token may be expired and refreshed during connection
-        connection_session_token = parse_qs(websocket.url.query).get("session_token", [None])[0]
-
-        if not connection_session_token:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": "Missing session_token"
-            })
-            await websocket.close(code=1002, reason="Missing session token")
-            return
-
-        client_ip = get_client_ip_from_websocket(websocket)
-        is_valid, session_id = await validate_token(connection_session_token, client_ip)
-        if not is_valid:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": "Session_token invalid or expired"
-            })
-            await websocket.close(code=1002, reason="Invalid session token")
-            return
-
-        is_in_ratelimit, result = await check_rate_limits(client_ip, connection_session_token)
-        if not is_in_ratelimit:
-            await websocket.send_json({
-                "type": "stream_error",
-                "text": f"{result}"
-            })
-            await websocket.close(code=1002, reason="Rate limit exceeded")
-            return
-
-        # Send a message to the client to indicate successful connection and session validation
-        #        await websocket.send_json({"type": "connection_success", "session_id": session_id})
-
-        while True:
-            message = await websocket.receive_text()
-            last_activity = asyncio.get_event_loop().time()  # update last_activity
-            data = json.loads(message)
-            if data.get("type") == "userInput":
-                session_token = data.get("session_token")
-                if not session_token:
-                    await websocket.send_json({
-                        "type": "stream_error",
-                        "text": "Missing session_token"
-                    })
-                    continue
-                client_ip = get_client_ip_from_websocket(websocket)
-                is_valid, session_id = await validate_token(session_token, client_ip)
-                if not is_valid:
-                    await websocket.send_json({
-                        "type": "stream_error",
-                        "text": "Session_token invalid or expired"
-                    })
-                    continue
-
-                await process_input(message, websocket, session_id)
-    except WebSocketDisconnect:
-        logger.info("websocket_text_endpoint disconnected by client")
-    except Exception as e:
-        logger.error(f"websocket_text_endpoint error: {e}")
-        await websocket.close(code=1011)  # 1011: Service restart
-    finally:
-        logger.info("websocket_text_endpoint connection closing")
-        try:
-            idle_check_task.cancel()  # Stop the idle check task
-            await websocket.close()
-        except Exception as e:
-            logger.info(f"websocket_text_endpoint connection closing error: {e}")
+    await serve_connection(websocket, "text", process_input, MESSAGE_TYPES)
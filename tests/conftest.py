@@ -0,0 +1,5 @@
+import os
+import sys
+
+# service modules use flat imports (``from app_config import ...``), same as when run from chatagent_ws/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatagent_ws"))
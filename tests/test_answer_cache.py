@@ -0,0 +1,136 @@
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+import answer_cache as answer_cache_module
+import ws_speech
+from answer_cache import AnswerCache, normalize_question, is_cacheable_response
+from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD
+from usage_meter import UsageMeter, TTS_CHARS, AUDIO_BYTES, LLM_TURNS
+
+# needs a local redis, e.g. docker run -p 6379:6379 redis
+
+
+class RecordingStream:
+    def __init__(self):
+        self.frames = []
+
+    async def send_json(self, data):
+        self.frames.append(data)
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+
+async def binary_client():
+    client = redis.Redis(host=APP_REDIS_HOST, port=APP_REDIS_PORT, db=APP_REDIS_DB, password=APP_REDIS_PASSWORD)
+    try:
+        await client.ping()
+    except redis.ConnectionError:
+        pytest.skip("local redis not available")
+    return client
+
+
+def test_normalize_question():
+    assert normalize_question("  What are your   store HOURS? ") == normalize_question("what are your store hours")
+    assert not is_cacheable_response({"cache-control": "private, max-age=0"})
+    assert is_cacheable_response(None)
+
+
+@pytest.mark.asyncio
+async def test_answer_is_replayed_from_cache(monkeypatch):
+    client = await binary_client()
+    cache = AnswerCache(redis_client=client, enabled=True)
+    monkeypatch.setattr(answer_cache_module, "answer_cache", cache)
+    question = f"store hours {uuid.uuid4()}?"
+    calls = []
+
+    async def produce(stream, response_info):
+        calls.append(question)
+        response_info["headers"] = {"cache-control": "max-age=60"}
+        await stream.send_bytes(b"mp3")
+        await stream.send_json({"type": "response_chunk", "text": "9 to 5."})
+        await stream.send_json({"type": "response_end"})
+
+    try:
+        first, second = RecordingStream(), RecordingStream()
+        await answer_cache_module.answer_with_cache("speech", question, first, produce)
+        await answer_cache_module.answer_with_cache("speech", question.upper(), second, produce)
+        assert len(calls) == 1
+        assert second.frames == first.frames
+    finally:
+        entry_id = cache.entry_id("speech", question)
+        await client.delete(cache._key(entry_id))
+        await client.zrem(answer_cache_module.LRU_KEY, entry_id)
+        size = await client.hget(answer_cache_module.SIZES_KEY, entry_id)
+        await client.hdel(answer_cache_module.SIZES_KEY, entry_id)
+        await client.decrby(answer_cache_module.TOTAL_BYTES_KEY, int(size or 0))
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_no_store_answers_are_not_cached(monkeypatch):
+    client = await binary_client()
+    cache = AnswerCache(redis_client=client, enabled=True)
+    monkeypatch.setattr(answer_cache_module, "answer_cache", cache)
+    question = f"my balance {uuid.uuid4()}"
+
+    async def produce(stream, response_info):
+        response_info["headers"] = {"cache-control": "no-store"}
+        await stream.send_json({"type": "response_end"})
+
+    try:
+        await answer_cache_module.answer_with_cache("text", question, RecordingStream(), produce)
+        assert await cache.get("text", question) is None
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_replayed_audio_is_metered_and_capped(monkeypatch):
+    meter = UsageMeter(None, quotas={AUDIO_BYTES: 5})
+    monkeypatch.setattr(answer_cache_module, "usage_meter", meter)
+    frames = [answer_cache_module.FRAME_BYTES + b"mp3",
+              answer_cache_module.FRAME_JSON + b'{"type": "audio_metadata", "format": "mp3", "length": 3}',
+              answer_cache_module.FRAME_JSON + b'{"type": "response_chunk", "text": "9 to 5."}',
+              answer_cache_module.FRAME_BYTES + b"mp3",
+              answer_cache_module.FRAME_JSON + b'{"type": "audio_metadata", "format": "mp3", "length": 3}',
+              answer_cache_module.FRAME_JSON + b'{"type": "response_chunk", "text": "Closed on Sundays."}',
+              answer_cache_module.FRAME_BYTES + b"mp3",
+              answer_cache_module.FRAME_JSON + b'{"type": "audio_metadata", "format": "mp3", "length": 3}',
+              answer_cache_module.FRAME_JSON + b'{"type": "response_chunk", "text": "Bye."}',
+              answer_cache_module.FRAME_JSON + b'{"type": "response_end"}']
+    stream = RecordingStream()
+    await AnswerCache(redis_client=None, enabled=True).replay(frames, stream, "session-1")
+    # the third sentence is over the audio quota and goes out as text only, like a live one would
+    assert stream.frames[6:] == [{"type": "response_chunk", "text": "Bye."}, {"type": "response_end"}]
+    assert stream.frames.count(b"mp3") == 2
+    assert meter.pending["session-1"] == {AUDIO_BYTES: 6, TTS_CHARS: len("9 to 5.") + len("Closed on Sundays.")}
+    assert meter.pending["session-1"][LLM_TURNS] == 0
+
+
+@pytest.mark.asyncio
+async def test_answer_with_refused_tts_is_not_cached(monkeypatch):
+    client = await binary_client()
+    cache = AnswerCache(redis_client=client, enabled=True)
+    monkeypatch.setattr(answer_cache_module, "answer_cache", cache)
+    question = f"store hours {uuid.uuid4()}?"
+
+    async def refused(*args, **kwargs):
+        # TTS admission refused or quota exceeded
+        return None
+
+    monkeypatch.setattr(ws_speech, "synthesize_audio", refused)
+
+    async def produce(stream, response_info):
+        await ws_speech.send_text_and_audio("9 to 5.", stream, "en-US", "en-US", "en-US-Standard-A")
+        await stream.send_json({"type": "response_end"})
+
+    try:
+        stream = RecordingStream()
+        await answer_cache_module.answer_with_cache("speech", question, stream, produce)
+        assert stream.frames == [{"type": "response_chunk", "text": "9 to 5."}, {"type": "response_end"}]
+        assert await cache.get("speech", question) is None
+    finally:
+        await client.aclose()
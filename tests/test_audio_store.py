@@ -0,0 +1,25 @@
+from audio_store import AudioStore, clip_key
+
+
+def test_clips_are_shared_and_persistent(tmp_path):
+    writer = AudioStore(str(tmp_path), capacity=16)
+    reader = AudioStore(str(tmp_path), capacity=16)
+    hello = clip_key("Hello!", "en-US-Wavenet-C", "en-US")
+    assert reader.get(hello) is None
+
+    assert writer.put(hello, b"mp3-hello")
+    # the reader mapped an empty data file before the write
+    assert bytes(reader.get(hello)) == b"mp3-hello"
+
+    restarted = AudioStore(str(tmp_path), capacity=1024)
+    assert bytes(restarted.get(hello)) == b"mp3-hello"
+    assert restarted.capacity == 16
+    assert restarted.count() == 1
+
+
+def test_store_stops_at_max_load(tmp_path):
+    store = AudioStore(str(tmp_path), capacity=4)
+    keys = [clip_key(f"phrase {i}", "voice", "en-US") for i in range(4)]
+    assert [store.put(key, b"mp3") for key in keys] == [True, True, False, False]
+    assert store.get(keys[2]) is None
+    assert bytes(store.get(keys[1])) == b"mp3"
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from backend_limiter import AdaptiveLimiter, CircuitBreaker, BackendGuard, BackendUnavailable, CLOSED, HALF_OPEN, \
+    OPEN
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_queue_is_bounded():
+    limiter = AdaptiveLimiter("test", initial_limit=1, min_limit=1, max_queue=1, max_wait=0.05)
+    await limiter.acquire()
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(BackendUnavailable):
+        await limiter.acquire()
+
+    limiter.release()
+    await waiting
+    assert limiter.in_flight == 1
+    with pytest.raises(BackendUnavailable):
+        await limiter.acquire()
+
+
+async def test_limit_backs_off_on_slow_calls():
+    limiter = AdaptiveLimiter("test", initial_limit=10, min_limit=2, tolerance=2.0)
+    limiter.on_sample(0.1)
+    limiter.on_sample(1.0)
+    assert limiter.limit == pytest.approx(9.0)
+    for _ in range(30):
+        limiter.on_failure()
+    assert limiter.limit == 2
+
+
+async def test_circuit_opens_and_probes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("backend_limiter.time.monotonic", lambda: now[0])
+    guard = BackendGuard("test", breaker=CircuitBreaker("test", window=4, min_calls=4, error_rate=0.5,
+                                                        open_seconds=10))
+    for _ in range(4):
+        with pytest.raises(ConnectionError):
+            async with guard.call():
+                raise ConnectionError("backend down")
+    assert guard.breaker.state == OPEN
+    with pytest.raises(BackendUnavailable):
+        async with guard.call():
+            pass
+
+    now[0] += 11
+    async with guard.call() as backend_call:
+        assert guard.breaker.state == HALF_OPEN
+        backend_call.first_chunk()
+    assert guard.breaker.state == CLOSED
+    assert guard.limiter.in_flight == 0
@@ -0,0 +1,22 @@
+from clause_rules import find_clause_boundary
+
+
+def test_short_openers_are_not_split():
+    assert find_clause_boundary("Yes, of course. ", "ENGLISH") == -1
+
+
+def test_first_long_clause():
+    text = "When you arrive at the main entrance of the building, take the lift"
+    boundary = find_clause_boundary(text, "ENGLISH")
+    assert text[:boundary] == "When you arrive at the main entrance of the building,"
+
+
+def test_numbers_are_not_clause_boundaries():
+    assert find_clause_boundary("The total for the whole order comes to 1,000 dollars and", "ENGLISH") == -1
+
+
+def test_cjk_comma():
+    text = "如果您明天上午想来参观，请提前"
+    assert text[:find_clause_boundary(text, "CHINESE")] == "如果您明天上午想来参观，"
+    # the clause is only complete once something follows the comma
+    assert find_clause_boundary("如果您明天上午想来参观，", "CHINESE") == -1
@@ -0,0 +1,117 @@
+import asyncio
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD
+from connection_registry import ConnectionRegistry, LocalConnection, run_turn, CONTROL_PUSH, CONTROL_CANCEL, \
+    CONTROL_DISCONNECT
+
+# needs a local redis, e.g. docker run -p 6379:6379 redis
+pytestmark = pytest.mark.asyncio
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.closed_with = code
+
+
+async def start_registry():
+    client = redis.Redis(host=APP_REDIS_HOST, port=APP_REDIS_PORT, db=APP_REDIS_DB, password=APP_REDIS_PASSWORD,
+                         decode_responses=True)
+    try:
+        await client.ping()
+    except redis.ConnectionError:
+        pytest.skip("local redis not available")
+    registry = ConnectionRegistry(client, heartbeat_seconds=1, flush_seconds=0.05)
+    await registry.start()
+    return registry
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.02)
+
+
+async def test_register_lookup_unregister():
+    registry = await start_registry()
+    session_id = str(uuid.uuid4())
+    connection = LocalConnection(session_id, RecordingWebSocket(), "text")
+    try:
+        registry.register(connection)
+        await asyncio.sleep(0.2)
+        assert await registry.lookup(session_id) == [registry.worker_id]
+
+        registry.unregister(connection)
+        await asyncio.sleep(0.2)
+        assert await registry.lookup(session_id) == []
+    finally:
+        await registry.stop()
+        await registry.redis_client.aclose()
+
+
+async def test_push_and_disconnect_reach_local_connection():
+    registry = await start_registry()
+    session_id = str(uuid.uuid4())
+    websocket = RecordingWebSocket()
+    registry.register(LocalConnection(session_id, websocket, "speech"))
+    try:
+        await asyncio.sleep(0.2)
+        assert await registry.send_control(session_id, CONTROL_PUSH, {"message": {"type": "refresh"}}) == 1
+        await wait_for(lambda: websocket.sent)
+        assert websocket.sent == [{"type": "refresh"}]
+
+        await registry.send_control(session_id, CONTROL_DISCONNECT)
+        await wait_for(lambda: websocket.closed_with is not None)
+        assert websocket.closed_with == 1008
+    finally:
+        await registry.stop()
+        await registry.redis_client.aclose()
+
+
+async def test_cancel_stops_in_flight_turn():
+    registry = await start_registry()
+    session_id = str(uuid.uuid4())
+    websocket = RecordingWebSocket()
+    connection = LocalConnection(session_id, websocket, "text")
+    registry.register(connection)
+    try:
+        await asyncio.sleep(0.2)
+        turn = asyncio.create_task(run_turn(connection, asyncio.sleep(30)))
+        await wait_for(lambda: connection.turn_task is not None)
+        await registry.send_control(session_id, CONTROL_CANCEL)
+        await asyncio.wait_for(turn, 2)
+        assert websocket.sent == [{"type": "stream_error", "text": "Request cancelled"}]
+    finally:
+        await registry.stop()
+        await registry.redis_client.aclose()
+
+
+async def test_cancel_report_to_a_gone_client_does_not_escape():
+    class GoneWebSocket(RecordingWebSocket):
+        async def send_json(self, data):
+            raise RuntimeError("client gone")
+
+    connection = LocalConnection("session", GoneWebSocket(), "text")
+    turn = asyncio.create_task(run_turn(connection, asyncio.sleep(30)))
+    await wait_for(lambda: connection.turn_task is not None)
+    connection.turn_task.cancel()
+    await asyncio.wait_for(turn, 2)
+    assert connection.turn_task is None
+
+
+async def test_unknown_action_is_rejected():
+    registry = ConnectionRegistry(None)
+    with pytest.raises(ValueError):
+        await registry.send_control("session", "reboot")
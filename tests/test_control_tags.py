@@ -0,0 +1,74 @@
+from control_tags import ControlTagParser
+
+
+def feed_all(parser, chunks):
+    return "".join(parser.feed(chunk) for chunk in chunks) + parser.finish()
+
+
+def test_language_tag_in_single_chunk():
+    parser = ControlTagParser()
+    assert feed_all(parser, ["language-name:french\nBonjour !"]) == "Bonjour !"
+    assert parser.language_name == "FRENCH"
+
+
+def test_language_tag_split_across_chunks():
+    parser = ControlTagParser()
+    chunks = ["lan", "guage-na", "me:fr", "ench", "\nBon", "jour !"]
+    assert feed_all(parser, chunks) == "Bonjour !"
+    assert parser.language_name == "FRENCH"
+
+
+def test_partial_value_is_not_resolved_early():
+    parser = ControlTagParser()
+    assert parser.feed("language-name:fre") == ""
+    assert parser.language_name is None
+    parser.feed("nch\n")
+    assert parser.language_name == "FRENCH"
+
+
+def test_language_is_locked_once_resolved():
+    parser = ControlTagParser()
+    text = feed_all(parser, ["language-name:german\nHallo. ", "language-name:english\nWelt."])
+    assert text == "Hallo. Welt."
+    assert parser.language_name == "GERMAN"
+
+
+def test_text_without_tags_passes_through():
+    parser = ControlTagParser()
+    chunks = ["Our store ", "is open ", "late on ", "Friday. la", "ter too."]
+    assert feed_all(parser, chunks) == "Our store is open late on Friday. later too."
+    assert parser.language_name is None
+
+
+def test_tag_at_end_of_stream():
+    parser = ControlTagParser()
+    assert feed_all(parser, ["你好。", "language-name:chinese"]) == "你好。"
+    assert parser.language_name == "CHINESE"
+
+
+def test_other_directives():
+    parser = ControlTagParser()
+    text = feed_all(parser, ["voice-name:en-US-Wavenet-D speaking-rate:1.2", "5\nHello."])
+    assert text == "Hello."
+    assert parser.voice_name == "en-US-Wavenet-D"
+    assert parser.speaking_rate == 1.25
+
+
+def test_invalid_value_is_stripped_and_ignored():
+    parser = ControlTagParser()
+    assert feed_all(parser, ["speaking-rate:fast\nHi."]) == "Hi."
+    assert parser.speaking_rate is None
+
+
+def test_tag_without_value_is_text():
+    parser = ControlTagParser()
+    for chunks in (["language-name: french\nBonjour !"], ["language-name:", " french\nBonjour !"]):
+        assert feed_all(parser, chunks) == "language-name: french\nBonjour !"
+    assert parser.language_name is None
+
+
+def test_tag_name_inside_a_word_is_text():
+    parser = ControlTagParser()
+    for chunks in (["mylanguage-name:french now"], ["my_voice", "-name:x1 ok"], ["my", "voice-name:x1 ok"]):
+        assert feed_all(parser, chunks) == "".join(chunks)
+    assert parser.values == {}
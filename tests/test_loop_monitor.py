@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+import pytest
+
+from loop_monitor import LoopLagMonitor, loop_lag_histogram
+
+pytestmark = pytest.mark.asyncio
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+async def test_stall_is_measured_and_blocking_stack_captured():
+    monitor = LoopLagMonitor(interval=0.01, stall_threshold=0.1)
+    samples_before = sum(state[2] for state in loop_lag_histogram._values.values())
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        assert monitor.last_stall is None
+        blocking_call()
+        await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+    assert monitor.last_stall is not None
+    assert "blocking_call" in monitor.last_stall["stack"]
+    assert monitor.last_stall["blocked_ms"] >= 100
+    lags = loop_lag_histogram._values[()]
+    assert lags[2] > samples_before
+    # the 0.3s stall falls in the 0.25 - 0.5 bucket
+    assert lags[0][loop_lag_histogram.buckets.index(0.5)] >= 1
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from profiler import Profiler, ProfileBusy, StackSampler, memory_diff
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def idle(stop):
+    stop.wait()
+
+
+def run_threads(sampler, seconds):
+    stop = threading.Event()
+    threads = [threading.Thread(target=spin, args=(stop,), name="spinner"),
+               threading.Thread(target=idle, args=(stop,), name="idler")]
+    for thread in threads:
+        thread.start()
+    # past thread start-up, the idler is blocked from here on
+    time.sleep(0.05)
+    try:
+        sampler.run(seconds)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def test_cpu_mode_leaves_out_waiting_threads():
+    wall = StackSampler("wall", interval=0.005)
+    run_threads(wall, 0.3)
+    wall_threads = {stack[0] for stack in wall.stacks}
+    assert {"spinner", "idler"} <= wall_threads
+
+    cpu = StackSampler("cpu", interval=0.005)
+    run_threads(cpu, 0.3)
+    assert "spinner" in {stack[0] for stack in cpu.stacks}
+    assert "idler" not in {stack[0] for stack in cpu.stacks}
+    assert any(line.startswith("spinner;") and "spin (test_profiler.py" in line
+               for line in cpu.collapsed().splitlines())
+
+
+def test_speedscope_samples_index_shared_frames():
+    sampler = StackSampler("wall")
+    sampler.stacks[("MainThread", "main", "handler")] = 0.02
+    sampler.stacks[("MainThread", "main", "encode")] = 0.01
+    profile = sampler.speedscope("test")
+    frames = [frame["name"] for frame in profile["shared"]["frames"]]
+    assert frames == ["MainThread", "main", "handler", "encode"]
+    assert profile["profiles"][0]["samples"] == [[0, 1, 2], [0, 1, 3]]
+    assert profile["profiles"][0]["weights"] == [20000, 10000]
+
+
+def test_memory_diff_reports_growth():
+    kept = []
+
+    def grow():
+        time.sleep(0.05)
+        kept.append([bytearray(1024) for _ in range(1000)])
+
+    thread = threading.Thread(target=grow)
+    thread.start()
+    report = memory_diff(0.2)
+    thread.join()
+    assert report["top"][0]["size_diff"] >= 1000 * 1024
+    assert any("test_profiler.py" in frame for frame in report["top"][0]["traceback"])
+
+
+@pytest.mark.asyncio
+async def test_one_profile_at_a_time():
+    profiler = Profiler()
+    first = asyncio.create_task(profiler.profile("wall", 0.2, "collapsed"))
+    await asyncio.sleep(0.05)
+    with pytest.raises(ProfileBusy):
+        await profiler.profile("cpu", 0.1)
+    # the event loop thread was sampled while it waited
+    assert "MainThread;" in await first
@@ -0,0 +1,42 @@
+import pytest
+
+from readiness import Readiness
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pings = 0
+
+    async def ping(self):
+        self.pings += 1
+        return True
+
+
+def failing_component():
+    raise RuntimeError("model not available")
+
+
+async def test_not_ready_until_every_component_is_warm():
+    readiness = Readiness(redis_client=FakeRedis())
+    assert not (await readiness.check())["ready"]
+
+    readiness._cached = None
+    await readiness.warm_up({"fast": lambda: None, "broken": failing_component})
+    report = await readiness.check()
+    assert not report["ready"]
+    assert report["checks"]["warm_up"]["components"]["broken"]["error"] == "model not available"
+
+    readiness = Readiness(redis_client=FakeRedis())
+    await readiness.warm_up({"fast": lambda: None})
+    assert (await readiness.check())["ready"]
+
+
+async def test_dependency_checks_are_cached():
+    redis_client = FakeRedis()
+    readiness = Readiness(redis_client=redis_client)
+    await readiness.warm_up({})
+    for _ in range(5):
+        await readiness.check()
+    assert redis_client.pings == 1
@@ -0,0 +1,102 @@
+import json
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+import response_stream
+from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD
+from response_stream import ResponseStream, resume_response_stream
+
+# needs a local redis, e.g. docker run -p 6379:6379 redis
+pytestmark = pytest.mark.asyncio
+
+
+class RecordingWebSocket:
+    def __init__(self, fail_after=None):
+        self.frames = []
+        self.fail_after = fail_after
+
+    def _append(self, frame):
+        if self.fail_after is not None and len(self.frames) >= self.fail_after:
+            raise RuntimeError("client gone")
+        self.frames.append(frame)
+
+    async def send_json(self, data):
+        self._append(json.loads(json.dumps(data)))
+
+    async def send_text(self, data):
+        self._append(json.loads(data))
+
+    async def send_bytes(self, data):
+        self._append(data)
+
+
+@pytest.fixture
+def replay_enabled(monkeypatch):
+    monkeypatch.setattr(response_stream, "APP_REPLAY_ENABLED", True)
+
+
+async def binary_client():
+    client = redis.Redis(host=APP_REDIS_HOST, port=APP_REDIS_PORT, db=APP_REDIS_DB, password=APP_REDIS_PASSWORD)
+    try:
+        await client.ping()
+    except redis.ConnectionError:
+        pytest.skip("local redis not available")
+    return client
+
+
+async def send_answer(stream):
+    await stream.send_bytes(b"mp3-1")
+    await stream.send_json({"type": "audio_metadata", "length": 5})
+    await stream.send_json({"type": "response_chunk", "text": "Hello."})
+    await stream.send_bytes(b"mp3-2")
+    await stream.send_json({"type": "audio_metadata", "length": 5})
+    await stream.send_json({"type": "response_chunk", "text": "Bye."})
+    await stream.send_json({"type": "response_end"})
+
+
+async def test_frames_are_numbered_without_replay():
+    websocket = RecordingWebSocket()
+    stream = ResponseStream(websocket, "session", "text", redis_client=None)
+    await stream.send_json({"type": "response_chunk", "text": "a"})
+    await stream.send_json({"type": "response_end"})
+    assert [frame["seq"] for frame in websocket.frames] == [1, 2]
+
+
+async def test_resume_after_disconnect(replay_enabled):
+    client = await binary_client()
+    session_id = str(uuid.uuid4())
+    try:
+        first = RecordingWebSocket(fail_after=3)
+        stream = ResponseStream(first, session_id, "speech", redis_client=client)
+        # the answer keeps being recorded after the client is gone
+        await send_answer(stream)
+        await stream.wait_flushed()
+        assert stream.detached
+        assert first.frames[-1] == {"type": "response_chunk", "text": "Hello.", "seq": 3}
+
+        second = RecordingWebSocket()
+        resumed = ResponseStream(second, session_id, "speech", redis_client=client)
+        await resume_response_stream(resumed, last_seq=3)
+        assert second.frames == [b"mp3-2", {"type": "audio_metadata", "length": 5, "seq": 5},
+                                 {"type": "response_chunk", "text": "Bye.", "seq": 6},
+                                 {"type": "response_end", "seq": 7}]
+
+        # numbering continues after the replayed frames
+        await resumed.send_json({"type": "response_end"})
+        assert second.frames[-1]["seq"] == 8
+    finally:
+        await client.delete(response_stream.replay_key(session_id, "speech"))
+        await client.aclose()
+
+
+async def test_resume_without_buffer(replay_enabled):
+    client = await binary_client()
+    try:
+        websocket = RecordingWebSocket()
+        stream = ResponseStream(websocket, str(uuid.uuid4()), "text", redis_client=client)
+        await resume_response_stream(stream, last_seq=10)
+        assert websocket.frames == [{"type": "stream_error", "text": "Resume not available", "seq": 1}]
+    finally:
+        await client.aclose()
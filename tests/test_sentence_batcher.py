@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from sentence_batcher import SentenceBatcher, chunks_with_deadline
+
+
+def test_first_sentence_goes_out_alone():
+    batcher = SentenceBatcher(min_chars=30, max_chars=60, max_wait=1)
+    assert batcher.add("Sure!") == ["Sure!"]
+    assert batcher.add("We open at nine.") == []
+    assert batcher.add("And close at five.") == ["We open at nine. And close at five."]
+    assert batcher.flush() is None
+
+
+def test_batches_stay_under_max_chars():
+    batcher = SentenceBatcher(min_chars=100, max_chars=40, max_wait=1)
+    batcher.add("Hello.")
+    assert batcher.add("x" * 25 + ".") == []
+    assert batcher.add("y" * 25 + ".") == ["x" * 25 + "."]
+    assert batcher.flush() == "y" * 25 + "."
+
+
+def test_cjk_sentences_are_joined_without_space():
+    batcher = SentenceBatcher(min_chars=100, max_chars=200, max_wait=1)
+    batcher.add("はい。")
+    batcher.add("九時に開きます。")
+    batcher.add("五時に閉まります。")
+    assert batcher.flush() == "九時に開きます。五時に閉まります。"
+
+
+@pytest.mark.asyncio
+async def test_pending_batch_is_due_while_waiting_for_chunks():
+    batcher = SentenceBatcher(min_chars=100, max_chars=200, max_wait=0.05)
+    batcher.add("First.")
+    batcher.add("Second.")
+
+    async def slow_chunks():
+        await asyncio.sleep(0.2)
+        yield "Third."
+
+    seen = []
+    async for chunk in chunks_with_deadline(slow_chunks(), batcher):
+        seen.append(chunk if chunk is not None else batcher.due())
+    assert seen == ["Second.", "Third."]
@@ -0,0 +1,120 @@
+import hmac
+import json
+import types
+
+import pytest
+import redis.asyncio as redis
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+import session_manager
+from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD, \
+    APP_SECURITY_TOKEN_BULK_MAX, APP_SECURITY_TOKEN_EXPIRY_SECONDS
+from session_manager import generate_session_tokens, validate_token, verify_api_key
+
+# the redis tests need a local redis, e.g. docker run -p 6379:6379 redis
+
+API_KEY = "s3cret-clé"
+REQUEST = types.SimpleNamespace(client=types.SimpleNamespace(host="203.0.113.7"))
+
+
+async def redis_client():
+    client = redis.Redis(host=APP_REDIS_HOST, port=APP_REDIS_PORT, db=APP_REDIS_DB, password=APP_REDIS_PASSWORD,
+                         decode_responses=True)
+    try:
+        await client.ping()
+    except redis.ConnectionError:
+        pytest.skip("local redis not available")
+    return client
+
+
+@pytest.mark.asyncio
+async def test_api_key_is_compared_in_constant_time(monkeypatch):
+    monkeypatch.setattr(session_manager, "APP_WS_API_KEY", API_KEY)
+    compared = []
+    original_compare_digest = hmac.compare_digest
+
+    def compare_digest(a, b):
+        compared.append((a, b))
+        return original_compare_digest(a, b)
+
+    monkeypatch.setattr(session_manager.hmac, "compare_digest", compare_digest)
+    assert await verify_api_key(API_KEY, REQUEST) == API_KEY
+    for wrong in ("s3cret-cle", "s3cret", "", "ключ"):
+        with pytest.raises(HTTPException) as raised:
+            await verify_api_key(wrong, REQUEST)
+        assert raised.value.status_code == 401
+    assert len(compared) == 5
+    assert compared[0] == (API_KEY.encode("utf-8"), API_KEY.encode("utf-8"))
+
+
+def test_non_ascii_api_key_header_is_rejected_not_an_error(monkeypatch):
+    monkeypatch.setattr(session_manager, "APP_WS_API_KEY", API_KEY)
+    client = TestClient(main.app)
+    # header values arrive latin-1 decoded, not the str the key was configured as
+    response = client.post("/api/get_session_tokens", headers={"x-api-key": API_KEY.encode("utf-8")},
+                           json={"count": 1})
+    assert response.status_code == 401
+
+
+def test_bulk_count_is_bounded(monkeypatch):
+    monkeypatch.setattr(session_manager, "APP_WS_API_KEY", "s3cret")
+    client = TestClient(main.app)
+    for count in (0, -1, APP_SECURITY_TOKEN_BULK_MAX + 1):
+        response = client.post("/api/get_session_tokens", headers={"x-api-key": "s3cret"}, json={"count": count})
+        assert response.status_code == 400, count
+
+
+def test_bulk_issuance_failures_are_mapped(monkeypatch):
+    monkeypatch.setattr(session_manager, "APP_WS_API_KEY", "s3cret")
+    client = TestClient(main.app)
+    for error, status_code in ((redis.ConnectionError("refused"), 503), (RuntimeError("bug"), 500)):
+        async def failing(count, client_ip):
+            raise error
+
+        monkeypatch.setattr(main, "generate_session_tokens", failing)
+        response = client.post("/api/get_session_tokens", headers={"x-api-key": "s3cret"}, json={"count": 3})
+        assert response.status_code == status_code
+
+
+@pytest.mark.asyncio
+async def test_bulk_tokens_are_issued_in_one_pipeline(monkeypatch):
+    client = await redis_client()
+    monkeypatch.setattr(session_manager, "session_redis_client", client)
+    client_ip = "198.51.100.23"
+    await client.delete(f"session/ip:{client_ip}")
+    pipelines = []
+    pipeline = client.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def counting_execute(*execute_args, **execute_kwargs):
+            pipelines.append([command[0][0] for command in pipe.command_stack])
+            return await execute(*execute_args, **execute_kwargs)
+
+        pipe.execute = counting_execute
+        return pipe
+
+    monkeypatch.setattr(client, "pipeline", counting_pipeline)
+    tokens = []
+    try:
+        tokens = await generate_session_tokens(5, client_ip)
+        assert len(set(tokens)) == 5
+        assert pipelines == [["SETEX"] * 5 + ["INCRBY", "EXPIRE"]]
+        assert await client.get(f"session/ip:{client_ip}") == "5"
+        assert 0 < await client.ttl(f"session/ip:{client_ip}") <= APP_SECURITY_TOKEN_EXPIRY_SECONDS
+
+        session_ids = set()
+        for token in tokens:
+            assert json.loads(await client.get(f"session/token:{token}"))["ip"] == client_ip
+            valid, session_id = await validate_token(token, client_ip)
+            assert valid
+            session_ids.add(session_id)
+        # a new session for each token
+        assert len(session_ids) == 5
+    finally:
+        await client.delete(f"session/ip:{client_ip}", *[f"session/token:{token}" for token in tokens])
+        await client.aclose()
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from stream_capture import StreamCapture
+
+pytestmark = pytest.mark.asyncio
+
+
+async def paced_reads(chunks, pause: float):
+    for chunk in chunks:
+        await asyncio.sleep(pause)
+        yield chunk
+
+
+async def test_slow_consumer_does_not_inflate_delays():
+    capture = StreamCapture("/api/chat", "hello")
+    chunks = [b"Open ", b"until ", "9 h, à ".encode("utf-8"), b"bient", b"\xc3", b"\xb4t"]
+    received = []
+    async for data in capture.capture_reads(paced_reads(chunks, 0.02)):
+        received.append(data)
+        # e.g. TTS of the sentence before the next read is asked for
+        await asyncio.sleep(0.1)
+    assert received == chunks
+    # the split "ô" is recorded once it is whole, with the time of both reads
+    assert [chunk for _, chunk in capture.events] == ["Open ", "until ", "9 h, à ", "bient", "ôt"]
+    delays = [delay_ms for delay_ms, _ in capture.events]
+    assert max(delays[:4]) < 60
+    assert delays[4] < 90
+
+
+async def test_upstream_error_reaches_consumer():
+    async def failing_reads():
+        yield b"Open "
+        raise ConnectionResetError("upstream went away")
+
+    capture = StreamCapture("/api/chat", "hello")
+    received = []
+    with pytest.raises(ConnectionResetError):
+        async for data in capture.capture_reads(failing_reads()):
+            received.append(data)
+    assert received == [b"Open "]
+    assert capture.events[0][1] == "Open "
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from tts_admission import TtsAdmission, PRIORITY_FIRST_SENTENCE, PRIORITY_NEXT_SENTENCE
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_first_sentences_are_admitted_first():
+    admission = TtsAdmission(rate=50, burst=1, max_queue=10, max_wait=1)
+    assert await admission.acquire()
+    admitted = []
+
+    async def sentence(name, priority):
+        await admission.acquire(priority)
+        admitted.append(name)
+
+    later = asyncio.create_task(sentence("later", PRIORITY_NEXT_SENTENCE))
+    await asyncio.sleep(0)
+    first = asyncio.create_task(sentence("first", PRIORITY_FIRST_SENTENCE))
+    await asyncio.gather(later, first)
+    assert admitted == ["first", "later"]
+
+
+async def test_rejects_after_max_wait():
+    admission = TtsAdmission(rate=0.1, burst=1, max_queue=1, max_wait=0.05)
+    assert await admission.acquire()
+    waiting = asyncio.create_task(admission.acquire())
+    await asyncio.sleep(0)
+    # queue full
+    assert not await admission.acquire()
+    assert not await waiting
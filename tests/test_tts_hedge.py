@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+import tts_hedge
+from tts_hedge import HedgedSynthesizer, LatencyTracker, HedgeBudget
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_synthesizer(budget_tokens):
+    tracker = LatencyTracker(min_samples=3)
+    for _ in range(3):
+        tracker.record("voice", 0.01)
+    budget = HedgeBudget(ratio=0, burst=10)
+    budget.tokens = budget_tokens
+    return HedgedSynthesizer(enabled=True, percentile=90, tracker=tracker, budget=budget)
+
+
+def first_call_stalls():
+    calls = []
+    lock = threading.Lock()
+
+    def synthesize():
+        with lock:
+            calls.append(None)
+            call = len(calls)
+        time.sleep(0.5 if call == 1 else 0.01)
+        return f"audio-{call}"
+
+    return synthesize, calls
+
+
+async def test_slow_call_is_hedged():
+    synthesizer = make_synthesizer(budget_tokens=1)
+    synthesize, calls = first_call_stalls()
+    started = time.monotonic()
+    assert await synthesizer.synthesize("voice", synthesize) == "audio-2"
+    assert time.monotonic() - started < 0.4
+    assert len(calls) == 2
+
+
+async def test_budget_caps_hedges():
+    synthesizer = make_synthesizer(budget_tokens=0)
+    synthesize, calls = first_call_stalls()
+    assert await synthesizer.synthesize("voice", synthesize) == "audio-1"
+    assert len(calls) == 1
+
+
+async def test_hedges_take_admission_only_for_rate_limited_engines(monkeypatch):
+    acquired = []
+
+    def try_acquire():
+        # the bucket is empty
+        acquired.append(None)
+        return False
+
+    monkeypatch.setattr(tts_hedge.tts_admission, "try_acquire", try_acquire)
+    synthesize, calls = first_call_stalls()
+    assert await make_synthesizer(budget_tokens=1).synthesize("voice", synthesize, rate_limited=False) == "audio-2"
+    assert acquired == []
+
+    synthesize, calls = first_call_stalls()
+    assert await make_synthesizer(budget_tokens=1).synthesize("voice", synthesize, rate_limited=True) == "audio-1"
+    assert len(acquired) == 1
+    assert len(calls) == 1
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import ws_speech
+from tts_provider import TtsRouter, TtsProvider, TtsEngineError, FakeTtsProvider, LocalTtsProvider
+
+
+def make_router(**kwargs):
+    providers = {"google": FakeTtsProvider(), "local": LocalTtsProvider(command="cat"), "fake": FakeTtsProvider()}
+    return TtsRouter(providers, **kwargs)
+
+
+def test_fake_audio_is_deterministic():
+    fake = FakeTtsProvider()
+    assert fake.synthesize("Hello.", "en-US", "en-US-Wavenet-C") == fake.synthesize("Hello.", "en-US",
+                                                                                    "en-US-Wavenet-C")
+    assert fake.synthesize("Hello.", "en-US", "en-US-Wavenet-C") != fake.synthesize("Hello.", "en-US",
+                                                                                    "en-US-Wavenet-C", 1.2)
+
+
+def test_routes_by_language_and_length():
+    router = make_router(default="google", routes="KOREAN:local", short_text_provider="fake",
+                         short_text_max_chars=10)
+    assert router.provider_for("KOREAN", "안녕하세요, 무엇을 도와드릴까요?").name == "local"
+    assert router.provider_for("ENGLISH", "How can I help you today?") is router.providers["google"]
+    assert router.provider_for("ENGLISH", "Hello!").name == "fake"
+    # unknown engines fall back to the default
+    router = make_router(default="google", routes="FRENCH:piper")
+    assert router.provider_for("FRENCH", "Bonjour à tous !") is router.providers["google"]
+
+
+def test_local_engine_reads_stdin():
+    local = LocalTtsProvider(command="cat")
+    assert local.voice_for("cmn-CN", "cmn-CN-Wavenet-A") == "cmn"
+    assert local.synthesize("Bonjour", "fr-FR", "fr-fr") == b"Bonjour"
+
+
+def test_providers_must_implement_synthesize():
+    class Silent(TtsProvider):
+        name = "silent"
+
+    with pytest.raises(TypeError):
+        Silent()
+
+
+def test_local_engine_failures_are_engine_errors():
+    for local in (LocalTtsProvider(command="false"), LocalTtsProvider(command="no-such-tts-engine"),
+                  LocalTtsProvider(command="sleep 5", timeout=0.1)):
+        with pytest.raises(TtsEngineError):
+            local.synthesize("Bonjour", "fr-FR", "fr-fr")
+
+
+def test_broken_engine_sends_text_only(monkeypatch):
+    monkeypatch.setattr(ws_speech, "tts_router", make_router(default="local", routes="", short_text_max_chars=0))
+    monkeypatch.setitem(ws_speech.tts_router.providers, "local", LocalTtsProvider(command="false"))
+    assert asyncio.run(ws_speech.synthesize_audio("Bonjour", "fr-FR", "fr-FR-Wavenet-A")) is None
@@ -0,0 +1,71 @@
+import json
+
+from upstream_decoder import UpstreamDecoder, UpstreamEvent, framing_for, FRAMING_SSE, FRAMING_NDJSON, \
+    FRAMING_PLAIN, EVENT_TEXT, EVENT_ERROR, EVENT_CONTROL, DONE_EVENT
+
+
+def decode_all(decoder, reads):
+    events = []
+    for data in reads:
+        events.extend(decoder.feed(data))
+    return events + decoder.finish()
+
+
+def split_every(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def joined_text(events):
+    return "".join(event.text for event in events if event.kind == EVENT_TEXT)
+
+
+def test_framing_follows_content_type():
+    assert framing_for("text/event-stream; charset=utf-8") == FRAMING_SSE
+    assert framing_for("application/x-ndjson") == FRAMING_NDJSON
+    assert framing_for("text/plain; charset=utf-8") == FRAMING_PLAIN
+    assert framing_for(None) == FRAMING_PLAIN
+
+
+def test_plain_done_glued_to_text():
+    events = decode_all(UpstreamDecoder(), [b"Open until 9 p.m.[DONE]"])
+    assert events == [UpstreamEvent(EVENT_TEXT, "Open until 9 p.m."), DONE_EVENT]
+
+
+def test_plain_done_and_utf8_split_across_every_byte():
+    body = "Bien sûr ! Ouvert à 9 h. 営業中です。[DONE]".encode("utf-8")
+    events = decode_all(UpstreamDecoder(), split_every(body, 1))
+    assert joined_text(events) == "Bien sûr ! Ouvert à 9 h. 営業中です。"
+    assert events[-1] == DONE_EVENT
+    assert "[" not in joined_text(events)
+
+
+def test_plain_error_after_text():
+    events = decode_all(UpstreamDecoder(), [b"Let me check", b". Error: upstream timeout"])
+    assert joined_text(events) == "Let me check. "
+    assert events[-1] == UpstreamEvent(EVENT_ERROR, "Error: upstream timeout")
+
+
+def test_plain_held_prefix_flushed_at_end():
+    events = decode_all(UpstreamDecoder(), [b"see [DO"])
+    assert joined_text(events) == "see [DO"
+
+
+def test_sse_frames_split_anywhere():
+    body = ("event: control\ndata: language-name:french\n\n"
+            "data: Bonjour,\r\ndata: à bientôt\r\n\r\n"
+            ": keep-alive\n\n"
+            "data: [DONE]\n\ndata: ignored\n\n").encode("utf-8")
+    for size in (1, 3, 7, len(body)):
+        events = decode_all(UpstreamDecoder(FRAMING_SSE), split_every(body, size))
+        assert events == [UpstreamEvent(EVENT_CONTROL, "french", "language-name"),
+                          UpstreamEvent(EVENT_TEXT, "Bonjour,\nà bientôt"), DONE_EVENT]
+
+
+def test_ndjson_frames():
+    lines = [{"type": "control", "name": "speaking-rate", "value": "1.2"}, {"type": "text", "text": "Hi [DONE] there"},
+             {"type": "error", "text": "quota"}]
+    body = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+    events = decode_all(UpstreamDecoder(FRAMING_NDJSON), split_every(body, 5))
+    # the sentinel is only special in plain text, a framed text is taken as is
+    assert events == [UpstreamEvent(EVENT_CONTROL, "1.2", "speaking-rate"), UpstreamEvent(EVENT_TEXT, "Hi [DONE] there"),
+                      UpstreamEvent(EVENT_ERROR, "quota")]
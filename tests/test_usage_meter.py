@@ -0,0 +1,67 @@
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from app_config import APP_REDIS_HOST, APP_REDIS_PORT, APP_REDIS_DB, APP_REDIS_PASSWORD
+from usage_meter import UsageMeter, TTS_CHARS, AUDIO_BYTES, LLM_TURNS
+
+# needs a local redis, e.g. docker run -p 6379:6379 redis
+pytestmark = pytest.mark.asyncio
+
+
+async def redis_client():
+    client = redis.Redis(host=APP_REDIS_HOST, port=APP_REDIS_PORT, db=APP_REDIS_DB, password=APP_REDIS_PASSWORD,
+                         decode_responses=True)
+    try:
+        await client.ping()
+    except redis.ConnectionError:
+        pytest.skip("local redis not available")
+    return client
+
+
+async def test_counts_are_flushed_in_batches_and_on_close():
+    client = await redis_client()
+    meter = UsageMeter(client, quotas={})
+    session_id, other_id = str(uuid.uuid4()), str(uuid.uuid4())
+    try:
+        await meter.open(session_id)
+        meter.record(session_id, llm_turns=1)
+        meter.record(session_id, tts_chars=40, audio_bytes=8000)
+        meter.record(session_id, tts_chars=2, audio_bytes=400)
+        meter.record(other_id, llm_turns=1)
+        assert await client.exists(f"session/usage:{session_id}") == 0
+        # not flushed yet, but counted in the query
+        assert await meter.usage(session_id) == {TTS_CHARS: 42, AUDIO_BYTES: 8400, LLM_TURNS: 1}
+
+        await meter.flush()
+        assert meter.pending == {}
+        assert await client.hgetall(f"session/usage:{session_id}") == {"llm_turns": "1", "tts_chars": "42",
+                                                                      "audio_bytes": "8400"}
+        meter.record(session_id, llm_turns=1)
+        await meter.close(session_id)
+        assert await meter.usage(session_id) == {TTS_CHARS: 42, AUDIO_BYTES: 8400, LLM_TURNS: 2}
+        assert await meter.usage(other_id) == {TTS_CHARS: 0, AUDIO_BYTES: 0, LLM_TURNS: 1}
+    finally:
+        await client.delete(f"session/usage:{session_id}", f"session/usage:{other_id}")
+        await client.aclose()
+
+
+async def test_quotas_are_checked_against_local_counts():
+    client = await redis_client()
+    meter = UsageMeter(client, quotas={LLM_TURNS: 3, TTS_CHARS: 0})
+    session_id = str(uuid.uuid4())
+    try:
+        # two turns on another worker, read once when the session connects here
+        await client.hset(f"session/usage:{session_id}", mapping={"llm_turns": 2})
+        await meter.open(session_id)
+        assert meter.exceeded(session_id) is None
+        meter.record(session_id, llm_turns=1, tts_chars=10_000)
+        assert meter.exceeded(session_id) == LLM_TURNS
+        assert meter.exceeded(session_id, (TTS_CHARS,)) is None
+        await meter.close(session_id)
+        assert meter.totals == {}
+        assert (await meter.usage(session_id))[LLM_TURNS] == 3
+    finally:
+        await client.delete(f"session/usage:{session_id}")
+        await client.aclose()
@@ -0,0 +1,189 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+import ws_connection
+from connection_registry import run_turn
+from response_stream import ResponseStream
+from ws_connection import Connection, ConnectionReaper, connection_reaper, dead_peer_counter, serve_connection
+
+pytestmark = pytest.mark.asyncio
+
+
+class IdleWebSocket:
+    scope = {"headers": []}
+
+    def __init__(self):
+        self.closed_with = None
+        self.sent = []
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.closed_with = code
+
+
+async def test_connection_state_is_slotted():
+    connection = Connection(IdleWebSocket(), "text")
+    assert not hasattr(connection, "__dict__")
+    assert not connection.authenticated
+
+
+async def test_reaper_closes_idle_connections_but_not_busy_ones():
+    reaper = ConnectionReaper(idle_timeout=0.05, check_seconds=0.01)
+    idle, busy, active = (Connection(IdleWebSocket(), "text") for _ in range(3))
+    busy.turn_task = asyncio.create_task(asyncio.sleep(1))
+    reaper.connections.update((idle, busy, active))
+    await asyncio.sleep(0.1)
+    active.last_activity = asyncio.get_running_loop().time()
+    await reaper.reap()
+    busy.turn_task.cancel()
+
+    assert idle.websocket.closed_with == 1001
+    assert busy.websocket.closed_with is None
+    assert active.websocket.closed_with is None
+    assert reaper.connections == {busy, active}
+
+
+async def test_heartbeat_reclaims_dead_peers_and_cancels_their_turns():
+    reaper = ConnectionReaper(heartbeat_seconds=1, missed_pongs=2)
+    dead, legacy = Connection(IdleWebSocket(), "speech"), Connection(IdleWebSocket(), "text")
+    for connection in (dead, legacy):
+        connection.session_id = "session"
+    dead.heartbeat_acked = True
+    dead.turn_task = asyncio.create_task(asyncio.sleep(10))
+    reaper.connections.update((dead, legacy))
+    dead_before = dead_peer_counter._values.get(("speech",), 0)
+
+    for _ in range(3):
+        await reaper.heartbeat()
+    assert dead.websocket.sent == [{"type": "ping"}] * 3
+    assert dead.websocket.closed_with is None
+
+    await reaper.heartbeat()
+    await asyncio.sleep(0)
+    assert dead.websocket.closed_with == 1001
+    assert dead.turn_task.cancelled()
+    assert dead_peer_counter._values[("speech",)] == dead_before + 1
+    # never answered a ping, so it isn't judged by them
+    assert legacy.websocket.closed_with is None
+    assert reaper.connections == {legacy}
+
+
+async def test_heartbeat_reclaims_silent_clients_that_never_answered(monkeypatch):
+    # replay on does not keep a dead peer's turns running by default
+    monkeypatch.setattr(ws_connection, "APP_REPLAY_ENABLED", True)
+    reaper = ConnectionReaper(heartbeat_seconds=1, missed_pongs=2, silent_timeout=0.05)
+    silent, talking = Connection(IdleWebSocket(), "text"), Connection(IdleWebSocket(), "text")
+    for connection in (silent, talking):
+        connection.session_id = "session"
+    silent.turn_task = asyncio.create_task(asyncio.sleep(10))
+    reaper.connections.update((silent, talking))
+    for _ in range(3):
+        await reaper.heartbeat()
+    await asyncio.sleep(0.1)
+    talking.last_seen = asyncio.get_running_loop().time()
+
+    await reaper.heartbeat()
+    await asyncio.sleep(0)
+    assert silent.websocket.closed_with == 1001
+    assert silent.turn_task.cancelled()
+    assert talking.websocket.closed_with is None
+    assert reaper.connections == {talking}
+
+
+async def test_cancelled_turn_is_reported_on_the_answer_stream():
+    websocket = IdleWebSocket()
+    connection = Connection(websocket, "text")
+    connection.session_id = "session"
+    connection.stream = ResponseStream(websocket, "session", "text", redis_client=None)
+
+    async def turn():
+        await connection.stream.send_json({"type": "response_chunk", "text": "Open"})
+        await asyncio.sleep(10)
+
+    running = asyncio.create_task(run_turn(connection, turn()))
+    while not websocket.sent:
+        await asyncio.sleep(0.01)
+    connection.turn_task.cancel()
+    await asyncio.wait_for(running, 2)
+    # numbered like the answer, so a resume of the turn ends on it
+    assert websocket.sent == [{"type": "response_chunk", "text": "Open", "seq": 1},
+                              {"type": "stream_error", "text": "Request cancelled", "seq": 2}]
+
+
+class AnsweringWebSocket:
+    """
+    A live client: answers every ping with a pong, sends its scripted
+    messages and disconnects once told to.
+    """
+    scope = {"headers": []}
+    url = SimpleNamespace(query="session_token=token")
+
+    def __init__(self, messages):
+        self.inbox = asyncio.Queue()
+        for message in messages:
+            self.inbox.put_nowait(message)
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        message = await self.inbox.get()
+        if message is None:
+            raise WebSocketDisconnect(1000)
+        return message
+
+    async def send_json(self, data):
+        self.sent.append(data)
+        if data.get("type") == "ping":
+            self.inbox.put_nowait(json.dumps({"type": "pong"}))
+
+    async def close(self, code=1000, reason=None):
+        if self.closed_with is None:
+            self.closed_with = code
+        self.inbox.put_nowait(None)
+
+
+async def test_long_turn_of_a_live_client_outlasts_the_heartbeat(monkeypatch):
+    async def validate_token(token, client_ip):
+        return True, "session-long-turn"
+
+    async def check_rate_limits(client_ip, token):
+        return True, ""
+
+    async def long_turn(message, stream, session_id):
+        # several heartbeat intervals, more than missed_pongs of them
+        await asyncio.sleep(0.5)
+        await stream.send_json({"type": "response_end"})
+
+    monkeypatch.setattr(ws_connection, "validate_token", validate_token)
+    monkeypatch.setattr(ws_connection, "check_rate_limits", check_rate_limits)
+    monkeypatch.setattr(connection_reaper, "heartbeat_seconds", 0.05)
+    monkeypatch.setattr(connection_reaper, "missed_pongs", 2)
+    dead_before = dead_peer_counter._values.get(("text",), 0)
+    websocket = AnsweringWebSocket([])
+    connection_reaper.start()
+    try:
+        endpoint = asyncio.create_task(serve_connection(websocket, "text", long_turn, ("userInput",)))
+        # the client answers pings while idle first, from then on missed pongs count
+        while not any(connection.heartbeat_acked for connection in connection_reaper.connections):
+            await asyncio.sleep(0.01)
+        websocket.inbox.put_nowait(json.dumps({"type": "userInput", "text": "hi", "session_token": "token"}))
+        while not any(frame.get("type") == "response_end" for frame in websocket.sent):
+            await asyncio.sleep(0.01)
+            assert not endpoint.done()
+        websocket.inbox.put_nowait(None)
+        await asyncio.wait_for(endpoint, 2)
+    finally:
+        await connection_reaper.stop()
+
+    assert sum(frame.get("type") == "ping" for frame in websocket.sent) > 2
+    assert dead_peer_counter._values.get(("text",), 0) == dead_before
+    assert websocket.closed_with == 1000
@@ -0,0 +1,138 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+import ws_connection
+from connection_registry import CONTROL_PUSH
+from ws_mux import MuxWriter, MuxClosed, MuxConnection, websocket_mux_endpoint
+
+pytestmark = pytest.mark.asyncio
+
+
+class SlowWebSocket:
+    def __init__(self, fail_after=None):
+        self.frames = []
+        self.fail_after = fail_after
+
+    async def _append(self, frame):
+        await asyncio.sleep(0.001)
+        if self.fail_after is not None and len(self.frames) >= self.fail_after:
+            raise RuntimeError("client gone")
+        self.frames.append(frame)
+
+    async def send_json(self, data):
+        await self._append(json.loads(json.dumps(data)))
+
+    async def send_bytes(self, data):
+        await self._append(data)
+
+
+async def produce(stream, count):
+    for i in range(count):
+        await stream.send_json({"type": "response_chunk", "text": str(i)})
+
+
+async def test_streams_interleave_fairly():
+    websocket = SlowWebSocket()
+    writer = MuxWriter(websocket, queue_frames=4)
+    writer.start()
+    speech, text = writer.stream("speech-1"), writer.stream("text-1")
+    # the speech answer starts first and has far more frames
+    await asyncio.gather(produce(speech, 40), produce(text, 5))
+    while len(websocket.frames) < 45:
+        await asyncio.sleep(0.01)
+    await writer.stop()
+
+    order = [frame["stream_id"] for frame in websocket.frames]
+    # every text frame is out within the first rounds, not after the 40 speech frames
+    assert max(i for i, stream_id in enumerate(order) if stream_id == "text-1") < 15
+    assert [frame["text"] for frame in websocket.frames if frame["stream_id"] == "speech-1"] == \
+           [str(i) for i in range(40)]
+
+
+async def test_binary_frames_carry_the_stream_id():
+    websocket = SlowWebSocket()
+    writer = MuxWriter(websocket)
+    writer.start()
+    await writer.stream("s1").send_bytes(b"audio")
+    while not websocket.frames:
+        await asyncio.sleep(0.01)
+    await writer.stop()
+    frame = websocket.frames[0]
+    assert frame[1:1 + frame[0]] == b"s1"
+    assert frame[1 + frame[0]:] == b"audio"
+
+
+async def test_senders_fail_once_the_websocket_is_gone():
+    writer = MuxWriter(SlowWebSocket(fail_after=2), queue_frames=2)
+    writer.start()
+    with pytest.raises(MuxClosed):
+        await produce(writer.stream("s1"), 10)
+    await writer.stop()
+
+
+class ScriptedWebSocket:
+    scope = {"headers": []}
+    url = SimpleNamespace(query="session_token=token")
+
+    def __init__(self, messages):
+        self.inbox = list(messages)
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        await asyncio.sleep(0.01)
+        if not self.inbox:
+            raise WebSocketDisconnect(1000)
+        return self.inbox.pop(0)
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        if self.closed_with is None:
+            self.closed_with = code
+
+
+async def test_bad_messages_fail_alone(monkeypatch):
+    async def validate_token(token, client_ip):
+        return True, "session-1"
+
+    async def check_rate_limits(client_ip, token):
+        return True, ""
+
+    monkeypatch.setattr(ws_connection, "validate_token", validate_token)
+    monkeypatch.setattr(ws_connection, "check_rate_limits", check_rate_limits)
+    websocket = ScriptedWebSocket([
+        "not json",
+        json.dumps({"type": "userInput", "stream_id": "\U0001F600" * 64, "text": "hi", "session_token": "token"}),
+        json.dumps({"type": "resume", "stream_id": "s1", "last_seq": "seven", "session_token": "token"}),
+    ])
+    await asyncio.wait_for(websocket_mux_endpoint(websocket), 5)
+
+    errors = [frame for frame in websocket.sent if frame.get("type") == "stream_error"]
+    assert [(frame.get("stream_id"), frame["text"]) for frame in errors] == \
+           [("", "Invalid message"), ("", "Invalid stream_id"), ("s1", "Invalid last_seq")]
+    # the connection outlived all three, it was closed normally at the end
+    assert websocket.closed_with == 1000
+
+
+async def test_pushes_go_through_the_writer():
+    websocket = ScriptedWebSocket([])
+    connection = MuxConnection(websocket)
+    await connection.on_open()
+    await connection.handle_control(CONTROL_PUSH, {"message": {"type": "refresh"}})
+    assert websocket.sent == []
+    while not websocket.sent:
+        await asyncio.sleep(0.01)
+    await connection.on_close()
+    assert websocket.sent == [{"type": "refresh", "stream_id": ""}]